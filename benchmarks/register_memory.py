@@ -0,0 +1,96 @@
+#------------------------------------------------------------------------------
+# direncrypt - Sync contents between encrypted and decrypted directories
+# Copyright (C) 2015-2019  Domagoj Marsic
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Contact:
+# https://github.com/dmarsic
+# <dmars+github@protonmail.com>
+#------------------------------------------------------------------------------
+
+"""Memory per register record.
+
+Builds a register of generated rows, as returned by the database,
+and measures with tracemalloc the memory taken by the register
+dict, once with a dict per record and once with RegisterRecord.
+
+Usage: python benchmarks/register_memory.py [number of records]
+"""
+
+import os
+import sys
+import uuid
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from direncrypt.inventory import RegisterRecord
+
+
+def make_rows(count):
+    """Generate register rows in REGISTER_COLUMNS order."""
+    public_id = 'public_id'
+    for n in range(count):
+        yield ('dir_{}/file_{}.txt'.format(n // 100, n), str(uuid.uuid4()),
+               ''.join(public_id), 0, '', 4096 + n, 1500000000000000000 + n,
+               1000000 + n, 1500000000000000000 + n, None, None, None, 0,
+               None, ''.join('gpg'))
+
+
+def make_dict(row):
+    """A record as a dict, the way records were kept before RegisterRecord."""
+    fingerprint = None
+    if row[5] is not None:
+        fingerprint = (row[5], row[6], row[7], row[8])
+    pack = None
+    if row[10] is not None:
+        pack = (row[10], row[11])
+    return {
+        'unencrypted_file': row[0],
+        'encrypted_file':   row[1],
+        'public_id':        row[2],
+        'is_link':          row[3],
+        'target':           row[4],
+        'fingerprint':      fingerprint,
+        'digest':           row[9],
+        'pack':             pack,
+        'chunked':          bool(row[12]),
+        'key_id':           row[13],
+        'backend':          row[14]
+    }
+
+
+def measure(count, make):
+    """Return bytes allocated for a register of count records."""
+    tracemalloc.start()
+    register = {row[0]: make(row) for row in make_rows(count)}
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del register
+    return size
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    print('Records: {}'.format(count))
+    for name, make in (('dict', make_dict),
+                       ('RegisterRecord', lambda row: RegisterRecord(*row))):
+        size = measure(count, make)
+        print('{:<15} {:>12} bytes {:>8.1f} bytes/record'.format(
+            name, size, size / count))
+
+
+if __name__ == '__main__':
+    main()
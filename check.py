@@ -34,6 +34,7 @@ import argparse
 import getpass
 from direncrypt import DATABASE
 from direncrypt.consistency import ConsistencyCheck
+from direncrypt.database_builder import DatabaseBuilder
 
 
 if __name__ == "__main__":
@@ -56,10 +57,17 @@ if __name__ == "__main__":
             action='store_true',
             help='Displays number of records')
 
+    parser.add_argument('--scan-workers',
+            type=int, default=1, metavar='N',
+            help='Number of threads checking file existence')
+
     args = parser.parse_args()
 
-    c = ConsistencyCheck(database)
-    c.check()
+    database_builder = DatabaseBuilder(database)
+    if database_builder.exists():
+        database_builder.migrate()
+
+    c = ConsistencyCheck(database, scan_workers=args.scan_workers)
 
     if args.clean:
         c.loop_through(clean=True)
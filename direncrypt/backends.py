@@ -0,0 +1,220 @@
+#------------------------------------------------------------------------------
+# direncrypt - Sync contents between encrypted and decrypted directories
+# Copyright (C) 2015-2019  Domagoj Marsic
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Contact:
+# https://github.com/dmarsic
+# <dmars+github@protonmail.com>
+#------------------------------------------------------------------------------
+
+import os
+import abc
+import hmac
+import uuid
+import asyncio
+import hashlib
+
+try:
+    from cryptography.exceptions import InvalidTag
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+except ImportError:
+    AESGCM = None
+
+
+class BackendResult(object):
+    """Result of an in-process backend or of a gpg process run by asyncio.
+
+    It has the ok and stderr attributes of python-gnupg results,
+    so results of all backends can be handled the same way.
+    """
+
+    def __init__(self, ok, stderr=''):
+        self.ok = ok
+        self.stderr = stderr
+
+
+class Backend(abc.ABC):
+    """Interface of encryption backends.
+
+    A backend encrypts content read from a binary stream into a file
+    in the encrypted directory, and decrypts an encrypted stream into
+    a file. Results have an ok attribute, and a stderr message if ok
+    is False. The name of the backend is stored with every registered
+    file, so files are decrypted by the backend that encrypted them.
+
+    Subclasses implement encrypt_stream() and decrypt_stream(), and
+    cannot be instantiated without them. File operations and their
+    coroutine versions are built on top of them.
+    """
+
+    name = None
+
+    @abc.abstractmethod
+    def encrypt_stream(self, stream, encfile, name=None, session_key=None):
+        """Encrypt content read from a binary stream into encfile."""
+
+    @abc.abstractmethod
+    def decrypt_stream(self, stream, output, phrase):
+        """Decrypt content read from a binary stream into the file output."""
+
+    def encrypt(self, plainfile, encfile, session_key=None):
+        """Encrypt content from plainfile into encfile."""
+        with open(plainfile, mode='rb') as f:
+            return self.encrypt_stream(f, encfile, plainfile, session_key)
+
+    def decrypt(self, encfile, plainfile, phrase):
+        """Decrypt content from encfile into plainfile.
+
+        The plaintext is written to a temporary file next to plainfile,
+        which is renamed to plainfile only if decryption succeeds.
+        """
+        tmpfile = self.temporary_path(plainfile)
+        try:
+            with open(encfile, mode='rb') as f:
+                result = self.decrypt_stream(f, tmpfile, phrase)
+            if result.ok:
+                os.replace(tmpfile, plainfile)
+            return result
+        finally:
+            if os.path.lexists(tmpfile):
+                os.remove(tmpfile)
+
+    async def encrypt_async(self, plainfile, encfile, session_key=None):
+        """Same as encrypt(), run in the default executor of the event loop."""
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self.encrypt, plainfile, encfile, session_key)
+
+    async def decrypt_async(self, encfile, plainfile, phrase):
+        """Same as decrypt(), run in the default executor of the event loop."""
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self.decrypt, encfile, plainfile, phrase)
+
+    def temporary_path(self, plainfile):
+        """Create the directory of plainfile and return a temporary path in it."""
+        plaindir = os.path.dirname(plainfile)
+        if not os.path.exists(plaindir):
+            # another thread may be creating the same directory
+            os.makedirs(plaindir, exist_ok=True)
+        return os.path.join(plaindir, '.{}.{}.tmp'.format(
+            os.path.basename(plainfile), uuid.uuid4().hex))
+
+
+class AEADBackend(Backend):
+    """AES-256-GCM encryption in the calling process.
+
+    This backend needs the optional cryptography package. It encrypts
+    with a session key only, so no gpg process is started per file;
+    the session key itself is encrypted to the public id with gpg.
+
+    An encrypted file starts with a header of MAGIC, a random salt and
+    a random nonce prefix. The file key is derived from the session key
+    and the salt, so every file has its own key. Content follows in
+    segments of SEGMENT_SIZE bytes, each encrypted and authenticated
+    on its own, with the header as associated data. The nonce of a
+    segment is the prefix, the segment number and a flag set only on
+    the last segment, so reordered, truncated or extended files fail
+    to decrypt.
+    """
+
+    name = 'aead'
+    MAGIC = b'DIRENCA1'
+    SALT_SIZE = 16
+    PREFIX_SIZE = 7
+    HEADER_SIZE = len(MAGIC) + SALT_SIZE + PREFIX_SIZE
+    SEGMENT_SIZE = 64 * 1024
+    TAG_SIZE = 16
+
+    def __init__(self):
+        """Check that the cryptography package is installed."""
+        if AESGCM is None:
+            raise ImportError('The aead backend needs the cryptography package, '
+                              'install it with: pipenv install cryptography')
+
+    @staticmethod
+    def available():
+        """Return True if the cryptography package is installed."""
+        return AESGCM is not None
+
+    def file_cipher(self, session_key, salt):
+        """Return the cipher of a single file."""
+        key = hmac.new(salt, session_key.encode('utf-8'), hashlib.sha256).digest()
+        return AESGCM(key)
+
+    def nonce(self, prefix, counter, last):
+        """Return the nonce of a segment."""
+        return prefix + counter.to_bytes(4, 'big') + (b'\x01' if last else b'\x00')
+
+    def encrypt_stream(self, stream, encfile, name=None, session_key=None):
+        """Encrypt content read from a binary stream into encfile.
+
+        A partially written encfile is removed if encryption fails.
+        """
+        if not session_key:
+            return BackendResult(False, 'The aead backend needs a session key')
+        salt = os.urandom(self.SALT_SIZE)
+        prefix = os.urandom(self.PREFIX_SIZE)
+        header = self.MAGIC + salt + prefix
+        cipher = self.file_cipher(session_key, salt)
+        try:
+            with open(encfile, mode='wb') as out:
+                out.write(header)
+                counter = 0
+                segment = stream.read(self.SEGMENT_SIZE)
+                while True:
+                    following = stream.read(self.SEGMENT_SIZE)
+                    last = not following
+                    out.write(cipher.encrypt(
+                        self.nonce(prefix, counter, last), segment, header))
+                    if last:
+                        break
+                    segment = following
+                    counter += 1
+        except OSError as e:
+            if os.path.lexists(encfile):
+                os.remove(encfile)
+            return BackendResult(False, str(e))
+        return BackendResult(True)
+
+    def decrypt_stream(self, stream, output, phrase):
+        """Decrypt content read from a binary stream into the file output.
+
+        phrase is the session key the content was encrypted with.
+        """
+        header = stream.read(self.HEADER_SIZE)
+        if len(header) < self.HEADER_SIZE or not header.startswith(self.MAGIC):
+            return BackendResult(False, 'Not encrypted by the aead backend')
+        if not phrase:
+            return BackendResult(False, 'The aead backend needs a session key')
+        salt = header[len(self.MAGIC):len(self.MAGIC) + self.SALT_SIZE]
+        prefix = header[-self.PREFIX_SIZE:]
+        cipher = self.file_cipher(phrase, salt)
+        with open(output, mode='wb') as out:
+            counter = 0
+            segment = stream.read(self.SEGMENT_SIZE + self.TAG_SIZE)
+            while True:
+                following = stream.read(self.SEGMENT_SIZE + self.TAG_SIZE)
+                last = not following
+                try:
+                    out.write(cipher.decrypt(
+                        self.nonce(prefix, counter, last), segment, header))
+                except InvalidTag:
+                    return BackendResult(
+                        False, 'Authentication failed: wrong key or damaged file')
+                if last:
+                    break
+                segment = following
+                counter += 1
+        return BackendResult(True)
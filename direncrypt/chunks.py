@@ -0,0 +1,89 @@
+#------------------------------------------------------------------------------
+# direncrypt - Sync contents between encrypted and decrypted directories
+# Copyright (C) 2015-2019  Domagoj Marsic
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Contact:
+# https://github.com/dmarsic
+# <dmars+github@protonmail.com>
+#------------------------------------------------------------------------------
+
+import hashlib
+import zlib
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+
+# Boundaries are only looked for after this byte, so the window hash is
+# computed at one in 256 positions, and the search runs in C.
+ANCHOR = 0x5a
+WINDOW = 48
+
+
+def chunk_limits(avg_size=DEFAULT_CHUNK_SIZE):
+    """Return minimum and maximum chunk size and the boundary mask.
+
+    The mask has as many bits set as needed for a boundary to occur
+    on average every avg_size bytes after the minimum size, rounded
+    down to a power of two.
+    """
+    bits = max(avg_size.bit_length() - 9, 0)
+    return avg_size // 4, avg_size * 4, (1 << bits) - 1
+
+
+def find_boundary(data, start, min_size, max_size, mask):
+    """Return the length of the chunk starting at start in data.
+
+    A position after an anchor byte is a boundary if the CRC-32 of
+    the WINDOW bytes before it has no bits of mask set. The hash
+    depends only on those bytes, so boundaries move with the content
+    when bytes are inserted or removed before them, and chunks after
+    an edit are the same as before.
+    """
+    end = min(len(data), start + max_size)
+    if end <= start + min_size:
+        return end - start
+    i = data.find(ANCHOR, start + max(min_size, WINDOW), end)
+    while i != -1:
+        if not zlib.crc32(data[i - WINDOW:i + 1]) & mask:
+            return i + 1 - start
+        i = data.find(ANCHOR, i + 1, end)
+    return end - start
+
+
+def split_chunks(stream, avg_size=DEFAULT_CHUNK_SIZE):
+    """Split content read from a binary stream into chunks.
+
+    Yields chunks of bytes, of about avg_size bytes each. No more
+    than the maximum chunk size is kept in memory.
+    """
+    min_size, max_size, mask = chunk_limits(avg_size)
+    buffer = bytearray()
+    eof = False
+    while True:
+        while not eof and len(buffer) < max_size:
+            data = stream.read(max_size - len(buffer))
+            if not data:
+                eof = True
+            buffer += data
+        if not buffer:
+            return
+        length = find_boundary(buffer, 0, min_size, max_size, mask)
+        yield bytes(buffer[:length])
+        del buffer[:length]
+
+
+def chunk_digest(chunk):
+    """Return the SHA-256 hex digest identifying a chunk."""
+    return hashlib.sha256(chunk).hexdigest()
@@ -0,0 +1,102 @@
+#------------------------------------------------------------------------------
+# direncrypt - Sync contents between encrypted and decrypted directories
+# Copyright (C) 2015-2019  Domagoj Marsic
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Contact:
+# https://github.com/dmarsic
+# <dmars+github@protonmail.com>
+#------------------------------------------------------------------------------
+
+import os
+import math
+from collections import Counter
+
+DEFAULT_SKIP = ('.7z .avi .bz2 .docx .flac .gif .gpg .gz .heic .jpeg .jpg '
+                '.m4a .mkv .mov .mp3 .mp4 .ogg .png .rar .tgz .webm .webp '
+                '.xlsx .xz .zip .zst')
+
+
+class CompressionPolicy(object):
+    """Chooses gpg compression options for each encrypted file.
+
+    Compression is turned off for files whose extension is in skip,
+    and, if probe is set, for files whose first PROBE_SIZE bytes look
+    random, which is the case for compressed and encrypted data.
+    Compressing such files costs CPU time without saving any space.
+
+    Other files are compressed with the given algorithm ('zip', 'zlib'
+    or 'bzip2') and level (1 to 9), or with gpg defaults if they are
+    not set.
+    """
+
+    PROBE_SIZE = 4096
+    # bits per byte, 8 being random data
+    ENTROPY_THRESHOLD = 7.5
+
+    def __init__(self, algorithm=None, level=None, skip=(), probe=False):
+        """Set compression options and extensions of files not to compress."""
+        self.algorithm = algorithm or None
+        self.level = level or None
+        self.skip = set(extension.lower() for extension in skip)
+        self.probe = probe
+
+    @classmethod
+    def from_parameters(cls, parameters):
+        """Build a policy from the compress_* parameters.
+
+        An unset compress_skip uses DEFAULT_SKIP, and an empty one
+        compresses files of every extension.
+        """
+        skip = parameters.get('compress_skip')
+        if skip is None:
+            skip = DEFAULT_SKIP
+        return cls(algorithm=parameters.get('compress_algo'),
+                   level=parameters.get('compress_level'),
+                   skip=skip.split(),
+                   probe=parameters.get('compress_probe') == '1')
+
+    def gpg_args(self, name=None, stream=None):
+        """Return gpg options for a file.
+
+        name is used for the extension, and the beginning of stream
+        for the probe. The stream is left at the position it was.
+        """
+        if self.algorithm == 'none' or self.is_incompressible(name, stream):
+            return ['--compress-algo', 'none']
+        args = []
+        if self.algorithm:
+            args += ['--compress-algo', self.algorithm]
+        if self.level:
+            args += ['--compress-level', str(self.level)]
+        return args
+
+    def is_incompressible(self, name, stream):
+        """Check the extension of name and, if enabled, probe the stream."""
+        if name and os.path.splitext(name)[1].lower() in self.skip:
+            return True
+        if self.probe and stream is not None:
+            position = stream.tell()
+            head = stream.read(self.PROBE_SIZE)
+            stream.seek(position)
+            return len(head) == self.PROBE_SIZE and self.entropy(head) > self.ENTROPY_THRESHOLD
+        return False
+
+    @staticmethod
+    def entropy(data):
+        """Return the Shannon entropy of data in bits per byte."""
+        total = len(data)
+        return -sum(count / total * math.log2(count / total)
+                    for count in Counter(data).values())
@@ -98,6 +98,145 @@ class CmdConfig(cmd.Cmd):
         Ex: /usr/bin/gpg2"""
         self.update('gpg_binary', filename)
 
+    def do_content_digest(self, flag):
+        """content_digest [0|1]
+
+        Store whether content digests are used to skip encryption of
+        files whose content did not change.
+        Ex: 1"""
+        self.update('content_digest', flag)
+
+    def do_dirstate(self, flag):
+        """dirstate [0|1]
+
+        Store whether directory listings are cached in the inventory,
+        so unchanged directories are not listed on every run.
+        Ex: 1"""
+        self.update('dirstate', flag)
+
+    def do_snapshot(self, flag):
+        """snapshot [0|1]
+
+        Store whether a snapshot of the scan is kept next to the
+        inventory, so only changed paths are looked up in the register.
+        Ex: 1"""
+        self.update('snapshot', flag)
+
+    def do_pack_threshold(self, size):
+        """pack_threshold [bytes]
+
+        Store the size below which files are stored together in packs
+        instead of one encrypted file each. 0 disables packing.
+        Ex: 65536"""
+        self.update('pack_threshold', size)
+
+    def do_pack_size(self, size):
+        """pack_size [bytes]
+
+        Store the size of the plaintext of a pack, after which a new
+        pack is started.
+        Ex: 4194304"""
+        self.update('pack_size', size)
+
+    def do_chunk_threshold(self, size):
+        """chunk_threshold [bytes]
+
+        Store the size from which files are split into chunks, so only
+        changed chunks are encrypted again. 0 disables chunking.
+        Ex: 67108864"""
+        self.update('chunk_threshold', size)
+
+    def do_chunk_size(self, size):
+        """chunk_size [bytes]
+
+        Store the average size of a chunk.
+        Ex: 1048576"""
+        self.update('chunk_size', size)
+
+    def do_compress_algo(self, algorithm):
+        """compress_algo [zip|zlib|bzip2|none]
+
+        Store the gpg compression algorithm. Leave empty for the gpg
+        default, or use 'none' to turn compression off.
+        Ex: zlib"""
+        self.update('compress_algo', algorithm)
+
+    def do_compress_level(self, level):
+        """compress_level [1-9]
+
+        Store the gpg compression level. Leave empty for the gpg default.
+        Ex: 6"""
+        self.update('compress_level', level)
+
+    def do_compress_skip(self, extensions):
+        """compress_skip [extension ...]
+
+        Store extensions, separated by spaces, of files that are
+        encrypted without compression, as they are already compressed.
+        Ex: .jpg .mp4 .zip"""
+        self.update('compress_skip', extensions)
+
+    def do_compress_probe(self, flag):
+        """compress_probe [0|1]
+
+        Store whether files whose first block looks random are encrypted
+        without compression.
+        Ex: 1"""
+        self.update('compress_probe', flag)
+
+    def do_session_keys(self, flag):
+        """session_keys [0|1]
+
+        Store whether files are encrypted with a random session key,
+        which is itself encrypted to the public id.
+        Ex: 1"""
+        self.update('session_keys', flag)
+
+    def do_session_key_lifetime(self, seconds):
+        """session_key_lifetime [seconds]
+
+        Store the number of seconds after which a new session key is made.
+        Ex: 86400"""
+        self.update('session_key_lifetime', seconds)
+
+    def do_backend(self, name):
+        """backend [gpg|aead]
+
+        Store the encryption backend of regular files. aead encrypts in
+        process with a session key and needs the cryptography package.
+        Ex: aead"""
+        self.update('backend', name)
+
+    def do_sqlite_synchronous(self, mode):
+        """sqlite_synchronous [OFF|NORMAL|FULL|EXTRA]
+
+        Store the SQLite synchronous mode of the inventory database.
+        NORMAL does not sync every commit to disk, FULL does.
+        Ex: NORMAL"""
+        self.update('sqlite_synchronous', mode)
+
+    def do_sqlite_cache_size(self, size):
+        """sqlite_cache_size [pages, or -KiB if negative]
+
+        Store the SQLite page cache size of the inventory database.
+        Ex: -65536"""
+        if size:
+            try:
+                int(size)
+            except ValueError:
+                print('sqlite_cache_size must be an integer, not: %s' % size)
+                return
+        self.update('sqlite_cache_size', size)
+
+    def do_exclude(self, patterns):
+        """exclude [pattern ...]
+
+        Store gitignore-style patterns, separated by spaces, of paths
+        that are not encrypted. A pattern starting with '!' includes
+        paths excluded by earlier patterns again.
+        Ex: node_modules/ .git/ *.tmp !keep.tmp"""
+        self.update('exclude', patterns)
+
     def update(self, key, value):
         """Generic function to update a single parameter."""
         print('Setting %s to: %s' % (key, value))
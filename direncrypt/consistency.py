@@ -21,26 +21,35 @@
 #------------------------------------------------------------------------------
 
 import os
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
 from direncrypt.inventory import Inventory
 from direncrypt.direncryption import DirEncryption
 from direncrypt.fileops import FileOps
+from direncrypt.rules import PathRules
 
 
 class ConsistencyCheck(object):
     """Consistency checks between unencrypted and encrypted directories.
 
     Checks are performed based on the file register, which is kept in
-    inventory.sqlite database.
+    inventory.sqlite database. The register is streamed and checked in
+    batches of BATCH_SIZE records, so memory use does not grow with it.
     """
 
-    def __init__(self, database):
+    BATCH_SIZE = 1000
+
+    def __init__(self, database, scan_workers=1):
         """Load program parameters.
 
-        Program parameters are needed for file locations.
+        Program parameters are needed for file locations. scan_workers
+        is the number of threads used for existence checks.
         """
         self.database = database
+        self.scan_workers = scan_workers or 1
         with Inventory(self.database) as inventory:
             self.parameters = inventory.read_parameters()
+        self.rules = PathRules.parse(self.parameters.get('exclude'))
 
     def set_passphrase(self, passphrase):
         """Set passphrase to be used for decrypting."""
@@ -50,29 +59,55 @@ class ConsistencyCheck(object):
         """Check file existence based on the register file set.
 
         Both unencrypted and encrypted files are checked in their
-        respective plain and encrypted directories. A flag is set
-        based on the check and fileset dict is updated.
+        respective plain and encrypted directories. Yields a tuple of
+        the record and existence of its unencrypted and encrypted file
+        for each registered file, while the register is being read.
 
         This method does not report or do anything else, so another
         method may be required to show the result of the check.
+        Files excluded by the exclude rules are not checked. With more
+        than one scan worker, the checks are done in a thread pool.
         """
-        # Load registered file list.
-        with Inventory(self.database) as inventory:
-            self.registered_files = inventory.read_register("files")
-
-        for filename in self.registered_files:
-
-            unenc_full_path = os.path.expanduser(os.path.join(
-                    self.parameters['plaindir'],
-                    self.registered_files[filename]['unencrypted_file']))
-            self.registered_files[filename]['unencrypted_file_check'] = \
-                    os.path.exists(unenc_full_path)
-
-            enc_full_path = os.path.expanduser(os.path.join(
-                    self.parameters['securedir'],
-                    self.registered_files[filename]['encrypted_file']))
-            self.registered_files[filename]['encrypted_file_check'] = \
-                    os.path.exists(enc_full_path)
+        pool = None
+        if self.scan_workers > 1:
+            pool = ThreadPoolExecutor(max_workers=self.scan_workers)
+        try:
+            with Inventory(self.database) as inventory:
+                records = (record for record in inventory.iter_register("files")
+                           if not self.rules.is_excluded(record['unencrypted_file']))
+                while True:
+                    batch = list(islice(records, self.BATCH_SIZE))
+                    if not batch:
+                        break
+                    manifests = [inventory.read_manifest(record['encrypted_file'])
+                                 if record.get('chunked') else None
+                                 for record in batch]
+                    if pool:
+                        checks = pool.map(self.check_record, batch, manifests)
+                    else:
+                        checks = map(self.check_record, batch, manifests)
+                    for record, (unenc_check, enc_check) in zip(batch, checks):
+                        yield record, unenc_check, enc_check
+        finally:
+            if pool:
+                pool.shutdown()
+
+    def check_record(self, record, chunk_ids=None):
+        """Return existence of the unencrypted and encrypted file of a record.
+
+        chunk_ids is the chunk list of a chunked file.
+        """
+        unenc_full_path = os.path.expanduser(os.path.join(
+                self.parameters['plaindir'], record['unencrypted_file']))
+        if record.get('chunked'):
+            # a chunked file exists if all its chunks exist
+            return os.path.exists(unenc_full_path), all(
+                os.path.exists(os.path.expanduser(os.path.join(
+                    self.parameters['securedir'], chunk_id)))
+                for chunk_id in chunk_ids)
+        enc_full_path = os.path.expanduser(os.path.join(
+                self.parameters['securedir'], record['encrypted_file']))
+        return os.path.exists(unenc_full_path), os.path.exists(enc_full_path)
 
     def clean_registry(self, filename):
         """Clean entry from registry."""
@@ -83,26 +118,28 @@ class ConsistencyCheck(object):
     def loop_through(self, clean=False, resync=False):
         """Go through all entries and take action based on user input.
 
-        This method can be called after check() has been executed,
-        otherwise it cannot properly report on the existence of
-        files.
+        Entries are checked with check() and reported as they are
+        read from the register. Resynced files are restored by a single
+        DirEncryption, so each session key is decrypted only once.
         """
         count_nok = 0
-        total_files = len(self.registered_files)
+        total_files = 0
+        de = None
 
         print('Plaindir: {}'.format(self.parameters['plaindir']))
         print('Securedir: {}'.format(self.parameters['securedir']))
         print('\nSTATUS PLAINFILE{}ENCFILE'.format(' '*27))
 
-        for filename, entry in self.registered_files.items():
+        for entry, unenc_check, enc_check in self.check():
 
+            total_files += 1
             unenc_exists = 'u'
             enc_exists = 'e'
             status = 'ok'
 
-            if not entry['unencrypted_file_check']:
+            if not unenc_check:
                 unenc_exists = ''
-            if not entry['encrypted_file_check']:
+            if not enc_check:
                 enc_exists = ''
 
             if clean and (not unenc_exists or not enc_exists):
@@ -111,18 +148,22 @@ class ConsistencyCheck(object):
                     FileOps.delete_file(self.parameters['plaindir'],
                                      entry['unencrypted_file'])
 
-                if enc_exists:
+                if enc_exists and entry.get('pack') is None and not entry.get('chunked'):
+                    # packs and chunks are shared with other files
                     print("delete enc")
                     FileOps.delete_file(self.parameters['securedir'],
                                      entry['encrypted_file'])
+                if entry.get('chunked'):
+                    # its chunks are deleted by the next encryption run
+                    with Inventory(self.database) as inventory:
+                        inventory.clean_manifest(entry['encrypted_file'])
 
                 self.clean_registry(entry['unencrypted_file'])
                 total_files -= 1
             elif not unenc_exists and resync:
-                de = DirEncryption(None, self.database)
-                de.decrypt(entry['encrypted_file'],
-                           entry['unencrypted_file'],
-                           self.passphrase)
+                if de is None:
+                    de = DirEncryption(None, self.database)
+                de.restore_record(entry, self.passphrase)
                 unenc_exists = 'u'
             elif not unenc_exists or not enc_exists:
                 status = 'NOK'
@@ -130,8 +171,7 @@ class ConsistencyCheck(object):
 
 
             print('%-3s %1s%1s %-35s %-30s' % (status, unenc_exists, enc_exists,
-                    self.registered_files[filename]['unencrypted_file'],
-                    self.registered_files[filename]['encrypted_file']))
+                    entry['unencrypted_file'], entry['encrypted_file']))
 
         print('\nTotal files in the register: {}'.format(total_files))
         print('Check: {} ok, {} not ok'.format(total_files - count_nok, count_nok))
@@ -156,10 +196,10 @@ class ConsistencyCheck(object):
         "Display number of records."
 
         with Inventory(self.database) as inv:
-            total_records = len(inv.read_register("all"))
-            reg_files = len(inv.read_register("files"))
-            reg_links = len(inv.read_register("links"))
-            reg_dirs = len(inv.read_register("dirs"))
+            total_records = inv.count_register()
+            reg_files = sum(1 for record in inv.iter_register("files"))
+            reg_links = sum(1 for record in inv.iter_register("links"))
+            reg_dirs = sum(1 for record in inv.iter_register("dirs"))
 
             print("- Registered regular files :     {}".format(reg_files))
             print("- Registered symlinks :          {}".format(reg_links))
@@ -21,25 +21,52 @@
 #------------------------------------------------------------------------------
 
 import os
+import re
 import glob
 import sqlite3
-from typing import List
+from typing import List, Tuple
 from direncrypt import ROOTDIR
 
 
 class DatabaseBuilder(object):
-    """Builds/rebuilds inventory database.
+    """Builds/rebuilds and migrates inventory database.
 
     Inventory database needs to exist before the first execution
     of direncrypt. This class removes the need for building it
     manually.
 
+    SQL files in the sql directory are named with a number, starting
+    at 1 and increasing by one with each new file, e.g. 0004_name.sql.
+    They are applied in that order, and the number of the last applied
+    file is the schema version of the database, stored in its SQLite
+    user_version. An existing database is migrated by applying only
+    the files numbered above its version.
+
     Once built, there is generally no reason to rebuild it.
     REBUILDING WILL DELETE THE PREVIOUS DATABASE, WHICH MAY CAUSE YOU
     GREAT PAIN ON DECRYPTING. Keep your backup safe.
     """
 
     SQL_FILES_PATH = os.path.join(ROOTDIR, 'sql', '*')
+    # Databases built before the schema version was recorded have
+    # the three SQL files of the first releases applied, and those
+    # built by later versions have every file that existed then.
+    # Each query succeeds and returns a row only if the file with the
+    # following number, starting at LEGACY_VERSION + 1, was applied.
+    LEGACY_VERSION = 3
+    LEGACY_PROBES = [
+        "SELECT COUNT(size) FROM register",
+        "SELECT COUNT(digest) FROM register",
+        "SELECT COUNT(*) FROM dirstate",
+        "SELECT value FROM parameters WHERE key = 'exclude'",
+        "SELECT value FROM parameters WHERE key = 'snapshot'",
+        "SELECT COUNT(pack_offset) FROM register",
+        "SELECT COUNT(*) FROM chunks",
+        "SELECT value FROM parameters WHERE key = 'compress_probe'",
+        "SELECT COUNT(*) FROM session_keys",
+        "SELECT COUNT(backend) FROM register",
+        "SELECT value FROM parameters WHERE key = 'sqlite_synchronous'"
+    ]
 
     def __init__(self, path: str) -> None:
         """Constructor.
@@ -55,7 +82,8 @@ class DatabaseBuilder(object):
     def build(self, force: bool = False) -> None:
         """Creates inventory database.
 
-        If it exists, it won't recreate it, unless `force` is set.
+        If it exists, it won't recreate it, unless `force` is set, but
+        it is migrated to the current schema version.
         SETTING `force` WILL DELETE YOUR EXISTING DATABASE.
 
         :param force: Set if the database should be recreated. It deletes
@@ -63,14 +91,92 @@ class DatabaseBuilder(object):
         """
         print(f'Inventory database file: {self.database_path}')
         if self.exists() and not force:
+            self.migrate()
             return
         if self.exists() and force:
             os.unlink(self.database_path)
             print('Removed previous database.')
-        conn = sqlite3.connect(self.database_path)
-        for sql_file in sorted(glob.glob(self.SQL_FILES_PATH)):
-            with open(sql_file, 'r') as f:
-                conn.executescript(f.read())
-        conn.commit()
-        conn.close()
+        self.migrate()
         print('Database created.')
+
+    def sql_files(self) -> List[Tuple[int, str]]:
+        """Returns numbers and paths of SQL files in the order they are applied.
+
+        :raises ValueError: If the files are not numbered 1, 2, 3, ...
+        """
+        files = []
+        for sql_file in glob.glob(self.SQL_FILES_PATH):
+            match = re.match(r'(\d+)', os.path.basename(sql_file))
+            if match is None:
+                raise ValueError(f'SQL file is not numbered: {sql_file}')
+            files.append((int(match.group(1)), sql_file))
+        files.sort()
+        numbers = [number for number, sql_file in files]
+        if numbers != list(range(1, len(files) + 1)):
+            raise ValueError(f'SQL files are not numbered 1 to {len(files)}: {numbers}')
+        return files
+
+    def schema_version(self, conn: sqlite3.Connection) -> int:
+        """Returns the number of the last SQL file applied to the database."""
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        if version == 0 and conn.execute(
+                "SELECT name FROM sqlite_master WHERE type='table' AND name='register'"
+                ).fetchone():
+            version = self.LEGACY_VERSION
+            for probe in self.LEGACY_PROBES:
+                try:
+                    if conn.execute(probe).fetchone() is None:
+                        break
+                except sqlite3.OperationalError:
+                    break
+                version += 1
+        return version
+
+    def migrate(self) -> int:
+        """Applies SQL files that have not been applied to the database yet.
+
+        Every file is applied in its own transaction, together with the
+        update of the schema version, so a failing file leaves the
+        database at the version before it. An existing database is
+        backed up before the first file is applied, see `backup`.
+
+        :return: Number of applied SQL files.
+        """
+        conn = sqlite3.connect(self.database_path)
+        try:
+            version = self.schema_version(conn)
+            pending = [(number, sql_file) for number, sql_file in self.sql_files()
+                       if number > version]
+            if pending and version > 0:
+                self.backup(conn, version)
+            for number, sql_file in pending:
+                with open(sql_file, 'r') as f:
+                    script = f.read()
+                try:
+                    conn.executescript('BEGIN;\n{}\n;PRAGMA user_version = {};\nCOMMIT;'.format(
+                        script, number))
+                except sqlite3.Error:
+                    if conn.in_transaction:
+                        conn.rollback()
+                    raise
+                if version > 0:
+                    print(f'Applied {os.path.basename(sql_file)}')
+            return len(pending)
+        finally:
+            conn.close()
+
+    def backup(self, conn: sqlite3.Connection, version: int) -> str:
+        """Copies the database to `<path>.v<version>.bak`.
+
+        :param conn: Connection to the database.
+        :param version: Schema version of the database.
+        :return: Path to the backup.
+        """
+        backup_path = f'{self.database_path}.v{version}.bak'
+        dest = sqlite3.connect(backup_path)
+        try:
+            conn.backup(dest)
+        finally:
+            dest.close()
+        print(f'Inventory database backed up to: {backup_path}')
+        return backup_path
@@ -22,11 +22,27 @@
 
 import os
 import sys
+import stat
+import time
+import io
 import uuid
+import asyncio
+import hashlib
+import secrets
 import logging
+from itertools import groupby
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
+from direncrypt.backends import AEADBackend, BackendResult
 from direncrypt.gpgops import GPGOps
 from direncrypt.inventory import Inventory
 from direncrypt.fileops import FileOps
+from direncrypt.compression import CompressionPolicy
+from direncrypt.chunks import DEFAULT_CHUNK_SIZE, chunk_digest, split_chunks
+from direncrypt.packs import DEFAULT_PACK_SIZE, extract_member, group_members, read_members
+from direncrypt.scanner import ScanResult, TreeScanner, fingerprint
+from direncrypt.snapshot import ScanSnapshot
+from direncrypt.watcher import InotifyWatcher
+from direncrypt.rules import PathRules
 
 
 class DirEncryption(object):
@@ -37,8 +53,9 @@ class DirEncryption(object):
 
     DirEncryption uses a SQLite database as a register of known files.
     Files from the source (unencrypted) directory will be encrypted
-    into the destination directory if the modified time of a file
-    is newer than the time of the last run.
+    into the destination directory if their stat fingerprint (size,
+    modified time, inode and change time) differs from the one stored
+    in the register.
     """
 
     def __init__(self, args, database=None):
@@ -51,7 +68,18 @@ class DirEncryption(object):
         self.set_parameters(args)
         self.gpg = GPGOps(gpg_binary=self.gpg_binary,
                           gpg_recipient=self.public_id,
-                          gpg_keyring=self.gpg_keyring)
+                          gpg_keyring=self.gpg_keyring,
+                          max_processes=self.jobs,
+                          compression=self.compression)
+        self.backends = {'gpg': self.gpg}
+        if AEADBackend.available() or self.backend_name == AEADBackend.name:
+            # fails if aead is configured but cannot be used
+            self.backends[AEADBackend.name] = AEADBackend()
+        self.backend = self.backends.get(self.backend_name)
+        if self.backend is None:
+            print('Backend {} is not available, encrypting with gpg'.format(
+                self.backend_name))
+            self.backend = self.gpg
 
     def set_parameters(self, args):
         """Set parameters based on database config and passed args."""
@@ -74,6 +102,25 @@ class DirEncryption(object):
         self.gpg_keyring = parameters['gpg_keyring']
         self.gpg_homedir = os.path.expanduser(parameters['gpg_homedir'])
         self.gpg_binary  = os.path.expanduser(parameters['gpg_binary'])
+        self.content_digest = parameters.get('content_digest') == '1'
+        self.use_dirstate = parameters.get('dirstate') == '1'
+        self.use_snapshot = parameters.get('snapshot') == '1'
+        self.snapshot_file = self.database + '.snapshot'
+        self.rules = PathRules.parse(parameters.get('exclude'))
+        self.compression = CompressionPolicy.from_parameters(parameters)
+        self.pack_threshold = int(parameters.get('pack_threshold') or 0)
+        self.pack_size = int(parameters.get('pack_size') or DEFAULT_PACK_SIZE)
+        self.chunk_threshold = int(parameters.get('chunk_threshold') or 0)
+        self.chunk_size = int(parameters.get('chunk_size') or DEFAULT_CHUNK_SIZE)
+        self.use_session_keys = parameters.get('session_keys') == '1'
+        self.session_key_lifetime = float(parameters.get('session_key_lifetime') or 86400)
+        self.session_key = None
+        self.session_key_created = None
+        self.unwrapped_keys = {}
+        self.backend_name = parameters.get('backend') or 'gpg'
+        self.scan_workers = 1
+        self.jobs = 1
+        self.gpg_engine = 'threads'
 
         if args is None:
             return
@@ -92,128 +139,793 @@ class DirEncryption(object):
             self.gpg_homedir = os.path.expanduser(args.gpg_homedir)
         if args.gpg_binary:
             self.gpg_binary  = os.path.expanduser(args.gpg_binary)
+        if args.scan_workers:
+            self.scan_workers = args.scan_workers
+        if args.jobs:
+            self.jobs = args.jobs
+        if args.gpg_engine:
+            self.gpg_engine = args.gpg_engine
 
     def encrypt_all(self):
         """Encrypt all new files from unencrypted directory.
 
-        New files are those that have modified timestamp newer than
-        the timestamp of the last run. At the start of run, the timestamp
-        is updated.
+        New files are those that are not registered yet, or whose
+        stat fingerprint differs from the registered one.
 
-        The files are recursively searched for in the source directory.
+        If the scan snapshot is enabled, the scan is compared with the
+        snapshot of the previous run, and only register records of
+        changed and removed paths are read.
+
+        The source directory is walked only once, and the result of
+        the walk is shared by files, empty directories and symlinks.
         """
         register = {}
         print("Encrypting all directory '{}', please wait...".format(self.plaindir))
         with Inventory(self.database) as inv:
-            register = inv.read_register("all")
+            scan = self.scan_plaindir(inv)
+            changes = scan
+            snapshot = self.load_snapshot(inv)
+            if snapshot is None:
+                register = inv.read_register("all")
+            else:
+                with snapshot:
+                    changed, removed = snapshot.diff(scan)
+                if self.verbose:
+                    print('Snapshot: {} changed, {} removed'.format(
+                        len(changed), len(removed)))
+                register = inv.read_register_paths(changed + removed,
+                                                   recursive=False)
+                changes = scan.subset(changed)
 
             # treat regular files first
-            self.encrypt_regular_files(register, inv)
+            failed = self.encrypt_regular_files(register, inv, changes)
             # then treat empty directories
-            self.register_empty_dirs(register, inv)
+            self.register_empty_dirs(register, inv, changes)
             # finally treat symlinks
-            self.register_symlinks(register, inv)
+            self.register_symlinks(register, inv, changes)
+            self.store_missing_fingerprints(register, changes, inv)
 
-            self.do_inv_maintenance(inv)
+            self.do_inv_maintenance(inv, register, scan)
+            if self.use_snapshot:
+                ScanSnapshot.write(self.snapshot_file, scan, self.plaindir,
+                                   inv.count_register(), skip=failed)
             print("Done !")
 
-    def encrypt_regular_files(self, register, inventory):
-        """Encrypt all regular files."""
-        files = self.find_unencrypted_files(register)
+    def load_snapshot(self, inventory):
+        """Return the snapshot of the previous run, if it can be used.
+
+        The snapshot is not used if it is disabled or missing, if it
+        was taken of another directory, or if the number of register
+        records changed since it was written, e.g. by check.py.
+        """
+        if not self.use_snapshot:
+            return None
+        snapshot = ScanSnapshot.load(self.snapshot_file)
+        if snapshot is None:
+            return None
+        if (snapshot.plaindir != self.plaindir or
+                snapshot.register_count != inventory.count_register()):
+            snapshot.close()
+            return None
+        return snapshot
+
+    def sync_paths(self, paths):
+        """Encrypt, register or unregister only the given relative paths.
+
+        Directories are handled with everything below them. Parent
+        directories of the paths are checked as well, as they may have
+        become empty or non-empty. The rest of the register and of the
+        unencrypted directory is not looked at.
+        """
+        paths = set(path for path in paths
+                    if path and not self.rules.is_excluded(path))
+        parents = set(os.path.dirname(path) for path in paths) - paths - {''}
+        with Inventory(self.database) as inv:
+            register = inv.read_register_paths(paths)
+            register.update(inv.read_register_paths(parents, recursive=False))
+            scan = self.scan_paths(paths, parents)
+
+            self.encrypt_regular_files(register, inv, scan)
+            self.register_empty_dirs(register, inv, scan)
+            self.register_symlinks(register, inv, scan)
+            self.remove_missing(register, scan, inv)
+
+    def encrypt_list(self, stream, null_separated=False):
+        """Encrypt, register or unregister the paths listed in a stream.
+
+        stream is a binary file object with one path per line, or with
+        paths separated by NUL characters if null_separated is set.
+        Paths are relative to the unencrypted directory; absolute paths
+        inside it are accepted too. The directory tree is not walked
+        and the register is not cleaned beyond the listed paths.
+        """
+        separator = b'\0' if null_separated else b'\n'
+        paths = set()
+        for entry in stream.read().split(separator):
+            if not null_separated:
+                entry = entry.rstrip(b'\r')
+            if not entry:
+                continue
+            relative_path = self.relative_path(os.fsdecode(entry))
+            if relative_path is None:
+                print('Skipping path outside of {}: {}'.format(
+                    self.plaindir, os.fsdecode(entry)))
+                continue
+            paths.add(relative_path)
+        print("Encrypting {} listed paths in '{}'...".format(len(paths), self.plaindir))
+        self.sync_paths(paths)
+        print("Done !")
+
+    def relative_path(self, path):
+        """Return path relative to the unencrypted directory.
+
+        Returns None if the path is not below the unencrypted directory.
+        """
+        if os.path.isabs(path):
+            path = os.path.relpath(path, self.plaindir)
+        path = os.path.normpath(path)
+        if path in (os.curdir, os.pardir) or path.startswith(os.pardir + os.sep):
+            return None
+        return path
+
+    def scan_paths(self, paths, parents=()):
+        """Stat the given relative paths, walking those that are directories.
+
+        parents are only checked for being empty directories.
+        Returns a ScanResult, in the same format as scan_plaindir().
+        """
+        scan = ScanResult()
+        for relative_path in paths:
+            path = os.path.join(self.plaindir, relative_path)
+            try:
+                statinfo = os.lstat(path)
+            except FileNotFoundError:
+                continue
+            except OSError as ose:
+                print('Failed to stat {} : {}'.format(relative_path, str(ose)))
+                scan.failed.add(relative_path)
+                continue
+            if stat.S_ISLNK(statinfo.st_mode):
+                scan.links[relative_path] = statinfo
+            elif stat.S_ISREG(statinfo.st_mode):
+                scan.files[relative_path] = statinfo
+            elif stat.S_ISDIR(statinfo.st_mode):
+                if self.rules.is_excluded(relative_path, is_dir=True):
+                    continue
+                subtree = TreeScanner(self.plaindir, rules=self.rules,
+                                      workers=self.scan_workers).scan(relative_path)
+                scan.files.update(subtree.files)
+                scan.links.update(subtree.links)
+                scan.dirs.update(subtree.dirs)
+                scan.failed.update(subtree.failed)
+
+        for relative_path in parents:
+            path = os.path.join(self.plaindir, relative_path)
+            try:
+                statinfo = os.lstat(path)
+                if not stat.S_ISDIR(statinfo.st_mode):
+                    continue
+                scanner = TreeScanner(self.plaindir, rules=self.rules)
+                children = scanner.read_directory(path)
+            except FileNotFoundError:
+                continue
+            except OSError:
+                scan.failed.add(relative_path)
+                continue
+            if scanner.is_empty(relative_path, children):
+                scan.dirs[relative_path] = statinfo
+        return scan
+
+    def watch(self, debounce=2.0, reconcile_interval=3600.0):
+        """Encrypt changes as they happen, using inotify.
+
+        Changed paths are collected until no event has arrived for
+        debounce seconds (or for at most ten times that long while
+        events keep arriving), and then passed to sync_paths().
+
+        A full encrypt_all() is run at start, every reconcile_interval
+        seconds, and whenever the inotify queue overflows, so lost
+        events are eventually recovered.
+        """
+        print("Watching directory '{}', press Ctrl-C to stop...".format(self.plaindir))
+        with InotifyWatcher(self.plaindir, self.rules) as watcher:
+            self.encrypt_all()
+            last_reconcile = time.monotonic()
+            pending = set()
+            first_event = None
+            while True:
+                paths = watcher.read_events(debounce)
+                if paths is None:
+                    print('Event queue overflowed, reconciling...')
+                    pending = set()
+                    self.encrypt_all()
+                    last_reconcile = time.monotonic()
+                    continue
+                if paths:
+                    if not pending:
+                        first_event = time.monotonic()
+                    pending |= paths
+                    if time.monotonic() - first_event < 10 * debounce:
+                        continue
+                if pending:
+                    if self.verbose:
+                        print('Changed paths: {}'.format(', '.join(sorted(pending))))
+                    self.sync_paths(pending)
+                    pending = set()
+                if time.monotonic() - last_reconcile >= reconcile_interval:
+                    self.encrypt_all()
+                    last_reconcile = time.monotonic()
+
+    def encrypt_regular_files(self, register, inventory, scan=None):
+        """Encrypt all regular files.
+
+        If content digests are enabled, a changed file whose digest
+        is the same as the registered one is not encrypted again,
+        only its fingerprint is updated. Digests are computed by the
+        jobs that encrypt the files, see encrypt_changed_file(), and
+        while chunked files are split.
+
+        With more than one job, files are encrypted in a thread pool,
+        and the register is written only from the calling thread. The
+        old encrypted files of changed files are deleted only after the
+        new ones have been written and the register is committed.
+
+        If packing is enabled, files smaller than pack_threshold bytes
+        are stored together in packs, see encrypt_packs(). If chunking
+        is enabled, files of chunk_threshold bytes or more are stored
+        in chunks, see encrypt_chunked(). Other files are encrypted by
+        the configured backend, with the session key if session keys are
+        enabled or the backend needs one. Packs and chunks are encrypted
+        by gpg, with the same session key if there is one.
+
+        Returns a set of files that failed to encrypt.
+        """
+        failed = set()
+        files = self.find_unencrypted_files(register, scan)
+        jobs = []
+        packed = {}
+        chunked = []
+        old_versions = {}
         for plainfile, val in files.items():
+            val['digest'] = None
+            val['old_digest'] = None
             if not val['is_new']:
-                # remove old file in secure directory
-                encfile = inventory.read_line_from_register(plainfile)
-                FileOps.delete_file(self.securedir, encfile)
-            encryptedfile = self.generate_name()
-            encrypted_ok = self.encrypt(plainfile, encryptedfile, inventory)
-            if encrypted_ok and self.verbose:
+                record = register[plainfile]
+                val['old_digest'] = record.get('digest')
+                if record.get('chunked'):
+                    old_versions[plainfile] = (record['encrypted_file'], True)
+                elif record.get('pack') is None:
+                    # a pack is only removed by repack()
+                    old_versions[plainfile] = (record['encrypted_file'], False)
+            if self.pack_threshold and val['fingerprint'][0] < self.pack_threshold:
+                packed[plainfile] = val['fingerprint'][0]
+                continue
+            if self.chunk_threshold and val['fingerprint'][0] >= self.chunk_threshold:
+                chunked.append(plainfile)
+                continue
+            jobs.append((plainfile, self.generate_name()))
+
+        key_id, session_key = None, None
+        if jobs or packed or chunked:
+            key_id, session_key = self.current_session_key(inventory)
+        backend = 'gpg' if session_key is None else self.backend.name
+        jobs = [((plainfile, encryptedfile),
+                 (plainfile, encryptedfile, session_key, backend,
+                  files[plainfile]['old_digest']))
+                for plainfile, encryptedfile in jobs]
+        for (plainfile, encryptedfile), (digest, result) in self.run_jobs(
+                self.encrypt_changed_file, jobs, self.encrypt_changed_file_async):
+            files[plainfile]['digest'] = digest
+            if result is None:
+                self.keep_unchanged(plainfile, files[plainfile], inventory)
+                continue
+            encrypted_ok = self.register_encrypted(
+                plainfile, encryptedfile, inventory, result,
+                fingerprint=files[plainfile]['fingerprint'],
+                digest=digest, key_id=key_id, backend=backend)
+            if not encrypted_ok:
+                failed.add(plainfile)
+                continue
+            if self.verbose:
                 print('Encrypted file: {} ---> {}'.format(plainfile, encryptedfile))
 
-    def register_empty_dirs(self, register, inventory):
+        if packed and self.content_digest:
+            # files are read again for the pack, but only if they changed
+            for plainfile, digest in self.run_jobs(
+                    FileOps.file_digest,
+                    [(plainfile, (self.plaindir, plainfile)) for plainfile in sorted(packed)]):
+                files[plainfile]['digest'] = digest
+                if self.is_unchanged(files[plainfile]):
+                    self.keep_unchanged(plainfile, files[plainfile], inventory)
+                    del packed[plainfile]
+        if packed:
+            failed |= self.encrypt_packs(files, packed, inventory, key_id, session_key)
+        if chunked:
+            failed |= self.encrypt_chunked(files, chunked, inventory, key_id, session_key)
+        replaced = sorted(plainfile for plainfile in old_versions.keys() - failed
+                          if not files[plainfile].get('unchanged'))
+        self.delete_old_versions([old_versions[plainfile] for plainfile in replaced],
+                                 inventory)
+        return failed
+
+    def is_unchanged(self, val):
+        """Check if a changed file has the same content digest as its record."""
+        return val['digest'] is not None and val['digest'] == val['old_digest']
+
+    def keep_unchanged(self, plainfile, val, inventory):
+        """Keep the encrypted file of a file whose content did not change.
+
+        Only the new fingerprint of the file is stored.
+        """
+        val['unchanged'] = True
+        inventory.update_fingerprint(plainfile, val['fingerprint'])
+        if self.verbose:
+            print('Content unchanged: {}'.format(plainfile))
+
+    def current_session_key(self, inventory):
+        """Return the id and value of the session key to encrypt files with.
+
+        A new key is made on first use, and again after
+        session_key_lifetime seconds, so keys are rotated in watch
+        mode. The key is stored in the inventory encrypted to the public
+        id, and is kept unencrypted only in memory.
+
+        Returns (None, None) if session keys are disabled and the
+        backend is gpg, or if the key could not be encrypted, in which
+        case files are encrypted to the public id with gpg.
+        """
+        if not self.use_session_keys and self.backend is self.gpg:
+            return None, None
+        if (self.session_key is None or time.monotonic() - self.session_key_created
+                >= self.session_key_lifetime):
+            session_key = secrets.token_urlsafe(32)
+            result = self.gpg.wrap_key(session_key)
+            if not result.ok:
+                message = result.stderr.replace('\n', '\n\t')
+                print('FAILED encryption of session key:\n\t{}'.format(message))
+                return None, None
+            key_id = self.generate_name()
+            inventory.register_session_key(key_id, self.public_id, str(result))
+            self.session_key = (key_id, session_key)
+            self.session_key_created = time.monotonic()
+        return self.session_key
+
+    def unwrap_session_keys(self, inventory, key_ids, passphrase):
+        """Decrypt the given session keys, once each.
+
+        Returns a dict with key id for keys and session key as value.
+        Keys that cannot be decrypted are reported and left out.
+        """
+        key_ids = sorted(set(key_ids) - {None})
+        keys = {}
+        for key_id, wrapped_key in inventory.read_session_keys(key_ids).items():
+            result = self.gpg.unwrap_key(wrapped_key, passphrase)
+            if result.ok:
+                keys[key_id] = str(result)
+            else:
+                message = result.stderr.replace('\n', '\n\t')
+                print('FAILED decryption of session key: {}\n\t{}'.format(key_id, message))
+        return keys
+
+    def unwrapped_key(self, inventory, key_id, passphrase):
+        """Return the phrase that decrypts content encrypted with key_id.
+
+        This is the passphrase for content encrypted to the public id,
+        and the session key otherwise. Session keys are decrypted once,
+        when first needed, and kept in memory. A key that cannot be
+        decrypted is replaced with the passphrase, so decryption of its
+        files fails and is reported.
+        """
+        if key_id is None:
+            return passphrase
+        if key_id not in self.unwrapped_keys:
+            keys = self.unwrap_session_keys(inventory, [key_id], passphrase)
+            self.unwrapped_keys[key_id] = keys.get(key_id, passphrase)
+        return self.unwrapped_keys[key_id]
+
+    def encrypt_packs(self, files, sizes, inventory, key_id=None, session_key=None):
+        """Encrypt small files into packs of about pack_size bytes.
+
+        Each pack is encrypted with a single gpg call, with session_key
+        if given, and every file in it is registered with the pack as
+        its encrypted file, its offset and length in the pack, and
+        key_id.
+
+        Returns a set of files that failed to encrypt.
+        """
+        failed = set()
+        jobs = []
+        for group in group_members(sizes, self.pack_size):
+            pack_id = self.generate_name()
+            jobs.append((pack_id, (pack_id, group, session_key)))
+
+        for pack_id, (result, placed, missing) in self.run_jobs(self.encrypt_pack, jobs):
+            failed.update(missing)
+            if not result.ok:
+                message = result.stderr.replace('\n', '\n\t')
+                print('FAILED encryption of pack: {}\n\t{}'.format(pack_id, message))
+                failed.update(plainfile for plainfile, _, _ in placed)
+                continue
+            inventory.register_pack(pack_id, sum(length for _, _, length in placed))
+            for plainfile, offset, length in placed:
+                inventory.register(plainfile, pack_id, self.public_id, False, '',
+                                   files[plainfile]['fingerprint'],
+                                   files[plainfile]['digest'],
+                                   pack=(offset, length), key_id=key_id)
+            if self.verbose:
+                print('Encrypted pack: {} files ---> {}'.format(len(placed), pack_id))
+        return failed
+
+    def encrypt_pack(self, pack_id, plainfiles, session_key=None):
+        """Read files into a new pack and encrypt it.
+
+        This is safe to run in a worker thread. Returns the gpg result,
+        a list of (file, offset, length) stored in the pack, and a list
+        of files that could not be read.
+        """
+        stream, placed, missing = read_members(self.plaindir, plainfiles)
+        encrypted_path = os.path.join(self.securedir, pack_id)
+        result = self.gpg.encrypt_stream(stream, encrypted_path, session_key=session_key)
+        return result, placed, missing
+
+    def encrypt_chunked(self, files, plainfiles, inventory, key_id=None, session_key=None):
+        """Encrypt large files as lists of content-defined chunks.
+
+        Files are split with split_chunks(), and every chunk is
+        identified by its digest. Only chunks that are not registered
+        yet are encrypted, each into its own file and with session_key
+        if given, so a file that is changed in a few places gets only a
+        few new chunks. Every chunk is registered with the session key
+        it is encrypted with, and the chunk list of a file is registered
+        once all its chunks are encrypted.
+
+        Files are read on the calling thread, and at most twice as
+        many chunks as there are jobs are held in memory. With content
+        digests enabled, the digest of a file is computed from its
+        chunks, and a file whose content did not change keeps its chunk
+        list.
+
+        Returns a set of files that failed to encrypt.
+        """
+        failed = set()
+        failed_chunks = set()
+        manifests = {}
+        new_chunks = {}
+
+        def chunk_jobs():
+            for plainfile in plainfiles:
+                chunk_ids = manifests[plainfile] = []
+                file_digest = hashlib.sha256() if self.content_digest else None
+                try:
+                    with open(os.path.join(self.plaindir, plainfile), 'rb') as f:
+                        for chunk in split_chunks(f, self.chunk_size):
+                            if file_digest is not None:
+                                file_digest.update(chunk)
+                            digest = chunk_digest(chunk)
+                            chunk_id = new_chunks.get(digest) or inventory.find_chunk(digest)
+                            if chunk_id is None:
+                                chunk_id = new_chunks[digest] = self.generate_name()
+                                yield ((chunk_id, digest, len(chunk)),
+                                       (chunk, chunk_id, session_key))
+                            chunk_ids.append(chunk_id)
+                except OSError as ose:
+                    print('Failed to read {} : {}'.format(plainfile, str(ose)))
+                    failed.add(plainfile)
+                    continue
+                if file_digest is not None:
+                    files[plainfile]['digest'] = file_digest.hexdigest()
+
+        for (chunk_id, digest, length), result in \
+                self.run_jobs(self.encrypt_chunk, chunk_jobs()):
+            if result.ok:
+                inventory.register_chunk(chunk_id, digest, length, key_id)
+            else:
+                message = result.stderr.replace('\n', '\n\t')
+                print('FAILED encryption of chunk: {}\n\t{}'.format(chunk_id, message))
+                failed_chunks.add(chunk_id)
+
+        for plainfile, chunk_ids in manifests.items():
+            if plainfile in failed or not failed_chunks.isdisjoint(chunk_ids):
+                failed.add(plainfile)
+                continue
+            if self.is_unchanged(files[plainfile]):
+                self.keep_unchanged(plainfile, files[plainfile], inventory)
+                continue
+            manifest_id = self.generate_name()
+            inventory.register_manifest(manifest_id, chunk_ids)
+            inventory.register(plainfile, manifest_id, self.public_id, False, '',
+                               files[plainfile]['fingerprint'],
+                               files[plainfile]['digest'], chunked=True)
+            if self.verbose:
+                print('Encrypted file: {} ---> {} chunks'.format(plainfile, len(chunk_ids)))
+        return failed
+
+    def encrypt_chunk(self, chunk, chunk_id, session_key=None):
+        """Encrypt a chunk of bytes. This is safe to run in a worker thread."""
+        encrypted_path = os.path.join(self.securedir, chunk_id)
+        return self.gpg.encrypt_stream(io.BytesIO(chunk), encrypted_path,
+                                       session_key=session_key)
+
+    def delete_old_versions(self, old_versions, inventory):
+        """Remove the previous encrypted files and chunk lists of re-encrypted files.
+
+        old_versions is a list of tuples of the registered encrypted
+        file and whether it is a chunk list. The register is committed
+        before encrypted files are deleted, so an interrupted run never
+        leaves a committed record pointing to a deleted file.
+        """
+        obsolete = []
+        for encfile, is_chunked in old_versions:
+            if is_chunked:
+                inventory.clean_manifest(encfile)
+            elif encfile:
+                obsolete.append(encfile)
+        if obsolete:
+            inventory.commit()
+        for encfile in obsolete:
+            FileOps.delete_file(self.securedir, encfile)
+
+    def delete_unused_chunks(self, inventory):
+        """Delete chunks that are no longer in the chunk list of any file."""
+        unused = inventory.read_unused_chunks()
+        if unused:
+            # chunk lists are removed for good before their chunks
+            inventory.commit()
+        for chunk_id in unused:
+            if os.path.isfile(os.path.join(self.securedir, chunk_id)):
+                if self.verbose:
+                    print('Delete unused chunk {}'.format(chunk_id))
+                FileOps.delete_file(self.securedir, chunk_id)
+        inventory.clean_chunks(unused)
+
+    def run_jobs(self, function, jobs, coroutine_function=None):
+        """Call function for each job, in a thread pool if jobs > 1.
+
+        jobs is an iterable of (key, args) tuples. Yields (key, result)
+        tuples on the calling thread, in the order the calls complete,
+        so results can be written to the inventory without locking.
+        At most twice as many calls as there are workers are queued
+        at any time.
+
+        With the asyncio gpg engine, coroutine_function is awaited
+        instead of calling function, see run_async_jobs().
+        """
+        if self.gpg_engine == 'asyncio' and coroutine_function is not None:
+            yield from self.run_async_jobs(coroutine_function, jobs)
+            return
+
+        if self.jobs <= 1:
+            for key, args in jobs:
+                yield key, function(*args)
+            return
+
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            pending = {}
+            for key, args in jobs:
+                if len(pending) >= 2 * self.jobs:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield pending.pop(future), future.result()
+                pending[pool.submit(function, *args)] = key
+            for future in as_completed(pending):
+                yield pending[future], future.result()
+
+    def run_async_jobs(self, coroutine_function, jobs):
+        """Await coroutine_function for each job in an event loop.
+
+        The loop runs on the calling thread, only while waiting for
+        results, so results are yielded as in run_jobs(). The number
+        of gpg processes is limited by GPGOps.
+        """
+        loop = asyncio.new_event_loop()
+        pending = {}
+        try:
+            for key, args in jobs:
+                if len(pending) >= 2 * self.jobs:
+                    done, _ = loop.run_until_complete(asyncio.wait(
+                        pending, return_when=asyncio.FIRST_COMPLETED))
+                    for task in done:
+                        yield pending.pop(task), task.result()
+                pending[loop.create_task(coroutine_function(*args))] = key
+            while pending:
+                done, _ = loop.run_until_complete(asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED))
+                for task in done:
+                    yield pending.pop(task), task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                loop.run_until_complete(asyncio.wait(pending))
+            loop.close()
+
+    def register_empty_dirs(self, register, inventory, scan=None):
         """Register all empty directories."""
-        dirs = self.find_unregistered_empty_dirs(register)
+        dirs = self.find_unregistered_empty_dirs(register, scan)
         for dir_name, val in dirs.items():
             if not val['is_new']:
                 # remove old dir in register
                 inventory.clean_record(dir_name)
-            self.register(dir_name, inventory, False)
+            self.register(dir_name, inventory, False,
+                          fingerprint=val['fingerprint'])
             if self.verbose:
                 print('Registered empty directory: {}'.format(dir_name))
 
-    def register_symlinks(self, register, inventory):
+    def register_symlinks(self, register, inventory, scan=None):
         """Register all symlinks."""
-        links = self.find_unregistered_links(register)
+        links = self.find_unregistered_links(register, scan)
         for link_name, val in links.items():
             if not val['is_new']:
                 # remove old link in register
                 inventory.clean_record(link_name)
-            self.register(link_name, inventory, True, val['target'])
+            self.register(link_name, inventory, True, val['target'],
+                          fingerprint=val['fingerprint'])
             if self.verbose:
                 print('Registered symlink: {} ---> {}'.format(link_name, val['target']))
 
-    def do_inv_maintenance(self, inventory):
+    def do_inv_maintenance(self, inventory, register=None, scan=None):
         """Clean register and update timestamp."""
-        self.clean(inventory)
+        self.clean(inventory, register, scan)
         inventory.update_last_timestamp()
 
-    def encrypt(self, plainfile, encfile, inventory, is_link=False):
-        """Encrypt the file and register input and output filenames."""
+    def encrypt(self, plainfile, encfile, inventory, is_link=False,
+                fingerprint=None, digest=None):
+        """Encrypt the file and register input and output filenames.
+
+        fingerprint should be taken before encryption, so a file
+        modified while being encrypted is picked up again on the next run.
+        """
+        result = self.encrypt_file(plainfile, encfile)
+        return self.register_encrypted(plainfile, encfile, inventory, result,
+                                       is_link, fingerprint, digest)
+
+    def encrypt_file(self, plainfile, encfile, session_key=None, backend=None):
+        """Encrypt the file, without touching the inventory.
+
+        This is the part of encrypt() that is safe to run in a worker
+        thread. The file is encrypted by the named backend, gpg if not
+        given, with session_key if given, and to the public id otherwise.
+        Returns the backend result.
+        """
+        plain_path = os.path.join(self.plaindir, plainfile)
+        encrypted_path = os.path.join(self.securedir, encfile)
+        return self.backends[backend or 'gpg'].encrypt(
+            plain_path, encrypted_path, session_key)
+
+    async def encrypt_file_async(self, plainfile, encfile, session_key=None,
+                                 backend=None):
+        """Same as encrypt_file(), with the asyncio gpg engine."""
         plain_path = os.path.join(self.plaindir, plainfile)
         encrypted_path = os.path.join(self.securedir, encfile)
-        result = self.gpg.encrypt(plain_path, encrypted_path)
+        return await self.backends[backend or 'gpg'].encrypt_async(
+            plain_path, encrypted_path, session_key)
+
+    def encrypt_changed_file(self, plainfile, encfile, session_key=None,
+                             backend=None, old_digest=None):
+        """Encrypt a file as encrypt_file(), unless its content did not change.
+
+        This is safe to run in a worker thread. With content digests
+        enabled, the digest of the file is computed first, and the file
+        is not encrypted if it equals old_digest, the registered one.
+        Returns the digest, or None if digests are disabled, and the
+        backend result, or None if the file was not encrypted.
+        """
+        digest = None
+        if self.content_digest:
+            digest = FileOps.file_digest(self.plaindir, plainfile)
+            if digest is not None and digest == old_digest:
+                return digest, None
+        return digest, self.encrypt_file(plainfile, encfile, session_key, backend)
+
+    async def encrypt_changed_file_async(self, plainfile, encfile, session_key=None,
+                                         backend=None, old_digest=None):
+        """Same as encrypt_changed_file(), with the asyncio gpg engine.
+
+        The digest is computed in the default executor of the event loop.
+        """
+        digest = None
+        if self.content_digest:
+            digest = await asyncio.get_running_loop().run_in_executor(
+                None, FileOps.file_digest, self.plaindir, plainfile)
+            if digest is not None and digest == old_digest:
+                return digest, None
+        return digest, await self.encrypt_file_async(plainfile, encfile, session_key,
+                                                     backend)
+
+    def register_encrypted(self, plainfile, encfile, inventory, result,
+                           is_link=False, fingerprint=None, digest=None,
+                           key_id=None, backend=None):
+        """Register an encrypted file, or report the failed encryption.
+
+        Returns True if the encryption succeeded.
+        """
         if result.ok:
-            inventory.register(plainfile, encfile, self.public_id, is_link, '')
+            inventory.register(plainfile, encfile, self.public_id, is_link, '',
+                               fingerprint, digest, key_id=key_id,
+                               backend=backend)
         else:
             message = result.stderr.replace('\n', '\n\t')
             print('FAILED encryption of: {}\n\t{}'.format(plainfile, message))
         return result.ok
 
-    def register(self, plainfile, inventory, is_link, link_target=None):
+    def register(self, plainfile, inventory, is_link, link_target=None,
+                 fingerprint=None):
         """Register symlinks and empty directories."""
-        inventory.register(plainfile, '', '', is_link, link_target)
+        inventory.register(plainfile, '', '', is_link, link_target, fingerprint)
+
+    def remove_missing(self, register, scan, inventory):
+        """Unregister records that are no longer found by the scan.
+
+        Stale records are the registered paths of each type that the scan
+        did not find, and are deleted from the register in one batch.
+        register may be a part of the register, but scan must cover all
+        of its paths. Encrypted files of removed regular files are
+        deleted. Records that changed type, are excluded, or sit under a
+        directory the scan could not read are kept. Packs are left to
+        repack(); unused chunks are deleted.
+        """
+        registered_files = set()
+        registered_links = set()
+        registered_dirs = set()
+        for filename, record in register.items():
+            if record['is_link']:
+                registered_links.add(filename)
+            elif record['encrypted_file']:
+                registered_files.add(filename)
+            else:
+                registered_dirs.add(filename)
+
+        stale_files = registered_files - scan.files.keys()
+        stale_links = registered_links - scan.links.keys()
+        stale_dirs = registered_dirs - scan.dirs.keys()
+        found = scan.files.keys() | scan.links.keys() | scan.dirs.keys()
+
+        unregister = []
+        unreadable = 0
+        for filenames, message, kind in ((stale_files, 'regular file', 'f'),
+                                         (stale_links, 'symlink', 'l'),
+                                         (stale_dirs, 'empty directory', 'd')):
+            is_file = kind == 'f'
+            for filename in sorted(filenames):
+                if self.rules.is_excluded(filename, is_dir=(kind == 'd')):
+                    continue
+                if scan.is_incomplete(filename):
+                    unreadable += 1
+                    continue
+                if is_file and register[filename].get('chunked'):
+                    inventory.clean_manifest(register[filename]['encrypted_file'])
+                elif is_file and register[filename].get('pack') is None:
+                    encfile = register[filename]['encrypted_file']
+                    if os.path.isfile(os.path.join(self.securedir, encfile)):
+                        print("  --> Delete encrypted file {}".format(encfile))
+                        FileOps.delete_file(self.securedir, encfile)
+                if filename not in found:
+                    print("  --> Unregister {} {}".format(message, filename))
+                    unregister.append(filename)
+        if unreadable:
+            print('  --> Kept {} records that could not be scanned'.format(unreadable))
+        inventory.clean_records(unregister)
+        self.delete_unused_chunks(inventory)
+        inventory.clean_session_keys(self.session_key[0] if self.session_key else None)
 
-    def clean(self, inv):
+    def clean(self, inv, register=None, scan=None):
         """Clean register and file system
 
         If some files, links or empty directories have been
         deleted in the root directory, they must be removed
-        from the register
+        from the register.
+
+        register and scan are read if they are not given. A register
+        read before the current run is fine, as anything registered
+        during the run is found by the scan.
         """
 
         print("Clean register and file system...")
-        registered_files = inv.read_register("files")
-        registered_links = inv.read_register("links")
-        registered_dirs = inv.read_register("dirs")
-
-        # Clean regular files
-        for filename, record in registered_files.items():
-            unenc_filename_path = os.path.join(self.plaindir, filename)
-            enc_filename_path = os.path.join(self.securedir, record['encrypted_file'])
-            if not os.path.isfile(unenc_filename_path):
-                if os.path.isfile(enc_filename_path):
-                    print("  --> Delete encrypted file {} and unregister".format(record['encrypted_file']))
-                    FileOps.delete_file(self.securedir, record['encrypted_file'])
-                inv.clean_record(filename)
-
-        # Clean symlinks
-        for filename, record in registered_links.items():
-            unenc_filename_path = os.path.join(self.plaindir, filename)
-            if not os.path.islink(unenc_filename_path):
-                print("  --> Unregister symlink {}".format(filename))
-                inv.clean_record(filename)
-
-        # Clean empty directories
-        for filename, record in registered_dirs.items():
-            unenc_filename_path = os.path.join(self.plaindir, filename)
-            if not os.path.isdir(unenc_filename_path):
-                print("  --> Unregister empty directory {}".format(filename))
-                inv.clean_record(filename)
-            elif os.path.isdir(unenc_filename_path):
-                # unregister if the directory has been filled
-                if os.listdir(unenc_filename_path):
-                    print("  --> Unregister  non empty directory {}".format(filename))
-                    inv.clean_record(filename)
+        if register is None:
+            register = inv.read_register("all")
+        if scan is None:
+            scan = self.scan_plaindir()
+        self.remove_missing(register, scan, inv)
 
     def decrypt_all(self, passphrase):
         """Decrypt all files from encrypted source.
@@ -221,158 +933,439 @@ class DirEncryption(object):
         Files that are being decrypted must be registered under the same
         public id in the database, so the passed passphrase would work
         for decryption process.
+
+        Empty directories are created first, then regular files are
+        decrypted, in a thread pool if there is more than one job, and
+        symlinks are created last. The register is streamed, so restoring
+        starts at once and memory use does not grow with the register.
+        Chunk lists and session keys are read while jobs are queued,
+        as the inventory is not used from worker threads, and every
+        session key is decrypted only once.
         """
-        register = {}
         with Inventory(self.database) as i:
-            register = i.read_register("all")
-            for filename, record in register.items():
-                # first decrypt regular files
-                if record['is_link'] == 0 and record['encrypted_file'] and record['public_id']:
-                    if record['public_id'] != self.public_id:
-                        continue
-                    try:
-                        self.decrypt(record['encrypted_file'], record['unencrypted_file'], passphrase)
-                    except IOError as e:
-                        logging.warning('decrypt_all: {}'.format(e))
-                        print('Failed to create file {} : {}'.format(record['unencrypted_file'], str(e)))
-                # then restore empty directories
-                elif record['is_link'] == 0 and not record['encrypted_file'] and not record['public_id']:
-                    FileOps.create_directory(self.restoredir, record['unencrypted_file'])
-                # finally restore symlinks
-                elif record['is_link'] == 1:
-                    FileOps.create_symlink(self.restoredir, record['unencrypted_file'], record['target'])
-
-
-    def decrypt(self, encfile, plainfile, phrase):
-        """Decrypt the file using a supplied passphrase."""
+            # first restore empty directories
+            for record in i.iter_register("dirs"):
+                FileOps.create_directory(self.restoredir, record['unencrypted_file'],
+                                         parents=True)
+
+            total = 0
+            failed = 0
+            # then decrypt regular files
+            jobs = ((record['unencrypted_file'],
+                     (record['encrypted_file'], record['unencrypted_file'],
+                      self.unwrapped_key(i, record.get('key_id'), passphrase),
+                      record.get('backend')))
+                    for record in self.iter_own_files(i)
+                    if record.get('pack') is None and not record.get('chunked'))
+            for plainfile, decrypted_ok in self.run_jobs(
+                    self.restore_file, jobs, self.restore_file_async):
+                total += 1
+                failed += not decrypted_ok
+            # and files stored in packs, each pack decrypted once
+            jobs = (((pack_id, len(members)),
+                     (pack_id, members,
+                      self.unwrapped_key(i, members[0].get('key_id'), passphrase)))
+                    for pack_id, members in self.iter_own_packs(i))
+            for (pack_id, count), restored in self.run_jobs(self.restore_pack, jobs):
+                total += count
+                failed += count - restored
+            # and files stored in chunks
+            jobs = ((record['unencrypted_file'],
+                     (record['unencrypted_file'],
+                      self.read_chunks(i, record['encrypted_file'], passphrase)))
+                    for record in self.iter_own_files(i) if record.get('chunked'))
+            for plainfile, decrypted_ok in self.run_jobs(self.restore_chunked, jobs):
+                total += 1
+                failed += not decrypted_ok
+            if failed:
+                print('Failed to decrypt {} of {} files'.format(failed, total))
+            # finally restore symlinks
+            for record in i.iter_register("links"):
+                parent = os.path.dirname(record['unencrypted_file'])
+                if parent:
+                    FileOps.create_directory(self.restoredir, parent, parents=True)
+                FileOps.create_symlink(self.restoredir, record['unencrypted_file'],
+                                       record['target'])
+
+    def iter_own_files(self, inventory, order_by=None):
+        """Yield records of regular files encrypted to the current public id."""
+        for record in inventory.iter_register("files", order_by):
+            if record['public_id'] == self.public_id:
+                yield record
+
+    def iter_own_packs(self, inventory):
+        """Yield pack id and the list of its member records, for each pack.
+
+        The register is read ordered by encrypted file, which is the
+        pack id of pack members, so members of a pack come together
+        and are not collected for all packs at once.
+        """
+        members = (record for record in self.iter_own_files(inventory, 'encrypted_file')
+                   if record.get('pack') is not None)
+        for pack_id, group in groupby(members, lambda record: record['encrypted_file']):
+            yield pack_id, list(group)
+
+    def read_chunks(self, inventory, manifest_id, passphrase):
+        """Return the chunk list of a file as (chunk id, phrase) tuples.
+
+        The phrase of a chunk is the one that decrypts it, see
+        unwrapped_key().
+        """
+        chunk_ids = inventory.read_manifest(manifest_id)
+        key_ids = inventory.read_chunk_keys(chunk_ids)
+        return [(chunk_id, self.unwrapped_key(inventory, key_ids.get(chunk_id), passphrase))
+                for chunk_id in chunk_ids]
+
+    def restore_record(self, record, phrase):
+        """Decrypt a single registered file, from its pack or chunks if it has them.
+
+        Session keys are decrypted once and kept for the next records.
+        """
+        with Inventory(self.database) as inv:
+            if record.get('chunked'):
+                chunks = self.read_chunks(inv, record['encrypted_file'], phrase)
+            else:
+                phrase = self.unwrapped_key(inv, record.get('key_id'), phrase)
+        if record.get('chunked'):
+            return self.restore_chunked(record['unencrypted_file'], chunks)
+        if record.get('pack') is None:
+            return self.decrypt(record['encrypted_file'],
+                                record['unencrypted_file'], phrase,
+                                record.get('backend'))
+        return self.restore_pack(record['encrypted_file'], [record], phrase) == 1
+
+    def restore_pack(self, pack_id, members, phrase):
+        """Decrypt a pack and extract the given members of it.
+
+        Only this pack is decrypted, in memory, so its plaintext is
+        never written outside the restore directory. Returns the number
+        of extracted files.
+        """
+        restored = 0
+        pack = self.decrypt_pack(pack_id, phrase)
+        if pack is None:
+            return restored
+        for record in members:
+            offset, length = record['pack']
+            if self.verbose:
+                print('Extract: {} ---> {}'.format(
+                    pack_id, os.path.join(self.restoredir, record['unencrypted_file'])))
+            if extract_member(pack, offset, length, self.restoredir,
+                              record['unencrypted_file']):
+                restored += 1
+        return restored
+
+    def restore_chunked(self, plainfile, chunks):
+        """Decrypt the chunks of a file one by one and join them.
+
+        chunks is a list of (chunk id, phrase) tuples, see read_chunks().
+        Chunks are appended to a temporary file next to the restored
+        file, which is renamed once all chunks have been decrypted, so
+        only one chunk is held in memory. Returns True if the file was
+        restored.
+        """
+        restored_path = os.path.join(self.restoredir, plainfile)
+        if self.verbose:
+            print('Decrypt: {} chunks ---> {}'.format(len(chunks), restored_path))
+        try:
+            tmpfile = self.gpg.temporary_path(restored_path)
+            try:
+                with open(tmpfile, 'wb') as f:
+                    for chunk_id, phrase in chunks:
+                        result = self.gpg.decrypt_data(
+                            os.path.join(self.securedir, chunk_id), phrase)
+                        if not self.report_decrypted(chunk_id, plainfile, result):
+                            return False
+                        f.write(result.data)
+                os.replace(tmpfile, restored_path)
+            finally:
+                if os.path.lexists(tmpfile):
+                    os.remove(tmpfile)
+        except IOError as e:
+            return self.report_restore_error(plainfile, e)
+        return True
+
+    def decrypt_pack(self, pack_id, phrase):
+        """Decrypt a pack in memory and return its plaintext as a file object.
+
+        Packs are about pack_size bytes, so they are never written to
+        disk decrypted. Returns None if the pack could not be decrypted.
+        """
+        encrypted_path = os.path.join(self.securedir, pack_id)
+        try:
+            result = self.gpg.decrypt_data(encrypted_path, phrase)
+        except IOError as e:
+            print('Failed to decrypt pack {} : {}'.format(pack_id, str(e)))
+            return None
+        if not result.ok:
+            message = result.stderr.replace('\n', '\n\t')
+            print('FAILED decryption of pack: {}\n\t{}'.format(pack_id, message))
+            return None
+        return io.BytesIO(result.data)
+
+    def repack(self, passphrase, ratio=0.5):
+        """Rewrite packs to reclaim space taken by replaced or deleted files.
+
+        Packs without registered files are deleted. Packs whose
+        registered files take less than ratio of their length are
+        decrypted one at a time, and their registered files are written
+        into new packs of about pack_size bytes. An old pack is deleted
+        only after all its files have been registered in new packs.
+        """
+        with Inventory(self.database) as inv:
+            sparse = []
+            for pack_id, (length, live) in sorted(inv.read_packs().items()):
+                if live == 0:
+                    print('Delete empty pack {}'.format(pack_id))
+                    if os.path.isfile(os.path.join(self.securedir, pack_id)):
+                        FileOps.delete_file(self.securedir, pack_id)
+                    inv.clean_pack(pack_id)
+                elif live < length * ratio:
+                    sparse.append(pack_id)
+
+            buffer = io.BytesIO()
+            moved = []
+            consumed = []
+            for pack_id in sparse:
+                members = inv.read_pack_members(pack_id)
+                key_id = next(iter(members.values())).get('key_id')
+                pack = self.decrypt_pack(pack_id, self.unwrapped_key(inv, key_id, passphrase))
+                if pack is None:
+                    continue
+                for plainfile, record in members.items():
+                    offset, length = record['pack']
+                    pack.seek(offset)
+                    moved.append((plainfile, buffer.tell(), length))
+                    buffer.write(pack.read(length))
+                consumed.append(pack_id)
+                if buffer.tell() >= self.pack_size:
+                    self.write_repacked(inv, buffer, moved, consumed)
+                    buffer, moved, consumed = io.BytesIO(), [], []
+            if moved:
+                self.write_repacked(inv, buffer, moved, consumed)
+
+    def write_repacked(self, inventory, buffer, moved, consumed):
+        """Encrypt a new pack from repacked files and delete the old packs.
+
+        The new pack is encrypted with the current session key, if any.
+        The new pack and its members are committed before the old packs
+        are deleted, so the register never points at a deleted pack.
+        """
+        pack_id = self.generate_name()
+        key_id, session_key = self.current_session_key(inventory)
+        buffer.seek(0)
+        result = self.gpg.encrypt_stream(buffer, os.path.join(self.securedir, pack_id),
+                                         session_key=session_key)
+        if not result.ok:
+            message = result.stderr.replace('\n', '\n\t')
+            print('FAILED encryption of pack: {}\n\t{}'.format(pack_id, message))
+            return
+        inventory.register_pack(pack_id, buffer.tell())
+        for plainfile, offset, length in moved:
+            inventory.move_pack_member(plainfile, pack_id, (offset, length), key_id)
+        inventory.commit()
+        for old_pack_id in consumed:
+            print('Repacked {} ---> {}'.format(old_pack_id, pack_id))
+            FileOps.delete_file(self.securedir, old_pack_id)
+            inventory.clean_pack(old_pack_id)
+
+    def restore_file(self, encfile, plainfile, phrase, backend=None):
+        """Decrypt a single file, reporting errors instead of raising them.
+
+        Returns True if the file was decrypted.
+        """
+        try:
+            return self.decrypt(encfile, plainfile, phrase, backend)
+        except IOError as e:
+            return self.report_restore_error(plainfile, e)
+
+    async def restore_file_async(self, encfile, plainfile, phrase, backend=None):
+        """Same as restore_file(), with the asyncio gpg engine."""
+        try:
+            return await self.decrypt_async(encfile, plainfile, phrase, backend)
+        except IOError as e:
+            return self.report_restore_error(plainfile, e)
+
+    def report_restore_error(self, plainfile, e):
+        """Report a file that could not be restored and return False."""
+        logging.warning('decrypt_all: {}'.format(e))
+        print('Failed to create file {} : {}'.format(plainfile, str(e)))
+        return False
+
+    def decrypt(self, encfile, plainfile, phrase, backend=None):
+        """Decrypt the file using a supplied passphrase.
+
+        The file is decrypted by the named backend that encrypted it,
+        gpg if not given.
+        """
+        ops = self.backends.get(backend or 'gpg')
+        if ops is None:
+            return self.report_decrypted(encfile, plainfile, BackendResult(
+                False, 'Backend {} is not available'.format(backend)))
         encrypted_path = os.path.join(self.securedir, encfile)
         restored_path = os.path.join(self.restoredir, plainfile)
         if self.verbose:
             print('Decrypt: {} ---> {}'.format(encrypted_path, restored_path))
-        result = self.gpg.decrypt(encrypted_path, restored_path, phrase)
+        result = ops.decrypt(encrypted_path, restored_path, phrase)
+        return self.report_decrypted(encfile, plainfile, result)
+
+    async def decrypt_async(self, encfile, plainfile, phrase, backend=None):
+        """Same as decrypt(), with the asyncio gpg engine."""
+        ops = self.backends.get(backend or 'gpg')
+        if ops is None:
+            return self.report_decrypted(encfile, plainfile, BackendResult(
+                False, 'Backend {} is not available'.format(backend)))
+        encrypted_path = os.path.join(self.securedir, encfile)
+        restored_path = os.path.join(self.restoredir, plainfile)
+        if self.verbose:
+            print('Decrypt: {} ---> {}'.format(encrypted_path, restored_path))
+        result = await ops.decrypt_async(encrypted_path, restored_path, phrase)
+        return self.report_decrypted(encfile, plainfile, result)
+
+    def report_decrypted(self, encfile, plainfile, result):
+        """Report a failed decryption. Returns True if it succeeded."""
         if not result.ok:
             message = result.stderr.replace('\n', '\n\t')
             print('FAILED decryption of: {} to {}\n\t{}'.format(encfile, plainfile, message))
         return result.ok
 
-    def find_unencrypted_files(self, register):
-        """List all files that need to be encrypted.
+    def scan_plaindir(self, inventory=None):
+        """Walk the unencrypted directory once.
+
+        If dirstate is enabled and inventory is given, directory
+        listings cached in the inventory are reused for directories
+        that did not change, and the cache is updated after the walk.
 
-        os.walk does not expand tilde in paths, so the walk directory
-        is explicitly expanded.
+        Returns a ScanResult with regular files, symlinks and empty
+        directories, shared by all find_* functions.
+        """
+        if self.verbose:
+            print('Walking: {}'.format(self.plaindir))
+        if not self.use_dirstate or inventory is None:
+            return TreeScanner(self.plaindir, rules=self.rules,
+                               workers=self.scan_workers).scan()
+        scanner = TreeScanner(self.plaindir, inventory.read_dirstate(),
+                              self.rules, self.scan_workers)
+        scan = scanner.scan()
+        inventory.update_dirstate(*scanner.dirstate_changes())
+        return scan
+
+    def find_unencrypted_files(self, register, scan=None):
+        """List all files that need to be encrypted.
 
         register is the currently known list of encrypted files.
+        scan is the result of scan_plaindir(); the directory is walked
+        if it is not provided.
 
         Returns a dict, with relative path of the unencrypted files
         for keys, and is_new boolean flag for values.
         """
+        if scan is None:
+            scan = self.scan_plaindir()
         files = {}
-        if self.verbose:
-            print('Walking: {}'.format(self.plaindir))
-
-        for (dirpath, dirnames, filenames) in os.walk(self.plaindir):
-            for name in filenames:
-                filepath = os.path.join(dirpath, name)
-                if os.path.islink(filepath):
-                    continue
-                statinfo = os.stat(filepath)
-                mtime = statinfo.st_mtime
-                relative_path = filepath[(len(self.plaindir) + 1):]
-                if relative_path not in register:
-                    # new file
-                    enc_flag = '*'
-                    files[relative_path] = {'is_new': True}
-                elif relative_path in register and mtime > int(self.last_timestamp):
-                    # file exists and has changed since last run
-                    enc_flag = '*'
-                    files[relative_path] = {'is_new': False}
-                else:
-                    # file has not changed since last run
-                    enc_flag = ' '
-                if self.verbose:
-                    print('List files: {} {} ({}): {}'.format(
-                        enc_flag, int(mtime), self.last_timestamp, relative_path))
+        for relative_path, statinfo in scan.files.items():
+            mtime = statinfo.st_mtime
+            if relative_path not in register:
+                # new file
+                enc_flag = '*'
+                files[relative_path] = {'is_new': True, 'fingerprint': fingerprint(statinfo)}
+            elif self.is_modified(register[relative_path], statinfo):
+                # file exists and has changed since last run
+                enc_flag = '*'
+                files[relative_path] = {'is_new': False, 'fingerprint': fingerprint(statinfo)}
+            else:
+                # file has not changed since last run
+                enc_flag = ' '
+            if self.verbose:
+                print('List files: {} {}: {}'.format(
+                    enc_flag, int(mtime), relative_path))
         return files
 
-    def find_unregistered_links(self, register):
+    def find_unregistered_links(self, register, scan=None):
         """List all links that need to be registered.
 
         Returns a dict, with relative path of the unregistered links
         for keys, having a dict with target of the link and
         is_new boolean flag for values.
         """
+        if scan is None:
+            scan = self.scan_plaindir()
         links = {}
-        if self.verbose:
-            print('Walking: {}'.format(self.plaindir))
-        links_to_treat = list()
-        # get symlinks to directories
-        for (dirpath, dirnames, filenames) in os.walk(self.plaindir, followlinks=True):
-            if os.path.islink(dirpath):
-                links_to_treat.append(dirpath)
-        # get symlinks to files
-        for (dirpath, dirnames, filenames) in os.walk(self.plaindir):
-            for name in filenames:
-                linkpath = os.path.join(dirpath, name)
-                if not os.path.islink(linkpath):
-                    continue
-                links_to_treat.append(linkpath)
-        for link in links_to_treat:
-            # stat to the link and not his target
-            statinfo = os.stat(link, follow_symlinks=False)
+        for relative_path, statinfo in scan.links.items():
             mtime = statinfo.st_mtime
-            linkto = os.readlink(link)
-            relative_path = link[(len(self.plaindir) + 1):]
             if relative_path not in register:
                 # new link
                 enc_flag = '*'
-                links[relative_path] = {'target': linkto, 'is_new': True}
-            elif relative_path in register and mtime > int(self.last_timestamp):
+                links[relative_path] = {'is_new': True, 'fingerprint': fingerprint(statinfo)}
+            elif self.is_modified(register[relative_path], statinfo):
                 # link exists and has changed since last run
                 enc_flag = '*'
-                links[relative_path] = {'target': linkto, 'is_new': False}
+                links[relative_path] = {'is_new': False, 'fingerprint': fingerprint(statinfo)}
             else:
                 # link has not changed since last run
                 enc_flag = ' '
+            if relative_path in links:
+                links[relative_path]['target'] = os.readlink(
+                    os.path.join(self.plaindir, relative_path))
             if self.verbose:
-                print('List links: {} {} ({}): {}'.format(
-                    enc_flag, int(mtime), self.last_timestamp, relative_path))
+                print('List links: {} {}: {}'.format(
+                    enc_flag, int(mtime), relative_path))
         return links
 
-    def find_unregistered_empty_dirs(self, register):
+    def find_unregistered_empty_dirs(self, register, scan=None):
         """List all empty directories that need to be registered.
 
         Returns a dict, with relative path of the unregistered directories
         for keys, having a dict with is_new boolean flag for values.
         """
+        if scan is None:
+            scan = self.scan_plaindir()
         result = {}
-        if self.verbose:
-            print('Walking: {}'.format(self.plaindir))
-        empty_dirs = list()
-        for (dirpath, dirnames, filenames) in os.walk(self.plaindir):
-            if not dirnames and not filenames:
-                empty_dirs.append(dirpath)
-        if not empty_dirs:
-            return result
-        for dir in empty_dirs:
-            statinfo = os.stat(dir)
+        for relative_path, statinfo in scan.dirs.items():
             mtime = statinfo.st_mtime
-            relative_path = dir[(len(self.plaindir) + 1):]
             if relative_path not in register:
                 # new dir
                 enc_flag = '*'
-                result[relative_path] = {'is_new': True}
-            elif relative_path in register and mtime > int(self.last_timestamp):
+                result[relative_path] = {'is_new': True, 'fingerprint': fingerprint(statinfo)}
+            elif self.is_modified(register[relative_path], statinfo):
                 # dir exists and has changed since last run
                 enc_flag = '*'
-                result[relative_path] = {'is_new': False}
+                result[relative_path] = {'is_new': False, 'fingerprint': fingerprint(statinfo)}
             else:
                 # dir has not changed since last run
                 enc_flag = ' '
             if self.verbose:
-                print('List empty directories: {} {} ({}): {}'.format(
-                    enc_flag, int(mtime), self.last_timestamp, relative_path))
+                print('List empty directories: {} {}: {}'.format(
+                    enc_flag, int(mtime), relative_path))
         return result
 
+    def is_modified(self, record, statinfo):
+        """Check if a registered entry has changed since it was registered.
+
+        The stat fingerprint of the entry is compared with the one
+        stored in the register. Records registered before fingerprints
+        were stored fall back to comparing modified and change time
+        with the timestamp of the last run.
+        """
+        if record['fingerprint'] is None:
+            last_run = int(self.last_timestamp or 0)
+            return statinfo.st_mtime > last_run or statinfo.st_ctime > last_run
+        return record['fingerprint'] != fingerprint(statinfo)
+
+    def store_missing_fingerprints(self, register, scan, inventory):
+        """Store fingerprints of unchanged records registered without one.
+
+        This is done once per record, so the next run can compare
+        fingerprints instead of timestamps.
+        """
+        for entries in (scan.files, scan.links, scan.dirs):
+            for relative_path, statinfo in entries.items():
+                record = register.get(relative_path)
+                if record is None or record['fingerprint'] is not None:
+                    continue
+                if not self.is_modified(record, statinfo):
+                    inventory.update_fingerprint(relative_path, fingerprint(statinfo))
+
     def generate_name(self):
         """Return a unique file name for encrypted file."""
         return str(uuid.uuid4())
@@ -1,8 +1,11 @@
 import os
+import hashlib
 
 
 class FileOps(object):
 
+    DIGEST_BLOCK_SIZE = 1024 * 1024
+
     @staticmethod
     def delete_file(root_dir, file_name):
         """Try to delete file from filesystem.
@@ -30,14 +33,37 @@ class FileOps(object):
         return True
 
     @staticmethod
-    def create_directory(root_dir, dir_name):
+    def create_directory(root_dir, dir_name, parents=False):
         """Try to create a directory.
 
+        If parents is set, missing parent directories are created too,
+        and an existing directory is not an error.
+
         Returns true if successful, false otherwise.
         """
+        path = os.path.expanduser(os.path.join(root_dir, dir_name))
         try:
-            os.mkdir(os.path.expanduser(os.path.join(root_dir, dir_name)))
+            if parents:
+                os.makedirs(path, exist_ok=True)
+            else:
+                os.mkdir(path)
         except OSError as ose:
             print('Failed to create directory {} : {}'.format(dir_name, str(ose)))
             return False
         return True
+
+    @staticmethod
+    def file_digest(root_dir, file_name, block_size=DIGEST_BLOCK_SIZE):
+        """Compute SHA-256 digest of a file, reading it in fixed-size blocks.
+
+        Returns hex digest if successful, None otherwise.
+        """
+        digest = hashlib.sha256()
+        try:
+            with open(os.path.expanduser(os.path.join(root_dir, file_name)), 'rb') as f:
+                for block in iter(lambda: f.read(block_size), b''):
+                    digest.update(block)
+        except OSError as ose:
+            print('Failed to read file {} : {}'.format(file_name, str(ose)))
+            return None
+        return digest.hexdigest()
@@ -21,47 +21,200 @@
 #------------------------------------------------------------------------------
 
 import os
+import asyncio
 import gnupg
+from direncrypt.backends import Backend, BackendResult
 
 
-class GPGOps(object):
+class GPGOps(Backend):
     """A simple wrapper for GPG encryption/decryption.
 
     The class provides functions for encrypting and decrypting a single
-    file. GPG parameters needed to execute encryption functions are set
-    during the instantiation of the class.
+    file, and is the 'gpg' encryption backend. GPG parameters needed to
+    execute encryption functions are set during the instantiation of
+    the class.
+
+    Files are streamed through gpg in chunks of STREAM_BUFFER_SIZE
+    bytes, so memory use does not depend on the size of the file.
+
+    encrypt_async and decrypt_async are coroutines doing the same as
+    encrypt and decrypt with gpg subprocesses driven by asyncio. The
+    open file is passed to gpg as its standard input, so no threads
+    are needed to feed the pipes. At most max_processes of them run
+    at the same time in an event loop.
+
+    If a compression policy is given, gpg compression options are
+    chosen for every file by the policy, see CompressionPolicy.
+
+    Files can also be encrypted symmetrically with a session key, a
+    random passphrase that is itself encrypted to the recipient with
+    wrap_key(). Such files are decrypted by passing the session key as
+    the passphrase, which avoids a private key operation per file.
     """
 
+    name = 'gpg'
+    STREAM_BUFFER_SIZE = 64 * 1024
+    # A session key is random, so it is hashed only once, with a salt.
+    # gpg-agent would otherwise use its calibrated iteration count,
+    # which takes longer than the encryption of a small file.
+    SESSION_KEY_OPTIONS = ['--cipher-algo', 'AES256', '--s2k-mode', '1',
+                           '--s2k-digest-algo', 'SHA256', '--no-symkey-cache']
+
     def __init__(self,
                  gpg_binary='gpg2',
                  gpg_recipient=None,
                  gpg_homedir=os.path.expanduser('~/.gnupg'),
                  gpg_keyring='pubring.kbx',
-                 verbose=False):
+                 verbose=False,
+                 max_processes=1,
+                 compression=None):
         """Set GPG parameters for encrypt/decrypt operations."""
         self.recipient = gpg_recipient
         self.verbose = verbose
+        self.compression = compression
+        self.max_processes = max_processes
+        self.semaphore = None
+        self.semaphore_loop = None
         self.gpg = gnupg.GPG(gpgbinary=gpg_binary,
                              gnupghome=gpg_homedir,
                              keyring=gpg_keyring,
                              verbose=verbose)
+        self.gpg.buffer_size = self.STREAM_BUFFER_SIZE
+
+    def encrypt_stream(self, stream, encfile, name=None, session_key=None):
+        """Encrypt content read from a binary stream into encfile.
 
-    def encrypt(self, plainfile, encfile):
-        """Encrypt content from plainfile into encfile."""
-        with open(plainfile, mode = 'rb') as f:
-            return self.gpg.encrypt(
-                f.read(),
+        name is the file the content comes from, if any, used by the
+        compression policy.
+        """
+        extra_args = self.compression_args(name, stream)
+        if session_key is None:
+            return self.gpg.encrypt_file(
+                stream,
                 self.recipient,
                 armor=False,
-                output=encfile)
+                output=encfile,
+                extra_args=extra_args)
+        return self.gpg.encrypt_file(
+            stream,
+            None,
+            symmetric=True,
+            passphrase=session_key,
+            armor=False,
+            output=encfile,
+            extra_args=self.SESSION_KEY_OPTIONS + (extra_args or []))
+
+    def wrap_key(self, session_key):
+        """Encrypt a session key to the recipient.
+
+        Returns the gpg result, with the ASCII armored key as str(result).
+        """
+        return self.gpg.encrypt(session_key, self.recipient, armor=True)
+
+    def unwrap_key(self, wrapped_key, phrase):
+        """Decrypt a session key encrypted with wrap_key().
+
+        Returns the gpg result, with the session key as str(result).
+        """
+        return self.gpg.decrypt(wrapped_key, passphrase=phrase)
+
+    def compression_args(self, name, stream):
+        """Return gpg compression options for a file, from the policy."""
+        if self.compression is None:
+            return None
+        return self.compression.gpg_args(name, stream)
 
-    def decrypt(self, encfile, plainfile, phrase):
-        """Decrypt content from encfile into plainfile."""
-        plaindir = os.path.dirname(plainfile)
-        if not os.path.exists(plaindir):
-            os.makedirs(plaindir)
+    def decrypt_stream(self, stream, output, phrase):
+        """Decrypt content read from a binary stream into the file output.
+
+        The stream is fed to gpg in chunks, and gpg writes output itself.
+        """
+        return self.gpg.decrypt_file(
+            stream,
+            passphrase=phrase,
+            output=output)
+
+    def decrypt_data(self, encfile, phrase):
+        """Decrypt encfile in memory, into the data attribute of the result.
+
+        This is meant for chunks and other objects of bounded size.
+        """
         with open(encfile, mode='rb') as f:
-            return self.gpg.decrypt(
-                f.read(),
-                passphrase=phrase,
-                output=plainfile)
+            return self.gpg.decrypt_file(f, passphrase=phrase)
+
+    def process_limit(self):
+        """Return the semaphore limiting gpg processes in the running loop."""
+        loop = asyncio.get_running_loop()
+        if self.semaphore_loop is not loop:
+            self.semaphore = asyncio.Semaphore(self.max_processes)
+            self.semaphore_loop = loop
+        return self.semaphore
+
+    async def run_async(self, args, stdin, passphrase_fd=None):
+        """Run gpg with the same options python-gnupg would use.
+
+        stdin is an open file given to gpg as its standard input.
+        If passphrase_fd is set, gpg reads the passphrase from it.
+        """
+        command = self.gpg.make_args(args, False)
+        pass_fds = ()
+        if passphrase_fd is not None:
+            options = ['--passphrase-fd', str(passphrase_fd)]
+            if self.gpg.version >= (2, 1):
+                options[:0] = ['--pinentry-mode', 'loopback']
+            command[1:1] = options
+            pass_fds = (passphrase_fd,)
+        process = await asyncio.create_subprocess_exec(
+            *command,
+            stdin=stdin,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE,
+            pass_fds=pass_fds)
+        _, stderr = await process.communicate()
+        return BackendResult(process.returncode == 0,
+                             stderr.decode(self.gpg.encoding, 'replace'))
+
+    async def run_async_with_passphrase(self, args, stdin, phrase):
+        """Run gpg as run_async(), writing phrase to a pipe read by gpg."""
+        read_fd, write_fd = os.pipe()
+        try:
+            try:
+                os.write(write_fd, '{}\n'.format(phrase or '').encode(
+                    self.gpg.encoding))
+            finally:
+                os.close(write_fd)
+            return await self.run_async(args, stdin, passphrase_fd=read_fd)
+        finally:
+            os.close(read_fd)
+
+    async def encrypt_async(self, plainfile, encfile, session_key=None):
+        """Encrypt content from plainfile into encfile, in an event loop."""
+        async with self.process_limit():
+            with open(plainfile, mode='rb') as f:
+                extra_args = self.compression_args(plainfile, f) or []
+                if session_key is None:
+                    return await self.run_async(
+                        ['--encrypt', '--recipient', self.recipient,
+                         '--yes', '--output', encfile] + extra_args, f)
+                return await self.run_async_with_passphrase(
+                    ['--symmetric'] + self.SESSION_KEY_OPTIONS +
+                    ['--yes', '--output', encfile] + extra_args, f, session_key)
+
+    async def decrypt_async(self, encfile, plainfile, phrase):
+        """Decrypt content from encfile into plainfile, in an event loop.
+
+        The passphrase is written to a pipe read by gpg, and the
+        plaintext goes through a temporary file as in decrypt().
+        """
+        tmpfile = self.temporary_path(plainfile)
+        try:
+            async with self.process_limit():
+                with open(encfile, mode='rb') as f:
+                    result = await self.run_async_with_passphrase(
+                        ['--decrypt', '--yes', '--output', tmpfile], f, phrase)
+            if result.ok:
+                os.replace(tmpfile, plainfile)
+            return result
+        finally:
+            if os.path.lexists(tmpfile):
+                os.remove(tmpfile)
@@ -20,8 +20,93 @@
 # <dmars+github@protonmail.com>
 #------------------------------------------------------------------------------
 
+import sys
+import json
+import time
+import logging
 import sqlite3
 
+
+def intern(value):
+    """Intern a string, so equal values share a single object."""
+    return sys.intern(value) if type(value) is str else value
+
+
+class RegisterRecord(object):
+    """A register record of a regular file, symlink or empty directory.
+
+    Fields are kept in __slots__ instead of a dict per record, and
+    values repeated across records, like the public id, are interned,
+    so a register of millions of records fits in memory. The
+    unencrypted file is the same string object as the key of the
+    record in the register dict. Fingerprint and pack are built from
+    their columns when read.
+
+    Fields can be read as attributes or, as with the dicts records used
+    to be, by item access and get().
+    """
+
+    __slots__ = ('unencrypted_file', 'encrypted_file', 'public_id',
+                 'is_link', 'target', 'size', 'mtime_ns', 'inode',
+                 'ctime_ns', 'digest', 'pack_offset', 'pack_length',
+                 'chunked', 'key_id', 'backend')
+
+    def __init__(self, unencrypted_file=None, encrypted_file='', public_id='',
+                 is_link=0, target='', size=None, mtime_ns=None, inode=None,
+                 ctime_ns=None, digest=None, pack_offset=None, pack_length=None,
+                 chunked=False, key_id=None, backend=None):
+        self.unencrypted_file = unencrypted_file
+        # files in a pack share the pack name as their encrypted file
+        self.encrypted_file = (encrypted_file if pack_offset is None
+                               else intern(encrypted_file))
+        self.public_id = intern(public_id)
+        self.is_link = is_link
+        self.target = target
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.inode = inode
+        self.ctime_ns = ctime_ns
+        self.digest = digest
+        self.pack_offset = pack_offset
+        self.pack_length = pack_length
+        self.chunked = bool(chunked)
+        self.key_id = intern(key_id)
+        self.backend = intern(backend)
+
+    @property
+    def fingerprint(self):
+        """The (size, mtime_ns, inode, ctime_ns) tuple, or None if not stored."""
+        if self.size is None:
+            return None
+        return (self.size, self.mtime_ns, self.inode, self.ctime_ns)
+
+    @property
+    def pack(self):
+        """The (offset, length) tuple of a file in a pack, or None."""
+        if self.pack_offset is None:
+            return None
+        return (self.pack_offset, self.pack_length)
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def __eq__(self, other):
+        if not isinstance(other, RegisterRecord):
+            return NotImplemented
+        return all(getattr(self, field) == getattr(other, field)
+                   for field in self.__slots__)
+
+    def __repr__(self):
+        return 'RegisterRecord({})'.format(', '.join(
+            '{}={!r}'.format(field, getattr(self, field)) for field in self.__slots__))
+
+
 class Inventory:
     """Inventory is a file/location register for encrypted files.
 
@@ -29,22 +114,114 @@ class Inventory:
     Provided methods use cursor to execute queries against the
     database. Calling functions and classes should not directly use
     cursor to execute arbitrary queries.
+
+    Writes to the register and the tables of packs, chunks, session
+    keys and cached directories are buffered, and written with
+    executemany in batches of batch_size, each committed in its own
+    transaction. A batch is also committed commit_interval seconds
+    after the last commit, so progress of a long run survives a crash.
+    Buffered writes are flushed before any of these tables is read.
+    Parameters and state are written directly, as they are written
+    once per run or from the configuration prompt.
+
+    iter_register() streams the register in batches of FETCH_SIZE
+    rows, for reading registers too large to hold in memory.
+
+    The database uses write-ahead logging, with the synchronous and
+    cache size pragmas set from the sqlite_synchronous and
+    sqlite_cache_size parameters.
     """
 
-    def __init__(self, filename):
-        """Set database name."""
+    BATCH_SIZE = 1000
+    FETCH_SIZE = 1000
+    COMMIT_INTERVAL = 10.0
+    SYNCHRONOUS_MODES = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+    DEFAULT_SYNCHRONOUS = 'NORMAL'
+    # negative values are in KiB
+    DEFAULT_CACHE_SIZE = -64 * 1024
+
+    def __init__(self, filename, batch_size=BATCH_SIZE, commit_interval=COMMIT_INTERVAL):
+        """Set database name and write batch parameters."""
         self.database = filename
+        self.batch_size = batch_size
+        self.commit_interval = commit_interval
+        self.pending = []
+        self.pending_count = 0
 
     def __enter__(self):
         self.conn = sqlite3.connect(self.database)
         self.conn.row_factory = sqlite3.Row
         self.cursor = self.conn.cursor()
+        self.set_pragmas()
+        self.last_commit = time.monotonic()
         return self
 
     def __exit__(self, type, value, traceback):
-        self.conn.commit()
+        self.commit()
         self.conn.close()
 
+    def set_pragmas(self):
+        """Enable write-ahead logging and set pragmas from parameters.
+
+        In WAL mode a commit appends to the log instead of rewriting
+        pages, and readers do not block the writer. With synchronous
+        NORMAL, commits are not synced to disk; a power loss may lose
+        the last commits, but does not corrupt the database. Invalid
+        values are logged and replaced with the defaults, so a bad
+        parameter does not make the inventory unusable.
+        """
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        try:
+            settings = dict(self.conn.execute('''SELECT key, value FROM parameters
+                WHERE key IN ('sqlite_synchronous', 'sqlite_cache_size')''').fetchall())
+        except sqlite3.OperationalError:
+            # parameters table is not created yet
+            settings = {}
+        synchronous = (settings.get('sqlite_synchronous') or self.DEFAULT_SYNCHRONOUS).upper()
+        if synchronous not in self.SYNCHRONOUS_MODES:
+            logging.warning('Invalid sqlite_synchronous {!r}, using {}'.format(
+                synchronous, self.DEFAULT_SYNCHRONOUS))
+            synchronous = self.DEFAULT_SYNCHRONOUS
+        cache_size = settings.get('sqlite_cache_size') or self.DEFAULT_CACHE_SIZE
+        try:
+            cache_size = int(cache_size)
+        except ValueError:
+            logging.warning('Invalid sqlite_cache_size {!r}, using {}'.format(
+                cache_size, self.DEFAULT_CACHE_SIZE))
+            cache_size = self.DEFAULT_CACHE_SIZE
+        self.conn.execute('PRAGMA synchronous={}'.format(synchronous))
+        self.conn.execute('PRAGMA cache_size={}'.format(cache_size))
+
+    def write(self, request, args):
+        """Buffer a write to the register.
+
+        Consecutive writes with the same request are written with a
+        single executemany. The buffer is flushed and committed when it
+        holds batch_size writes, or commit_interval seconds have passed
+        since the last commit.
+        """
+        if self.pending and self.pending[-1][0] == request:
+            self.pending[-1][1].append(args)
+        else:
+            self.pending.append((request, [args]))
+        self.pending_count += 1
+        if (self.pending_count >= self.batch_size
+                or time.monotonic() - self.last_commit >= self.commit_interval):
+            self.commit()
+
+    def flush(self):
+        """Write buffered register writes, without committing them."""
+        for request, rows in self.pending:
+            self.cursor.executemany(request, rows)
+        self.pending = []
+        self.pending_count = 0
+
+    def commit(self):
+        """Flush buffered writes and commit the transaction."""
+        self.flush()
+        self.conn.commit()
+        self.last_commit = time.monotonic()
+
     def read_parameters(self, params_only=False):
         """Fetch program parameters and state from the database."""
         params = {}
@@ -55,63 +232,308 @@ class Inventory:
                 params[row[0]] = row[1]
         return params
     
+    REGISTER_COLUMNS = """
+                       SELECT unencrypted_file, encrypted_file, public_id,
+                       is_link, target, size, mtime_ns, inode, ctime_ns,
+                       digest, pack_offset, pack_length, chunked, key_id,
+                       backend
+                       FROM register
+                       """
+
+    REGISTER_FILTERS = {
+        "all":   "",
+        "files": "WHERE kind='f'",
+        "links": "WHERE kind='l'",
+        "dirs":  "WHERE kind='d'"
+    }
+    # indexed columns the register can be ordered by
+    REGISTER_ORDER = ('unencrypted_file', 'encrypted_file')
+
     def read_register(self, filter: str = "all"):
         """Get information on all registered regular files, symlinks and empty directories.
 
         "filter" can take the following values : "all", "files", "links" or "dirs".
         This parameter is used to modify the SQL query and filter the results.
         Returns a dict with unencrypted filename for keys, having
-        a dict of unencrypted file, encrypted file, public id,
-        is_link and target as value.
+        a RegisterRecord of unencrypted file, encrypted file, public id,
+        is_link, target, fingerprint, digest, pack, chunked and key_id as value.
+        Fingerprint is None for records registered before fingerprints
+        were stored. Pack is a tuple of offset and length of a file
+        stored in a pack, whose name is kept as the encrypted file, and
+        None otherwise. Chunked is True for a file stored in chunks,
+        whose manifest id is kept as the encrypted file. Key_id is the
+        session key a file is encrypted with, or None for files
+        encrypted to the public id.
         """
-        request_all =   """
-                        SELECT unencrypted_file, encrypted_file, public_id,
-                        is_link, target FROM register
-                        """
-        request_files = """
-                        SELECT unencrypted_file, encrypted_file, public_id,
-                        is_link, target FROM register WHERE is_link=0 and
-                        encrypted_file <>''
-                        """
-        request_links = """
-                        SELECT unencrypted_file, encrypted_file, public_id, 
-                        is_link, target FROM register WHERE is_link=1
-                        """
-        request_dirs =  """
-                        SELECT unencrypted_file, encrypted_file, public_id,
-                        is_link, target FROM register WHERE is_link=0 and
-                        encrypted_file=''
-                        """
-                         
-        switcher = { "all": request_all, "files": request_files, "links": request_links, "dirs": request_dirs }
-        request = switcher.get(filter)
-        
+        request = self.REGISTER_COLUMNS + self.REGISTER_FILTERS[filter]
+
+        self.flush()
         rows = {}
         for row in self.cursor.execute(request):
-            rows[row[0]] = {
-                'unencrypted_file': row[0],
-                'encrypted_file':   row[1],
-                'public_id':        row[2],
-                'is_link':          row[3],
-                'target':           row[4]
-            }
+            rows[row[0]] = self.make_record(row)
         return rows
-    
+
+    def iter_register(self, filter="all", order_by=None, batch_size=None):
+        """Yield register records one by one, without reading the whole register.
+
+        "filter" takes the same values as in read_register. order_by is
+        a column name from REGISTER_ORDER; records come in no particular
+        order if it is not given. Rows are fetched batch_size at a time,
+        FETCH_SIZE by default, with a cursor of their own, so other
+        methods can be used while iterating.
+        """
+        request = self.REGISTER_COLUMNS + self.REGISTER_FILTERS[filter]
+        if order_by is not None:
+            if order_by not in self.REGISTER_ORDER:
+                raise ValueError('Cannot order register by {}'.format(order_by))
+            request += " ORDER BY " + order_by
+
+        self.flush()
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute(request)
+            while True:
+                rows = cursor.fetchmany(batch_size or self.FETCH_SIZE)
+                if not rows:
+                    break
+                for row in rows:
+                    yield self.make_record(row)
+        finally:
+            cursor.close()
+
+    def read_register_paths(self, paths, recursive=True):
+        """Get register records of the given paths only.
+
+        If recursive is set, records of everything below a path are
+        returned too, so a deleted directory can be unregistered with
+        its content. Returns a dict in the same format as read_register.
+        """
+        exact = self.REGISTER_COLUMNS + "WHERE unencrypted_file = ?"
+        below = self.REGISTER_COLUMNS + """
+                WHERE unencrypted_file = ?
+                OR (unencrypted_file >= ? AND unencrypted_file < ?)
+                """
+        self.flush()
+        rows = {}
+        for path in paths:
+            if recursive:
+                # all paths starting with "path/", using the unique index
+                prefix = path + '/'
+                bound = path + chr(ord('/') + 1)
+                result = self.cursor.execute(below, (path, prefix, bound))
+            else:
+                result = self.cursor.execute(exact, (path,))
+            for row in result:
+                rows[row[0]] = self.make_record(row)
+        return rows
+
+    def count_register(self):
+        """Return the number of records in the register."""
+        self.flush()
+        self.cursor.execute("SELECT COUNT(*) FROM register")
+        return self.cursor.fetchone()[0]
+
+    def make_record(self, row):
+        """Convert a row selected with REGISTER_COLUMNS to a RegisterRecord."""
+        return RegisterRecord(*row)
+
     def read_line_from_register(self, plainfile):
         """Get encrypted filename from unencrypted filename in register"""
         result = {}
         request = "SELECT encrypted_file FROM register WHERE unencrypted_file = ?"
+        self.flush()
         for row in self.cursor.execute(request, (plainfile,)):
             result[plainfile] = {'encrypted_file':   row[0]}
         return result[plainfile]['encrypted_file']
 
-    def register(self, plain_path, enc_path, public_id, is_link, link_target):
-        """Register input and output filenames into a database."""
+    def register(self, plain_path, enc_path, public_id, is_link, link_target,
+                 fingerprint=None, digest=None, pack=None, chunked=False,
+                 key_id=None, backend=None):
+        """Register input and output filenames into a database.
+
+        fingerprint is the (size, mtime_ns, inode, ctime_ns) tuple of
+        the unencrypted file at the time it was read, and digest is the
+        optional content digest of the file. pack is the (offset, length)
+        tuple of a file stored in the pack enc_path. If chunked is set,
+        enc_path is the id of the manifest listing the chunks of the file.
+        key_id is the session key enc_path is encrypted with, if any, and
+        backend the name of the encryption backend that wrote enc_path;
+        records without one were written by gpg.
+
+        The kind of the record is stored for indexed lookups: 'l' for
+        symlinks, 'd' for empty directories, which have no encrypted
+        file, and 'f' for regular files.
+        """
         is_link_int = int(is_link)
-        self.cursor.execute('''INSERT OR REPLACE INTO register
-            (unencrypted_file, encrypted_file, public_id, is_link, target)
-            VALUES (?,?,?,?,?)''',
-            (plain_path, enc_path, public_id, is_link_int, link_target))
+        kind = 'l' if is_link_int else ('f' if enc_path else 'd')
+        size, mtime_ns, inode, ctime_ns = fingerprint or (None,) * 4
+        pack_offset, pack_length = pack or (None, None)
+        self.write('''INSERT OR REPLACE INTO register
+            (unencrypted_file, encrypted_file, public_id, is_link, target,
+             size, mtime_ns, inode, ctime_ns, digest, pack_offset, pack_length,
+             chunked, key_id, backend, kind)
+            VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)''',
+            (plain_path, enc_path, public_id, is_link_int, link_target,
+             size, mtime_ns, inode, ctime_ns, digest, pack_offset, pack_length,
+             int(chunked), key_id, backend, kind))
+
+    def update_fingerprint(self, plain_path, fingerprint):
+        """Store a new fingerprint for an already registered file."""
+        self.write('''UPDATE register
+            SET size = ?, mtime_ns = ?, inode = ?, ctime_ns = ?
+            WHERE unencrypted_file = ?''',
+            tuple(fingerprint) + (plain_path,))
+
+    def register_pack(self, pack_id, length):
+        """Register a pack with the total length of its members."""
+        self.write('''INSERT OR REPLACE INTO packs (pack_id, length)
+            VALUES (?,?)''', (pack_id, length))
+
+    def read_packs(self):
+        """Get all packs with the length of their members still registered.
+
+        Returns a dict with pack id for keys, having a tuple of total
+        length and live length as value.
+        """
+        request = """SELECT p.pack_id, p.length, COALESCE(SUM(r.pack_length), 0)
+                     FROM packs p LEFT JOIN register r
+                     ON r.encrypted_file = p.pack_id AND r.pack_offset IS NOT NULL
+                     GROUP BY p.pack_id"""
+        self.flush()
+        return {row[0]: (row[1], row[2]) for row in self.cursor.execute(request)}
+
+    def read_pack_members(self, pack_id):
+        """Get register records of the files stored in a pack."""
+        request = self.REGISTER_COLUMNS + """
+                  WHERE encrypted_file = ? AND pack_offset IS NOT NULL
+                  ORDER BY pack_offset"""
+        self.flush()
+        rows = {}
+        for row in self.cursor.execute(request, (pack_id,)):
+            rows[row[0]] = self.make_record(row)
+        return rows
+
+    def move_pack_member(self, plain_path, pack_id, pack, key_id=None):
+        """Point a registered file to its new place in another pack.
+
+        key_id is the session key the new pack is encrypted with, if any.
+        """
+        self.write('''UPDATE register
+            SET encrypted_file = ?, pack_offset = ?, pack_length = ?, key_id = ?
+            WHERE unencrypted_file = ?''',
+            (pack_id,) + tuple(pack) + (key_id, plain_path))
+
+    def clean_pack(self, pack_id):
+        """Delete a pack that has been removed from the encrypted directory."""
+        self.write("DELETE FROM packs WHERE pack_id = ?", (pack_id,))
+
+    def register_session_key(self, key_id, public_id, wrapped_key):
+        """Store a session key, encrypted to public_id."""
+        self.write('''INSERT INTO session_keys (key_id, public_id, wrapped_key)
+            VALUES (?,?,?)''', (key_id, public_id, wrapped_key))
+
+    def read_session_keys(self, key_ids):
+        """Get encrypted session keys.
+
+        Returns a dict with key id for keys and the session key,
+        encrypted to the public id, as value.
+        """
+        request = "SELECT key_id, wrapped_key FROM session_keys WHERE key_id = ?"
+        self.flush()
+        keys = {}
+        for key_id in key_ids:
+            for row in self.cursor.execute(request, (key_id,)):
+                keys[row[0]] = row[1]
+        return keys
+
+    def clean_session_keys(self, keep=None):
+        """Delete session keys not used by any registered file or chunk, except keep."""
+        self.flush()
+        self.cursor.execute("""DELETE FROM session_keys WHERE key_id IS NOT ? AND
+            key_id NOT IN (SELECT key_id FROM register WHERE key_id IS NOT NULL
+                           UNION SELECT key_id FROM chunks WHERE key_id IS NOT NULL)""",
+            (keep,))
+
+    def find_chunk(self, digest):
+        """Return the id of an encrypted chunk with the given digest, or None."""
+        self.flush()
+        self.cursor.execute("SELECT chunk_id FROM chunks WHERE digest = ?", (digest,))
+        row = self.cursor.fetchone()
+        return row[0] if row else None
+
+    def register_chunk(self, chunk_id, digest, length, key_id=None):
+        """Register an encrypted chunk.
+
+        key_id is the session key the chunk is encrypted with, or None
+        for a chunk encrypted to the public id.
+        """
+        self.write('''INSERT OR REPLACE INTO chunks (chunk_id, digest, length, key_id)
+            VALUES (?,?,?,?)''', (chunk_id, digest, length, key_id))
+
+    def read_chunk_keys(self, chunk_ids):
+        """Get the session keys chunks are encrypted with.
+
+        Returns a dict with chunk id for keys and key id, or None for
+        chunks encrypted to the public id, as value.
+        """
+        request = "SELECT chunk_id, key_id FROM chunks WHERE chunk_id = ?"
+        self.flush()
+        keys = {}
+        for chunk_id in set(chunk_ids):
+            for row in self.cursor.execute(request, (chunk_id,)):
+                keys[row[0]] = row[1]
+        return keys
+
+    def register_manifest(self, manifest_id, chunk_ids):
+        """Store the ordered list of chunks of a file."""
+        for seq, chunk_id in enumerate(chunk_ids):
+            self.write('''INSERT OR REPLACE INTO file_chunks
+                (manifest_id, seq, chunk_id) VALUES (?,?,?)''',
+                (manifest_id, seq, chunk_id))
+
+    def read_manifest(self, manifest_id):
+        """Get the ordered list of chunk ids of a file."""
+        request = "SELECT chunk_id FROM file_chunks WHERE manifest_id = ? ORDER BY seq"
+        self.flush()
+        return [row[0] for row in self.cursor.execute(request, (manifest_id,))]
+
+    def clean_manifest(self, manifest_id):
+        """Delete the chunk list of a file that has been replaced or removed."""
+        self.write("DELETE FROM file_chunks WHERE manifest_id = ?", (manifest_id,))
+
+    def read_unused_chunks(self):
+        """Get ids of chunks that are not in any chunk list."""
+        request = """SELECT chunk_id FROM chunks WHERE chunk_id NOT IN
+                     (SELECT chunk_id FROM file_chunks)"""
+        self.flush()
+        return [row[0] for row in self.cursor.execute(request)]
+
+    def clean_chunks(self, chunk_ids):
+        """Delete chunks that have been removed from the encrypted directory."""
+        for chunk_id in chunk_ids:
+            self.write("DELETE FROM chunks WHERE chunk_id = ?", (chunk_id,))
+
+    def read_dirstate(self):
+        """Get cached directory listings.
+
+        Returns a dict with relative directory path for keys, having
+        a tuple of directory mtime in nanoseconds and a list of
+        (name, kind) children as value.
+        """
+        dirstate = {}
+        self.flush()
+        for row in self.cursor.execute('SELECT path, mtime_ns, entries FROM dirstate'):
+            dirstate[row[0]] = (row[1], [tuple(child) for child in json.loads(row[2])])
+        return dirstate
+
+    def update_dirstate(self, changed, removed):
+        """Store changed directory listings and delete removed ones."""
+        for path, (mtime_ns, entries) in changed.items():
+            self.write('''INSERT OR REPLACE INTO dirstate
+                (path, mtime_ns, entries) VALUES (?,?,?)''',
+                (path, mtime_ns, json.dumps(entries)))
+        for path in removed:
+            self.write('DELETE FROM dirstate WHERE path = ?', (path,))
 
     def update_last_timestamp(self):
         """Update last timestamp in the database."""
@@ -126,14 +548,22 @@ class Inventory:
     def clean_record(self, filename):
         """Delete record based on the unencrypted filename."""
         request = "DELETE FROM register WHERE unencrypted_file = ?"
-        self.cursor.execute(request, (filename,))
-        
+        self.write(request, (filename,))
+
+    def clean_records(self, filenames):
+        """Delete records of all given unencrypted filenames."""
+        request = "DELETE FROM register WHERE unencrypted_file = ?"
+        for filename in filenames:
+            self.write(request, (filename,))
+
     def exists_encrypted_file(self, filename):
-        """Tests if an encoded filename exists in register.
+        """Tests if an encoded filename exists in register, or is a chunk.
         
         Returns True if 'filename' is found, False otherwise.
         """
-        request = "SELECT encrypted_file FROM register WHERE encrypted_file = ?"
-        self.cursor.execute(request, (filename,))
+        request = """SELECT encrypted_file FROM register WHERE encrypted_file = ?
+                     UNION ALL SELECT chunk_id FROM chunks WHERE chunk_id = ?"""
+        self.flush()
+        self.cursor.execute(request, (filename, filename))
         enc_filenames = self.cursor.fetchall()
         return bool(enc_filenames)
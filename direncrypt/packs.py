@@ -0,0 +1,100 @@
+#------------------------------------------------------------------------------
+# direncrypt - Sync contents between encrypted and decrypted directories
+# Copyright (C) 2015-2019  Domagoj Marsic
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Contact:
+# https://github.com/dmarsic
+# <dmars+github@protonmail.com>
+#------------------------------------------------------------------------------
+
+
+import io
+import os
+
+DEFAULT_PACK_SIZE = 4 * 1024 * 1024
+COPY_BLOCK_SIZE = 1024 * 1024
+
+
+def group_members(sizes, pack_size=DEFAULT_PACK_SIZE):
+    """Split files into groups to be stored in the same pack.
+
+    sizes is a dict with relative path for keys and file size for
+    values. Files are grouped in path order, so files of the same
+    directory tend to end up in the same pack. A group is closed once
+    it reaches pack_size.
+    """
+    groups = []
+    group = []
+    total = 0
+    for relative_path in sorted(sizes):
+        group.append(relative_path)
+        total += sizes[relative_path]
+        if total >= pack_size:
+            groups.append(group)
+            group = []
+            total = 0
+    if group:
+        groups.append(group)
+    return groups
+
+
+def read_members(root_dir, file_names):
+    """Concatenate files into the plaintext of a pack.
+
+    Returns a stream positioned at the start of the plaintext, a list
+    of (file name, offset, length) for files that were read, and a
+    list of file names that could not be read.
+    """
+    stream = io.BytesIO()
+    placed = []
+    missing = []
+    for file_name in file_names:
+        try:
+            with open(os.path.join(root_dir, file_name), 'rb') as f:
+                data = f.read()
+        except OSError as ose:
+            print('Failed to read {} : {}'.format(file_name, str(ose)))
+            missing.append(file_name)
+            continue
+        placed.append((file_name, stream.tell(), len(data)))
+        stream.write(data)
+    stream.seek(0)
+    return stream, placed, missing
+
+
+def extract_member(pack, offset, length, root_dir, file_name,
+                   block_size=COPY_BLOCK_SIZE):
+    """Copy a member of a decrypted pack into its own file.
+
+    pack is the decrypted pack opened in binary mode. Returns true if
+    successful, false otherwise.
+    """
+    path = os.path.join(root_dir, file_name)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        pack.seek(offset)
+        with open(path, 'wb') as f:
+            remaining = length
+            while remaining:
+                data = pack.read(min(block_size, remaining))
+                if not data:
+                    raise IOError('pack is shorter than expected')
+                f.write(data)
+                remaining -= len(data)
+    except OSError as ose:
+        print('Failed to create file {} : {}'.format(file_name, str(ose)))
+        return False
+    return True
@@ -0,0 +1,152 @@
+#------------------------------------------------------------------------------
+# direncrypt - Sync contents between encrypted and decrypted directories
+# Copyright (C) 2015-2019  Domagoj Marsic
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Contact:
+# https://github.com/dmarsic
+# <dmars+github@protonmail.com>
+#------------------------------------------------------------------------------
+
+import os
+import re
+
+
+class PathRules(object):
+    """Exclude rules for paths in the unencrypted directory.
+
+    Patterns follow gitignore syntax:
+
+    - a pattern without a slash matches a name at any depth,
+      e.g. 'node_modules' or '*.tmp'
+    - a pattern with a slash is matched against the path relative
+      to the unencrypted directory, e.g. '/build' or 'docs/*.pdf'
+    - a trailing slash matches directories only, e.g. '.git/'
+    - '*' and '?' do not match a slash, '**' matches any number of
+      directories
+    - a leading '!' includes again paths excluded by earlier patterns,
+      e.g. '*.log !keep.log'
+
+    The last matching pattern wins. Content of an excluded directory
+    is always excluded, as the directory is not walked at all.
+
+    All patterns are compiled into one regular expression for
+    directories and one for other paths.
+    """
+
+    def __init__(self, patterns=()):
+        """Compile a list of patterns."""
+        self.patterns = [p for p in patterns if p and not p.startswith('#')]
+        self.dir_regex = self.compile(self.patterns, is_dir=True)
+        self.file_regex = self.compile(self.patterns, is_dir=False)
+
+    @classmethod
+    def parse(cls, value):
+        """Build rules from a parameter value with whitespace-separated patterns."""
+        return cls((value or '').split())
+
+    def __bool__(self):
+        return bool(self.patterns)
+
+    @classmethod
+    def compile(cls, patterns, is_dir):
+        """Combine patterns into one regular expression.
+
+        Patterns are tried in reverse order, so the first alternative
+        that matches is the last matching pattern. Groups of negated
+        patterns are named 'i<n>', others 'e<n>'.
+        """
+        alternatives = []
+        for index in reversed(range(len(patterns))):
+            pattern = patterns[index]
+            name = 'e{}'.format(index)
+            if pattern.startswith('!'):
+                pattern = pattern[1:]
+                name = 'i{}'.format(index)
+            if pattern.endswith('/'):
+                if not is_dir:
+                    continue
+                pattern = pattern.rstrip('/')
+            if not pattern:
+                continue
+            if '/' in pattern:
+                body = cls.translate(pattern.lstrip('/'))
+            else:
+                body = '(?:.*/)?' + cls.translate(pattern)
+            alternatives.append('(?P<{}>{})'.format(name, body))
+        if not alternatives:
+            return None
+        return re.compile('(?:{})\\Z'.format('|'.join(alternatives)), re.DOTALL)
+
+    @staticmethod
+    def translate(pattern):
+        """Translate a single glob pattern to a regular expression."""
+        result = []
+        i, n = 0, len(pattern)
+        while i < n:
+            c = pattern[i]
+            i += 1
+            if c == '*':
+                if pattern[i:i + 1] == '*':
+                    i += 1
+                    if pattern[i:i + 1] == '/':
+                        i += 1
+                        result.append('(?:.*/)?')
+                    else:
+                        result.append('.*')
+                else:
+                    result.append('[^/]*')
+            elif c == '?':
+                result.append('[^/]')
+            elif c == '[':
+                j = pattern.find(']', i + 1)
+                if j == -1:
+                    result.append('\\[')
+                    continue
+                content = pattern[i:j].replace('\\', '\\\\')
+                if content.startswith('!'):
+                    content = '^' + content[1:]
+                result.append('[{}]'.format(content))
+                i = j + 1
+            elif c == '\\' and i < n:
+                result.append(re.escape(pattern[i]))
+                i += 1
+            else:
+                result.append(re.escape(c))
+        return ''.join(result)
+
+    def match(self, relative_path, is_dir=False):
+        """Check a path against the patterns, without its parent directories.
+
+        This is enough during a walk, where excluded directories are
+        never descended into.
+        """
+        regex = self.dir_regex if is_dir else self.file_regex
+        if regex is None:
+            return False
+        if os.sep != '/':
+            relative_path = relative_path.replace(os.sep, '/')
+        m = regex.match(relative_path)
+        return m is not None and m.lastgroup.startswith('e')
+
+    def is_excluded(self, relative_path, is_dir=False):
+        """Check a path and all its parent directories against the patterns."""
+        if not self.patterns:
+            return False
+        parts = relative_path.split(os.sep)
+        for depth in range(1, len(parts)):
+            if self.match(os.sep.join(parts[:depth]), is_dir=True):
+                return True
+        return self.match(relative_path, is_dir)
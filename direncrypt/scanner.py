@@ -0,0 +1,281 @@
+#------------------------------------------------------------------------------
+# direncrypt - Sync contents between encrypted and decrypted directories
+# Copyright (C) 2015-2019  Domagoj Marsic
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Contact:
+# https://github.com/dmarsic
+# <dmars+github@protonmail.com>
+#------------------------------------------------------------------------------
+
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+
+def fingerprint(statinfo):
+    """Return the stat fingerprint used to detect changed entries.
+
+    The fingerprint is a tuple of size, modification time in
+    nanoseconds, inode number and change time in nanoseconds.
+    """
+    return (statinfo.st_size, statinfo.st_mtime_ns,
+            statinfo.st_ino, statinfo.st_ctime_ns)
+
+
+class ScanResult(object):
+    """Everything found during a single walk of the unencrypted directory.
+
+    Regular files, symlinks and empty directories are kept in separate
+    dicts, with relative path for keys and the stat result of the entry
+    (not following symlinks) for values.
+
+    Directories that could not be listed and entries that could not be
+    stat'ed are kept in the failed set. Paths under them may be missing
+    from the result even though they still exist.
+    """
+
+    def __init__(self):
+        self.files = {}
+        self.links = {}
+        self.dirs = {}
+        self.failed = set()
+
+    def add(self, found):
+        """Add a list of (kind, relative path, stat result) entries.
+
+        Kind 'e' is an entry that could not be read, without stat result.
+        """
+        kinds = {'f': self.files, 'l': self.links, 'd': self.dirs}
+        for kind, relative_path, statinfo in found:
+            if kind == 'e':
+                self.failed.add(relative_path)
+            else:
+                kinds[kind][relative_path] = statinfo
+
+    def is_incomplete(self, relative_path):
+        """Check if a path may be missing because it or a parent failed to be read."""
+        if not self.failed:
+            return False
+        while True:
+            if relative_path in self.failed:
+                return True
+            if not relative_path:
+                return False
+            relative_path = os.path.dirname(relative_path)
+
+    def subset(self, paths):
+        """Return a new ScanResult with only the given paths."""
+        result = ScanResult()
+        result.failed = set(self.failed)
+        for relative_path in paths:
+            for found, entries in ((result.files, self.files),
+                                   (result.links, self.links),
+                                   (result.dirs, self.dirs)):
+                if relative_path in entries:
+                    found[relative_path] = entries[relative_path]
+        return result
+
+    def sort(self):
+        """Order all dicts by relative path."""
+        self.files = dict(sorted(self.files.items()))
+        self.links = dict(sorted(self.links.items()))
+        self.dirs = dict(sorted(self.dirs.items()))
+
+
+class TreeScanner(object):
+    """Walks a directory tree once, using os.scandir.
+
+    Each directory is read only once, and the type information cached
+    in os.DirEntry is used instead of separate islink/isdir calls.
+    Symlinks are never followed, so symlinks to directories are reported
+    as links and are not descended into.
+
+    If a dirstate is given, it is used as a cache of directory listings:
+    a dict with relative directory path for keys, and a tuple of the
+    directory mtime in nanoseconds and a list of (name, kind) children
+    for values. Directories whose mtime did not change are not listed
+    again. Their regular files and symlinks are still stat'ed, because
+    writing to a file does not change the mtime of its directory.
+
+    If rules are given, excluded entries are left out, and excluded
+    directories are not descended into.
+
+    On network and FUSE filesystems every listing and stat is a round
+    trip, so a walk is bound by latency rather than bandwidth. Setting
+    workers above 1 keeps that many requests in flight.
+    """
+
+    # Listings of directories modified this close to the start of the
+    # scan are not cached, as entries added within the same mtime tick
+    # would go unnoticed.
+    RACY_NS = 2 * 10**9
+
+    def __init__(self, root, dirstate=None, rules=None, workers=1):
+        """Set the root directory of the walk, optional dirstate and rules."""
+        self.root = root
+        self.dirstate = dirstate
+        self.rules = rules
+        self.workers = workers or 1
+        self.new_dirstate = {}
+
+    def scan(self, start=''):
+        """Walk the tree and return a ScanResult.
+
+        start is a directory relative to root to walk instead of the
+        whole tree; paths in the result are still relative to root.
+
+        With more than one worker, directories are listed and their
+        entries stat'ed in a thread pool. The result is sorted by path
+        either way, so it does not depend on the order of the walk.
+
+        Directories and entries that cannot be read are reported,
+        skipped and kept in the failed set of the result. The root
+        directory itself is never reported as an empty directory.
+        """
+        result = ScanResult()
+        self.new_dirstate = {}
+        self.start_ns = time.time_ns()
+        if self.workers > 1:
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                pending = {pool.submit(self.scan_directory, start, None)}
+                while pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        found, subdirs = future.result()
+                        result.add(found)
+                        for reldir, dir_entry in subdirs:
+                            pending.add(pool.submit(
+                                self.scan_directory, reldir, dir_entry))
+        else:
+            stack = [(start, None)]
+            while stack:
+                found, subdirs = self.scan_directory(*stack.pop())
+                result.add(found)
+                stack.extend(subdirs)
+        result.sort()
+        return result
+
+    def scan_directory(self, reldir, dir_entry):
+        """List a single directory and stat its entries.
+
+        Returns a list of (kind, relative path, stat result) for regular
+        files, symlinks and the directory itself if it is empty, and a
+        list of (relative path, DirEntry) for subdirectories to walk.
+        Entries that cannot be read have kind 'e', unless they have
+        been removed in the meantime.
+        """
+        found = []
+        subdirs = []
+        path = os.path.join(self.root, reldir) if reldir else self.root
+        try:
+            children = self.list_directory(reldir, path, dir_entry)
+            if reldir and self.is_empty(reldir, children):
+                found.append(('d', reldir, self.lstat(dir_entry, path)))
+                return found, subdirs
+        except OSError as ose:
+            print('Failed to scan directory {} : {}'.format(path, str(ose)))
+            if reldir == '' or not isinstance(ose, FileNotFoundError):
+                found.append(('e', reldir, None))
+            return found, subdirs
+
+        for name, kind, entry in children:
+            relative_path = os.path.join(reldir, name)
+            if self.rules and self.rules.match(relative_path, kind == 'd'):
+                continue
+            if kind == 'd':
+                subdirs.append((relative_path, entry))
+                continue
+            try:
+                found.append((kind, relative_path,
+                              self.lstat(entry, os.path.join(path, name))))
+            except FileNotFoundError:
+                # entry vanished between listing and stat
+                continue
+            except OSError as ose:
+                print('Failed to stat {} : {}'.format(relative_path, str(ose)))
+                found.append(('e', relative_path, None))
+        return found, subdirs
+
+    def is_empty(self, reldir, children):
+        """Check if a directory has no children left after the rules.
+
+        children is a list as returned by list_directory(). A directory
+        holding only excluded entries is reported as empty.
+        """
+        if not self.rules:
+            return not children
+        return all(self.rules.match(os.path.join(reldir, name), kind == 'd')
+                   for name, kind, _ in children)
+
+    def list_directory(self, reldir, path, dir_entry):
+        """Return a list of (name, kind, DirEntry) for a directory.
+
+        Kind is 'f' for regular files, 'l' for symlinks and 'd' for
+        directories; other entries are left out. DirEntry is None for
+        listings taken from the dirstate.
+        """
+        if self.dirstate is None:
+            return self.read_directory(path)
+
+        mtime_ns = self.lstat(dir_entry, path).st_mtime_ns
+        cached = self.dirstate.get(reldir)
+        if cached is not None and cached[0] == mtime_ns:
+            self.new_dirstate[reldir] = cached
+            return [(name, kind, None) for name, kind in cached[1]]
+
+        children = self.read_directory(path)
+        if mtime_ns >= self.start_ns - self.RACY_NS:
+            mtime_ns = None
+        self.new_dirstate[reldir] = (
+            mtime_ns, [(name, kind) for name, kind, _ in children])
+        return children
+
+    def read_directory(self, path):
+        """List a directory with os.scandir."""
+        children = []
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.is_symlink():
+                    kind = 'l'
+                elif entry.is_dir(follow_symlinks=False):
+                    kind = 'd'
+                elif entry.is_file(follow_symlinks=False):
+                    kind = 'f'
+                else:
+                    continue
+                children.append((entry.name, kind, entry))
+        return children
+
+    def lstat(self, entry, path):
+        """Stat an entry without following symlinks.
+
+        The DirEntry is used when available, path otherwise.
+        """
+        if entry is not None:
+            return entry.stat(follow_symlinks=False)
+        return os.lstat(path)
+
+    def dirstate_changes(self):
+        """Compare the dirstate built by the last scan with the given one.
+
+        Returns a dict of new or changed directory listings, and a list
+        of directories that are no longer in the tree.
+        """
+        old = self.dirstate or {}
+        changed = {reldir: state for reldir, state in self.new_dirstate.items()
+                   if old.get(reldir) != state}
+        removed = [reldir for reldir in old if reldir not in self.new_dirstate]
+        return changed, removed
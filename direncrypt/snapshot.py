@@ -0,0 +1,176 @@
+#------------------------------------------------------------------------------
+# direncrypt - Sync contents between encrypted and decrypted directories
+# Copyright (C) 2015-2019  Domagoj Marsic
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Contact:
+# https://github.com/dmarsic
+# <dmars+github@protonmail.com>
+#------------------------------------------------------------------------------
+
+
+import os
+import heapq
+import mmap
+import struct
+from direncrypt.scanner import fingerprint
+
+
+class ScanSnapshot(object):
+    """Compact on-disk copy of the last scan of the unencrypted directory.
+
+    The snapshot is a table of entries sorted by relative path, each
+    with the kind of the entry ('f', 'l' or 'd') and its stat
+    fingerprint. It is read through mmap and compared with a new scan
+    in a single merge pass, without building a dict of either side.
+
+    An entry is only written to the snapshot if the register is known
+    to match it, so an unchanged entry does not need its register
+    record at all.
+
+    File layout: a header with magic, number of register records at
+    the time of writing, number of entries and length of the
+    unencrypted directory path, followed by the path itself, followed
+    by entries. Each entry is an ENTRY struct followed by the relative
+    path.
+    """
+
+    MAGIC = b'DESNAP01'
+    HEADER = struct.Struct('<8sQQI')
+    ENTRY = struct.Struct('<cqqqqI')
+
+    def __init__(self, data):
+        """Parse the header of snapshot data, a bytes-like object."""
+        magic, self.register_count, self.count, length = \
+            self.HEADER.unpack_from(data, 0)
+        if magic != self.MAGIC:
+            raise ValueError('Not a scan snapshot')
+        offset = self.HEADER.size
+        self.plaindir = os.fsdecode(bytes(data[offset:offset + length]))
+        self.data = data
+        self.entries_offset = offset + length
+
+    @classmethod
+    def load(cls, filename):
+        """Map a snapshot file into memory.
+
+        Returns None if the file does not exist or cannot be read
+        as a snapshot.
+        """
+        try:
+            with open(filename, 'rb') as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+        try:
+            return cls(data)
+        except (struct.error, ValueError):
+            data.close()
+            return None
+
+    def close(self):
+        """Unmap the snapshot file."""
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    @classmethod
+    def write(cls, filename, scan, plaindir, register_count, skip=()):
+        """Write a ScanResult to a snapshot file.
+
+        Paths in skip are left out, so they are looked up in the
+        register again on the next run. The file is written under
+        a temporary name and renamed, so a failed write leaves the
+        previous snapshot in place.
+        """
+        plaindir = os.fsencode(plaindir)
+        entries = [entry for entry in cls.scan_entries(scan)
+                   if entry[0] not in skip]
+        tmp_filename = filename + '.tmp'
+        with open(tmp_filename, 'wb') as f:
+            f.write(cls.HEADER.pack(cls.MAGIC, register_count,
+                                    len(entries), len(plaindir)))
+            f.write(plaindir)
+            for relative_path, kind, statinfo in entries:
+                f.write(cls.pack_entry(relative_path, kind, statinfo))
+        os.replace(tmp_filename, filename)
+
+    @classmethod
+    def pack_entry(cls, relative_path, kind, statinfo):
+        """Return the bytes of a single entry."""
+        path = os.fsencode(relative_path)
+        return cls.ENTRY.pack(kind.encode(), *fingerprint(statinfo),
+                              len(path)) + path
+
+    @staticmethod
+    def scan_entries(scan):
+        """Iterate over (path, kind, stat result) of a ScanResult in path order."""
+        return heapq.merge(
+            ((path, 'f', statinfo) for path, statinfo in scan.files.items()),
+            ((path, 'l', statinfo) for path, statinfo in scan.links.items()),
+            ((path, 'd', statinfo) for path, statinfo in scan.dirs.items()),
+            key=lambda entry: entry[0])
+
+    def read_path(self, offset):
+        """Return the path of the entry at offset and the offset of the next one."""
+        length = self.ENTRY.unpack_from(self.data, offset)[5]
+        start = offset + self.ENTRY.size
+        return os.fsdecode(self.data[start:start + length]), start + length
+
+    def diff(self, scan):
+        """Compare a ScanResult with the snapshot in one merge pass.
+
+        scan must be sorted by path, as returned by TreeScanner.
+        Returns a list of paths that are new or changed in the scan,
+        and a list of paths that are in the snapshot only.
+
+        An unchanged entry is recognized by comparing its packed bytes
+        with the mapped snapshot; paths are only decoded from the
+        snapshot where entries differ.
+        """
+        changed = []
+        removed = []
+        offset = self.entries_offset
+        remaining = self.count
+        for relative_path, kind, statinfo in self.scan_entries(scan):
+            packed = self.pack_entry(relative_path, kind, statinfo)
+            while remaining:
+                if self.data[offset:offset + len(packed)] == packed:
+                    # same path, kind and fingerprint
+                    offset += len(packed)
+                    remaining -= 1
+                    break
+                old_path, next_offset = self.read_path(offset)
+                if old_path > relative_path:
+                    changed.append(relative_path)
+                    break
+                offset = next_offset
+                remaining -= 1
+                if old_path == relative_path:
+                    changed.append(relative_path)
+                    break
+                removed.append(old_path)
+            else:
+                changed.append(relative_path)
+        while remaining:
+            old_path, offset = self.read_path(offset)
+            removed.append(old_path)
+            remaining -= 1
+        return changed, removed
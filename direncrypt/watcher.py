@@ -0,0 +1,169 @@
+#------------------------------------------------------------------------------
+# direncrypt - Sync contents between encrypted and decrypted directories
+# Copyright (C) 2015-2019  Domagoj Marsic
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Contact:
+# https://github.com/dmarsic
+# <dmars+github@protonmail.com>
+#------------------------------------------------------------------------------
+
+import os
+import ctypes
+import ctypes.util
+import select
+import struct
+
+
+class InotifyWatcher(object):
+    """Collects changed paths under a directory tree with Linux inotify.
+
+    inotify is called through ctypes, so no additional package or
+    service is needed. Every directory of the tree gets its own watch,
+    and watches are added and removed as directories are created,
+    moved and deleted.
+
+    Paths are reported relative to the root directory. A directory
+    path means that the whole subtree has to be looked at, as events
+    inside a new directory may happen before it is watched.
+
+    Directories excluded by rules are not watched.
+    """
+
+    IN_MODIFY      = 0x00000002
+    IN_ATTRIB      = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM  = 0x00000040
+    IN_MOVED_TO    = 0x00000080
+    IN_CREATE      = 0x00000100
+    IN_DELETE      = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF   = 0x00000800
+    IN_Q_OVERFLOW  = 0x00004000
+    IN_IGNORED     = 0x00008000
+    IN_ONLYDIR     = 0x01000000
+    IN_DONTFOLLOW  = 0x02000000
+    IN_ISDIR       = 0x40000000
+    IN_NONBLOCK    = os.O_NONBLOCK
+    IN_CLOEXEC     = os.O_CLOEXEC
+
+    WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+                  IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF |
+                  IN_ONLYDIR | IN_DONTFOLLOW)
+
+    EVENT_HEADER = struct.Struct('iIII')
+    READ_SIZE = 64 * 1024
+
+    def __init__(self, root, rules=None):
+        """Initialize inotify and watch every directory under root."""
+        self.root = root
+        self.rules = rules
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                                use_errno=True)
+        self.fd = self.libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, 'inotify_init1: {}'.format(os.strerror(errno)))
+        self.watches = {}
+        self.watch_tree('')
+
+    def close(self):
+        """Close the inotify file descriptor, removing all watches."""
+        os.close(self.fd)
+        self.watches = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def watch_tree(self, reldir):
+        """Add a watch for a directory and all directories below it."""
+        top = os.path.join(self.root, reldir) if reldir else self.root
+        for (dirpath, dirnames, filenames) in os.walk(top):
+            relative_path = os.path.relpath(dirpath, self.root)
+            if relative_path == os.curdir:
+                relative_path = ''
+            if self.rules:
+                if relative_path and self.rules.is_excluded(relative_path, is_dir=True):
+                    dirnames[:] = []
+                    continue
+                dirnames[:] = [d for d in dirnames if not self.rules.match(
+                    os.path.join(relative_path, d), is_dir=True)]
+            wd = self.libc.inotify_add_watch(
+                self.fd, os.fsencode(dirpath), self.WATCH_MASK)
+            if wd < 0:
+                errno = ctypes.get_errno()
+                print('Failed to watch directory {} : {}'.format(
+                    dirpath, os.strerror(errno)))
+                continue
+            self.watches[wd] = relative_path
+
+    def unwatch_tree(self, reldir):
+        """Remove watches for a directory and all directories below it."""
+        prefix = reldir + os.sep
+        for wd, relative_path in list(self.watches.items()):
+            if relative_path == reldir or relative_path.startswith(prefix):
+                self.libc.inotify_rm_watch(self.fd, wd)
+                del self.watches[wd]
+
+    def read_events(self, timeout):
+        """Wait up to timeout seconds and return changed paths.
+
+        Returns a set of relative paths, or None if the kernel event
+        queue overflowed and events have been lost, in which case the
+        caller should do a full reconcile.
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return set()
+        try:
+            data = os.read(self.fd, self.READ_SIZE)
+        except BlockingIOError:
+            return set()
+        return self.parse_events(data)
+
+    def parse_events(self, data):
+        """Parse a buffer of inotify events into relative paths."""
+        paths = set()
+        overflow = False
+        offset = 0
+        while offset + self.EVENT_HEADER.size <= len(data):
+            wd, mask, cookie, length = self.EVENT_HEADER.unpack_from(data, offset)
+            offset += self.EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+
+            if mask & self.IN_Q_OVERFLOW:
+                overflow = True
+                continue
+            if mask & self.IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            reldir = self.watches.get(wd)
+            if reldir is None or not name:
+                continue
+
+            relative_path = os.path.join(reldir, name)
+            paths.add(relative_path)
+            if mask & self.IN_ISDIR:
+                if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                    self.watch_tree(relative_path)
+                elif mask & self.IN_MOVED_FROM:
+                    self.unwatch_tree(relative_path)
+        if overflow:
+            return None
+        return paths
@@ -44,7 +44,22 @@ Sample usage:
 
       encrypt.py -d
 
-(3) Program is not yet configured, or we want to override some
+(3) Program is already configured, keep encrypting files as they
+    change, using inotify (Linux only):
+
+      encrypt.py --watch
+
+(4) Program is already configured, encrypt only the files listed
+    in a file, or on standard input with '-':
+
+      find . -newer stamp -print0 | encrypt.py --from-list - --null
+
+(5) Program is already configured, rewrite packs of small files
+    that have mostly been replaced or deleted:
+
+      encrypt.py --repack
+
+(6) Program is not yet configured, or we want to override some
     parameters, and encrypt unencrypted files:
 
       encrypt.py --encrypt \
@@ -57,10 +72,12 @@ Sample usage:
                  --gpg-binary gpg2
 """
 
+import sys
 import argparse
 import getpass
 from direncrypt import DATABASE
 from direncrypt.configuration import RunConfig
+from direncrypt.database_builder import DatabaseBuilder
 from direncrypt.direncryption import DirEncryption
 
 
@@ -83,6 +100,18 @@ if __name__ == '__main__':
     parser.add_argument('-d', '--decrypt',
             action='store_true',
             help='Decrypt and transfer files from encrypted source')
+    parser.add_argument('-w', '--watch',
+            action='store_true',
+            help='Encrypt files as they change, using inotify (Linux only)')
+    parser.add_argument('-l', '--from-list',
+            metavar='FILE',
+            help='Encrypt only the paths listed in FILE, or stdin if FILE is -')
+    parser.add_argument('-0', '--null',
+            action='store_true',
+            help='Paths in the --from-list input are separated by NUL characters')
+    parser.add_argument('--repack',
+            action='store_true',
+            help='Rewrite packs of small files to reclaim unused space')
     parser.add_argument('--configure',
             action='store_true',
             help='Configure parameters interactively')
@@ -99,15 +128,47 @@ if __name__ == '__main__':
     parser.add_argument('-H', '--gpg-homedir', help='GPG home directory')
     parser.add_argument('-k', '--gpg-keyring', help='GPG keyring file')
     parser.add_argument('-b', '--gpg-binary',  help='GPG binary file')
+    parser.add_argument('-j', '--jobs',
+            type=int, default=1, metavar='N',
+            help='Number of files encrypted or decrypted at the same time')
+    parser.add_argument('--gpg-engine',
+            choices=['threads', 'asyncio'], default='threads',
+            help='Run gpg jobs in threads, or as asyncio subprocesses')
+    parser.add_argument('--scan-workers',
+            type=int, default=1, metavar='N',
+            help='Number of threads listing and stat\'ing directories')
+    parser.add_argument('--debounce',
+            type=float, default=2.0,
+            help='Seconds without events before changes are encrypted in watch mode')
+    parser.add_argument('--reconcile-interval',
+            type=float, default=3600.0,
+            help='Seconds between full encryption runs in watch mode')
 
     args = parser.parse_args()
 
+    database_builder = DatabaseBuilder(database)
+    if not args.configure and database_builder.exists():
+        database_builder.migrate()
+
     if args.configure:
         header()
         c = RunConfig(database=database)
     elif args.encrypt:
         e = DirEncryption(args, database=database)
         e.encrypt_all()
+    elif args.from_list:
+        e = DirEncryption(args, database=database)
+        if args.from_list == '-':
+            e.encrypt_list(sys.stdin.buffer, args.null)
+        else:
+            with open(args.from_list, 'rb') as f:
+                e.encrypt_list(f, args.null)
+    elif args.watch:
+        e = DirEncryption(args, database=database)
+        try:
+            e.watch(args.debounce, args.reconcile_interval)
+        except KeyboardInterrupt:
+            print('Stopped watching.')
     elif args.decrypt:
         if args.passphrase:
             passphrase = args.passphrase
@@ -115,7 +176,15 @@ if __name__ == '__main__':
             passphrase = getpass.getpass('Passphrase: ')
         e = DirEncryption(args, database=database)
         e.decrypt_all(passphrase)
+    elif args.repack:
+        if args.passphrase:
+            passphrase = args.passphrase
+        else:
+            passphrase = getpass.getpass('Passphrase: ')
+        e = DirEncryption(args, database=database)
+        e.repack(passphrase)
     else:
         header()
-        print('Please specify encrypt (-e) or decrypt (-d) operation,')
+        print('Please specify encrypt (-e), watch (-w), from list (-l)')
+        print('or decrypt (-d) or --repack operation,')
         print('or --configure to set up configuration.')
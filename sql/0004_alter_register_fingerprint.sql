@@ -0,0 +1,4 @@
+ALTER TABLE register ADD COLUMN size INTEGER;
+ALTER TABLE register ADD COLUMN mtime_ns INTEGER;
+ALTER TABLE register ADD COLUMN inode INTEGER;
+ALTER TABLE register ADD COLUMN ctime_ns INTEGER;
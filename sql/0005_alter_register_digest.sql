@@ -0,0 +1,2 @@
+ALTER TABLE register ADD COLUMN digest TEXT;
+INSERT INTO parameters (key, value) VALUES ('content_digest', '0');
@@ -0,0 +1,7 @@
+CREATE TABLE IF NOT EXISTS dirstate (
+    path                TEXT PRIMARY KEY,
+    mtime_ns            INTEGER,
+    entries             TEXT
+);
+
+INSERT INTO parameters (key, value) VALUES ('dirstate', '0');
@@ -0,0 +1 @@
+INSERT INTO parameters (key, value) VALUES ('snapshot', '0');
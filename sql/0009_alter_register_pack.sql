@@ -0,0 +1,10 @@
+ALTER TABLE register ADD COLUMN pack_offset INTEGER;
+ALTER TABLE register ADD COLUMN pack_length INTEGER;
+
+CREATE TABLE IF NOT EXISTS packs (
+    pack_id             TEXT PRIMARY KEY,
+    length              INTEGER
+);
+
+INSERT INTO parameters (key, value) VALUES ('pack_threshold', '0');
+INSERT INTO parameters (key, value) VALUES ('pack_size', '4194304');
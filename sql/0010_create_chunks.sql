@@ -0,0 +1,21 @@
+ALTER TABLE register ADD COLUMN chunked INTEGER;
+
+CREATE TABLE IF NOT EXISTS chunks (
+    chunk_id            TEXT PRIMARY KEY,
+    digest              TEXT,
+    length              INTEGER
+);
+
+CREATE INDEX IF NOT EXISTS chunks_digest ON chunks(digest);
+
+CREATE TABLE IF NOT EXISTS file_chunks (
+    manifest_id         TEXT,
+    seq                 INTEGER,
+    chunk_id            TEXT,
+    PRIMARY KEY (manifest_id, seq)
+);
+
+CREATE INDEX IF NOT EXISTS file_chunks_chunk ON file_chunks(chunk_id);
+
+INSERT INTO parameters (key, value) VALUES ('chunk_threshold', '0');
+INSERT INTO parameters (key, value) VALUES ('chunk_size', '1048576');
@@ -0,0 +1,4 @@
+INSERT INTO parameters (key, value) VALUES ('compress_algo', '');
+INSERT INTO parameters (key, value) VALUES ('compress_level', '');
+INSERT INTO parameters (key, value) VALUES ('compress_skip', NULL);
+INSERT INTO parameters (key, value) VALUES ('compress_probe', '1');
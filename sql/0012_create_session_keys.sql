@@ -0,0 +1,11 @@
+ALTER TABLE register ADD COLUMN key_id TEXT;
+
+CREATE TABLE IF NOT EXISTS session_keys (
+    key_id              TEXT PRIMARY KEY,
+    public_id           TEXT,
+    wrapped_key         TEXT,
+    created             DATETIME DEFAULT CURRENT_TIMESTAMP
+);
+
+INSERT INTO parameters (key, value) VALUES ('session_keys', '0');
+INSERT INTO parameters (key, value) VALUES ('session_key_lifetime', '86400');
@@ -0,0 +1,3 @@
+ALTER TABLE register ADD COLUMN backend TEXT;
+
+INSERT INTO parameters (key, value) VALUES ('backend', 'gpg');
@@ -0,0 +1,2 @@
+INSERT INTO parameters (key, value) VALUES ('sqlite_synchronous', 'NORMAL');
+INSERT INTO parameters (key, value) VALUES ('sqlite_cache_size', '-65536');
@@ -0,0 +1,10 @@
+ALTER TABLE register ADD COLUMN kind TEXT;
+
+UPDATE register SET kind = CASE
+    WHEN is_link = 1 THEN 'l'
+    WHEN encrypted_file IS NULL OR encrypted_file = '' THEN 'd'
+    ELSE 'f'
+END;
+
+CREATE INDEX IF NOT EXISTS register_kind ON register(kind);
+CREATE INDEX IF NOT EXISTS register_encrypted_file ON register(encrypted_file);
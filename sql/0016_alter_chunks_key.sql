@@ -0,0 +1 @@
+ALTER TABLE chunks ADD COLUMN key_id TEXT;
@@ -0,0 +1,150 @@
+#------------------------------------------------------------------------------
+# direncrypt - Sync contents between encrypted and decrypted directories
+# Copyright (C) 2015  Domagoj Marsic
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Contact:
+# https://github.com/dmarsic
+# <dmars+github@protonmail.com>
+#------------------------------------------------------------------------------
+
+import io
+import os
+import shutil
+import asyncio
+import tempfile
+import nose
+from nose.tools import eq_, ok_, assert_raises
+from mock import patch
+from direncrypt.backends import AEADBackend, Backend
+
+
+def setup_module():
+    if not AEADBackend.available():
+        raise nose.SkipTest('cryptography is not installed')
+
+
+def encrypt_decrypt(content, tamper=None, key='key'):
+    """Encrypt content with the aead backend, optionally change it, and decrypt it.
+
+    Returns the decryption result and the restored content, if any.
+    """
+    workdir = tempfile.mkdtemp()
+    try:
+        backend = AEADBackend()
+        encfile = os.path.join(workdir, 'encfile')
+        plainfile = os.path.join(workdir, 'restore', 'plainfile')
+        ok_(backend.encrypt_stream(io.BytesIO(content), encfile, session_key='key').ok)
+        if tamper is not None:
+            with open(encfile, 'rb') as f:
+                data = f.read()
+            with open(encfile, 'wb') as f:
+                f.write(tamper(data))
+        result = backend.decrypt(encfile, plainfile, key)
+        restored = None
+        if os.path.exists(plainfile):
+            with open(plainfile, 'rb') as f:
+                restored = f.read()
+        ok_(os.listdir(os.path.dirname(plainfile)) == (['plainfile'] if result.ok else []))
+        return result, restored
+    finally:
+        shutil.rmtree(workdir)
+
+
+def test_aead_roundtrip():
+    """Content of any length, including none, decrypts to itself."""
+    segment = AEADBackend.SEGMENT_SIZE
+    for size in (0, 1, segment - 1, segment, segment + 1, 3 * segment):
+        content = os.urandom(size)
+        result, restored = encrypt_decrypt(content)
+        ok_(result.ok)
+        eq_(restored, content)
+
+
+def test_aead_wrong_key():
+    """A wrong session key fails authentication and leaves no file behind."""
+    result, restored = encrypt_decrypt(b'content', key='other')
+    ok_(not result.ok)
+    ok_('Authentication failed' in result.stderr)
+
+
+def test_aead_damaged():
+    """Changed, truncated and extended files fail to decrypt."""
+    segment = AEADBackend.SEGMENT_SIZE + AEADBackend.TAG_SIZE
+    header = AEADBackend.HEADER_SIZE
+    content = os.urandom(2 * AEADBackend.SEGMENT_SIZE + 10)
+    for tamper in (lambda data: data[:-1] + bytes([data[-1] ^ 1]),
+                   lambda data: data[:header + segment],
+                   lambda data: data + data[header:header + segment],
+                   lambda data: data[:header] + data[header + segment:]):
+        result, restored = encrypt_decrypt(content, tamper)
+        ok_(not result.ok)
+        eq_(restored, None)
+
+
+def test_aead_not_encrypted():
+    """Files without the header are rejected."""
+    result, restored = encrypt_decrypt(b'content', lambda data: b'gpg data')
+    ok_(not result.ok)
+    ok_('Not encrypted' in result.stderr)
+
+
+def test_aead_needs_session_key():
+    """Nothing is written without a session key."""
+    workdir = tempfile.mkdtemp()
+    try:
+        result = AEADBackend().encrypt_stream(
+            io.BytesIO(b'content'), os.path.join(workdir, 'encfile'))
+        ok_(not result.ok)
+        eq_(os.listdir(workdir), [])
+    finally:
+        shutil.rmtree(workdir)
+
+
+def test_aead_async():
+    """Coroutines of in-process backends run the file operations in an executor."""
+    workdir = tempfile.mkdtemp()
+    try:
+        backend = AEADBackend()
+        plainfile = os.path.join(workdir, 'plainfile')
+        with open(plainfile, 'wb') as f:
+            f.write(b'plain content')
+        encfile = os.path.join(workdir, 'encfile')
+        restored = os.path.join(workdir, 'restore', 'plainfile')
+
+        ok_(asyncio.run(backend.encrypt_async(plainfile, encfile, 'key')).ok)
+        ok_(asyncio.run(backend.decrypt_async(encfile, restored, 'key')).ok)
+        with open(restored, 'rb') as f:
+            eq_(f.read(), b'plain content')
+    finally:
+        shutil.rmtree(workdir)
+
+
+def test_backend_abstract():
+    """A backend without the stream operations cannot be created."""
+    class EncryptOnly(Backend):
+        def encrypt_stream(self, stream, encfile, name=None, session_key=None):
+            pass
+
+    assert_raises(TypeError, EncryptOnly)
+
+
+@patch('direncrypt.backends.AESGCM', None)
+def test_aead_missing_cryptography():
+    """The aead backend cannot be created without the cryptography package."""
+    ok_(not AEADBackend.available())
+    with assert_raises(ImportError) as cm:
+        AEADBackend()
+    ok_('pipenv install cryptography' in str(cm.exception))
@@ -0,0 +1,58 @@
+#------------------------------------------------------------------------------
+# direncrypt - Sync contents between encrypted and decrypted directories
+# Copyright (C) 2015  Domagoj Marsic
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Contact:
+# https://github.com/dmarsic
+# <dmars+github@protonmail.com>
+#------------------------------------------------------------------------------
+import io
+import random
+import nose
+from nose.tools import *
+from direncrypt.chunks import chunk_limits, find_boundary, split_chunks
+
+
+def random_bytes(size, seed=0):
+    return random.Random(seed).randbytes(size)
+
+def test_split_chunks():
+    data = random_bytes(1 << 20)
+    chunks = list(split_chunks(io.BytesIO(data), avg_size=1 << 14))
+    min_size, max_size, _ = chunk_limits(1 << 14)
+
+    eq_(b''.join(chunks), data)
+    ok_(len(chunks) > 16)
+    for chunk in chunks[:-1]:
+        ok_(min_size <= len(chunk) <= max_size)
+
+def test_split_chunks__insertion():
+    """Only the chunk around an insertion changes."""
+    data = random_bytes(1 << 20)
+    edited = data[:300000] + b'inserted' + data[300000:]
+    before = list(split_chunks(io.BytesIO(data), avg_size=1 << 14))
+    after = list(split_chunks(io.BytesIO(edited), avg_size=1 << 14))
+
+    eq_(b''.join(after), edited)
+    ok_(len(set(after) - set(before)) <= 2)
+
+def test_split_chunks__empty():
+    eq_(list(split_chunks(io.BytesIO(b''))), [])
+
+def test_find_boundary__no_anchor():
+    """Content without boundaries is cut at the maximum size."""
+    eq_(find_boundary(bytearray(100), 0, 10, 40, 0), 40)
+    eq_(find_boundary(bytearray(30), 0, 10, 40, 0), 30)
@@ -0,0 +1,75 @@
+#------------------------------------------------------------------------------
+# direncrypt - Sync contents between encrypted and decrypted directories
+# Copyright (C) 2015  Domagoj Marsic
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Contact:
+# https://github.com/dmarsic
+# <dmars+github@protonmail.com>
+#------------------------------------------------------------------------------
+import io
+import os
+import nose
+from nose.tools import *
+from direncrypt.compression import DEFAULT_SKIP, CompressionPolicy
+
+
+def test_gpg_args__defaults():
+    policy = CompressionPolicy()
+    eq_(policy.gpg_args('notes.txt'), [])
+
+def test_gpg_args__algorithm_level():
+    policy = CompressionPolicy(algorithm='bzip2', level='9')
+    eq_(policy.gpg_args('notes.txt'), ['--compress-algo', 'bzip2', '--compress-level', '9'])
+
+def test_gpg_args__off():
+    policy = CompressionPolicy(algorithm='none')
+    eq_(policy.gpg_args('notes.txt'), ['--compress-algo', 'none'])
+
+def test_gpg_args__skip_extension():
+    policy = CompressionPolicy(algorithm='zlib', skip=['.jpg', '.MP4'])
+    eq_(policy.gpg_args(os.path.join('photos', 'a.JPG')), ['--compress-algo', 'none'])
+    eq_(policy.gpg_args('video.mp4'), ['--compress-algo', 'none'])
+    eq_(policy.gpg_args('jpg'), ['--compress-algo', 'zlib'])
+
+def test_gpg_args__probe():
+    policy = CompressionPolicy(probe=True)
+    random_data = io.BytesIO(os.urandom(2 * CompressionPolicy.PROBE_SIZE))
+    random_data.seek(10)
+    eq_(policy.gpg_args('blob', random_data), ['--compress-algo', 'none'])
+    eq_(random_data.tell(), 10)
+    text = io.BytesIO(b'hello world\n' * 1000)
+    eq_(policy.gpg_args('blob', text), [])
+    # too short to tell
+    eq_(policy.gpg_args('blob', io.BytesIO(os.urandom(100))), [])
+
+def test_from_parameters():
+    policy = CompressionPolicy.from_parameters({})
+    eq_(policy.skip, set(DEFAULT_SKIP.split()))
+    ok_(not policy.probe)
+
+    policy = CompressionPolicy.from_parameters({'compress_skip': None})
+    eq_(policy.skip, set(DEFAULT_SKIP.split()))
+
+    policy = CompressionPolicy.from_parameters({'compress_skip': ''})
+    eq_(policy.skip, set())
+
+    policy = CompressionPolicy.from_parameters({
+        'compress_algo': 'zlib', 'compress_level': '', 'compress_skip': '.iso',
+        'compress_probe': '1'})
+    eq_(policy.algorithm, 'zlib')
+    eq_(policy.level, None)
+    eq_(policy.skip, {'.iso'})
+    ok_(policy.probe)
@@ -38,6 +38,16 @@ def test_update(Inventory):
     eq_(parameters[0], 'key_1')
     eq_(parameters[1], 'value_1')
 
+@patch('direncrypt.configuration.Inventory')
+def test_sqlite_cache_size(Inventory):
+    cmdconfig = CmdConfig()
+    cmdconfig.do_set_database('test_database')
+    cmdconfig.do_sqlite_cache_size('64MB')
+    eq_(Inventory().__enter__().update_parameters.call_count, 0)
+
+    cmdconfig.do_sqlite_cache_size('-65536')
+    eq_(Inventory().__enter__().update_parameters.call_args[0], ('sqlite_cache_size', '-65536'))
+
 @patch('direncrypt.configuration.CmdConfig')
 def test_RunConfig(CmdConfig):
     runconfig = RunConfig()
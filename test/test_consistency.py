@@ -57,16 +57,16 @@ def test_check(exists, expanduser, Inventory):
         'securedir': 'test_securedir'
     }
 
-    Inventory().__enter__().read_register.return_value = {
-        'unenc_1': {
+    Inventory().__enter__().iter_register.return_value = [
+        {
             'unencrypted_file': 'unenc_1',
             'encrypted_file': 'uuid-1'
         },
-        'unenc_2': {
+        {
             'unencrypted_file': 'unenc_2',
             'encrypted_file': 'uuid-2'
         }
-    }
+    ]
 
     expanduser.side_effect = [
         os.path.join('test_plaindir', 'unenc_1'),
@@ -78,12 +78,10 @@ def test_check(exists, expanduser, Inventory):
     exists.side_effect = [True, True, False, True]
 
     c = ConsistencyCheck('test_database')
-    c.check()
+    checks = [(record['unencrypted_file'], unenc_check, enc_check)
+              for record, unenc_check, enc_check in c.check()]
 
-    ok_(c.registered_files['unenc_1']['unencrypted_file_check'])
-    ok_(c.registered_files['unenc_1']['encrypted_file_check'])
-    assert c.registered_files['unenc_2']['unencrypted_file_check']==False
-    ok_(c.registered_files['unenc_2']['encrypted_file_check'])
+    eq_(checks, [('unenc_1', True, True), ('unenc_2', False, True)])
 
 @patch('direncrypt.consistency.Inventory')
 def test_clean_registry(Inventory):
@@ -103,20 +101,16 @@ def test_loop_through(delete_file, DirEncryption, Inventory):
     between tests."""
     c = ConsistencyCheck('test_database')
     c.clean_registry = MagicMock()
-    c.registered_files = {
-        'unenc_1': {
+    c.check = lambda: iter([
+        ({
             'unencrypted_file'       : 'unenc_1',
-            'encrypted_file'         : 'enc_1',
-            'unencrypted_file_check' : False,
-            'encrypted_file_check'   : True
-        },
-        'unenc_2': {
+            'encrypted_file'         : 'enc_1'
+        }, False, True),
+        ({
             'unencrypted_file'       : 'unenc_2',
-            'encrypted_file'         : 'enc_2',
-            'unencrypted_file_check' : True,
-            'encrypted_file_check'   : False
-        }
-    }
+            'encrypted_file'         : 'enc_2'
+        }, True, False)
+    ])
 
     c.loop_through(clean=True)
     eq_(delete_file.call_count, 2)
@@ -133,6 +127,15 @@ def test_loop_through(delete_file, DirEncryption, Inventory):
     eq_(c.clean_registry.call_count, 0)
     eq_(DirEncryption.call_count, 1)
 
+    # a single DirEncryption restores all files
+    DirEncryption.reset_mock()
+    c.check = lambda: iter([
+        ({'unencrypted_file': name, 'encrypted_file': 'enc'}, False, True)
+        for name in ('unenc_1', 'unenc_2')])
+    c.loop_through(resync=True)
+    eq_(DirEncryption.call_count, 1)
+    eq_(DirEncryption().restore_record.call_count, 2)
+
 @patch('direncrypt.consistency.Inventory')
 @patch('direncrypt.consistency.FileOps.delete_file')
 @patch('direncrypt.consistency.os.walk')
@@ -164,3 +167,86 @@ def test_delete_orphans_encrypted_files_no_files(walk, delete_file, inv):
     inv().__enter__().exists_encrypted_file.return_value = True
     c.delete_orphans_encrypted_files()
     eq_(delete_file.call_count, 0)
+
+@patch('direncrypt.consistency.Inventory')
+@patch('direncrypt.consistency.os.path.exists')
+def test_check__excluded(exists, Inventory):
+    """Files excluded by the exclude rules are not checked."""
+    Inventory().__enter__().read_parameters.return_value = {
+        'plaindir': 'test_plaindir',
+        'securedir': 'test_securedir',
+        'exclude': 'cache/'
+    }
+    Inventory().__enter__().iter_register.return_value = [
+        {
+            'unencrypted_file': 'unenc_1',
+            'encrypted_file': 'uuid-1'
+        },
+        {
+            'unencrypted_file': os.path.join('cache', 'unenc_2'),
+            'encrypted_file': 'uuid-2'
+        }
+    ]
+    exists.return_value = True
+
+    c = ConsistencyCheck('test_database')
+    checks = list(c.check())
+
+    eq_([record['unencrypted_file'] for record, _, _ in checks], ['unenc_1'])
+    eq_(exists.call_count, 2)
+
+@patch('direncrypt.consistency.Inventory')
+@patch('direncrypt.consistency.os.path.exists')
+def test_check__scan_workers(exists, Inventory):
+    """Existence checks in a thread pool set the same flags."""
+    Inventory().__enter__().read_parameters.return_value = {
+        'plaindir': 'test_plaindir',
+        'securedir': 'test_securedir'
+    }
+    Inventory().__enter__().iter_register.return_value = [
+        {
+            'unencrypted_file': 'unenc_{}'.format(n),
+            'encrypted_file': 'uuid-{}'.format(n)
+        } for n in range(20)
+    ]
+    exists.side_effect = lambda path: path != os.path.join('test_securedir', 'uuid-7')
+
+    c = ConsistencyCheck('test_database', scan_workers=4)
+    c.BATCH_SIZE = 8
+    checks = list(c.check())
+
+    eq_(exists.call_count, 40)
+    eq_([(record['unencrypted_file'], unenc_check, enc_check)
+         for record, unenc_check, enc_check in checks],
+        [('unenc_{}'.format(n), True, n != 7) for n in range(20)])
+
+@patch('direncrypt.consistency.Inventory')
+@patch('direncrypt.consistency.os.path.exists')
+def test_check__chunked(exists, Inventory):
+    """A chunked file is complete only if all its chunks exist."""
+    Inventory().__enter__().read_parameters.return_value = {
+        'plaindir': 'test_plaindir',
+        'securedir': 'test_securedir'
+    }
+    Inventory().__enter__().iter_register.return_value = [
+        {
+            'unencrypted_file': 'unenc_1',
+            'encrypted_file': 'manifest-1',
+            'chunked': True
+        },
+        {
+            'unencrypted_file': 'unenc_2',
+            'encrypted_file': 'manifest-2',
+            'chunked': True
+        }
+    ]
+    Inventory().__enter__().read_manifest.side_effect = lambda manifest_id: {
+        'manifest-1': ['chunk-1', 'chunk-2'],
+        'manifest-2': ['chunk-1', 'chunk-3']}[manifest_id]
+    exists.side_effect = lambda path: path != os.path.join('test_securedir', 'chunk-3')
+
+    c = ConsistencyCheck('test_database')
+    checks = list(c.check())
+
+    ok_(checks[0][2])
+    ok_(not checks[1][2])
@@ -21,25 +21,31 @@
 #------------------------------------------------------------------------------
 
 import os
+import shutil
+import sqlite3
+import tempfile
 import nose
 from nose.tools import *
-from mock import patch, call
+from mock import patch
+from direncrypt import ROOTDIR
 from direncrypt.database_builder import DatabaseBuilder
 
 
 @patch('direncrypt.database_builder.glob')
 @patch('direncrypt.database_builder.sqlite3')
 @patch('direncrypt.database_builder.open')
-def test_build(open, sqlite3, glob):
-    """Test that database is built with sql files applied in sorted order."""
+@patch('direncrypt.database_builder.DatabaseBuilder.schema_version')
+def test_build(schema_version, open, sqlite3, glob):
+    """Test that database is built with sql files applied in numbered order."""
     database_file = 'database.sqlite'
     file_content = {
-        'file_c': 'content_c',
-        'file_a': 'content_a',
-        'file_b': 'content_b'
+        '0003_c.sql': 'content_c',
+        '0001_a.sql': 'content_a',
+        '0002_b.sql': 'content_b'
     }
 
-    glob.glob.return_value = ['file_c', 'file_a', 'file_b']
+    glob.glob.return_value = ['0003_c.sql', '0001_a.sql', '0002_b.sql']
+    schema_version.return_value = 0
     open.return_value.__enter__.return_value.read.side_effect = [
         file_content[key] for key in sorted(file_content.keys())
     ]
@@ -47,5 +53,126 @@ def test_build(open, sqlite3, glob):
     builder = DatabaseBuilder(database_file)
     builder.build()
 
-    calls = [call('content_a'), call('content_b'), call('content_c')]
-    sqlite3.connect.return_value.executescript.assert_has_calls(calls, any_order=False)
+    scripts = [c[0][0] for c in sqlite3.connect.return_value.executescript.call_args_list]
+    eq_(len(scripts), 3)
+    for script, content, version in zip(scripts, ['content_a', 'content_b', 'content_c'], [1, 2, 3]):
+        ok_(script.startswith('BEGIN;'))
+        ok_(content in script)
+        ok_(script.endswith('PRAGMA user_version = {};\nCOMMIT;'.format(version)))
+    ok_(not sqlite3.connect.return_value.backup.called)
+
+
+def make_sql_files(sqldir, scripts):
+    """Write SQL files named 0001_test.sql, 0002_test.sql, ... into sqldir."""
+    for number, script in enumerate(scripts, start=1):
+        with open(os.path.join(sqldir, '{:04}_test.sql'.format(number)), 'w') as f:
+            f.write(script)
+
+
+def test_migrate():
+    """Only pending files are applied, after a backup of the database."""
+    workdir = tempfile.mkdtemp()
+    try:
+        database = os.path.join(workdir, 'inventory.sqlite')
+        make_sql_files(workdir, ['CREATE TABLE register (a TEXT);',
+                                 'ALTER TABLE register ADD COLUMN b TEXT;'])
+        with patch.object(DatabaseBuilder, 'SQL_FILES_PATH', os.path.join(workdir, '*.sql')):
+            builder = DatabaseBuilder(database)
+            builder.build()
+            eq_(builder.migrate(), 0)
+            ok_(not os.path.exists(database + '.v2.bak'))
+
+            make_sql_files(workdir, ['CREATE TABLE register (a TEXT);',
+                                     'ALTER TABLE register ADD COLUMN b TEXT;',
+                                     'ALTER TABLE register ADD COLUMN c TEXT;'])
+            eq_(builder.migrate(), 1)
+
+        conn = sqlite3.connect(database)
+        eq_(conn.execute('PRAGMA user_version').fetchone()[0], 3)
+        eq_([row[1] for row in conn.execute('PRAGMA table_info(register)')], ['a', 'b', 'c'])
+        conn.close()
+        backup = sqlite3.connect(database + '.v2.bak')
+        eq_(backup.execute('PRAGMA user_version').fetchone()[0], 2)
+        backup.close()
+    finally:
+        shutil.rmtree(workdir)
+
+
+def test_migrate__legacy():
+    """A database without schema version has the first three files applied."""
+    workdir = tempfile.mkdtemp()
+    try:
+        database = os.path.join(workdir, 'inventory.sqlite')
+        conn = sqlite3.connect(database)
+        conn.execute('CREATE TABLE register (a TEXT)')
+        conn.close()
+        make_sql_files(workdir, ['DROP TABLE register;', '', '',
+                                 'ALTER TABLE register ADD COLUMN b TEXT;'])
+        with patch.object(DatabaseBuilder, 'SQL_FILES_PATH', os.path.join(workdir, '*.sql')):
+            eq_(DatabaseBuilder(database).migrate(), 1)
+
+        conn = sqlite3.connect(database)
+        eq_(conn.execute('PRAGMA user_version').fetchone()[0], 4)
+        eq_([row[1] for row in conn.execute('PRAGMA table_info(register)')], ['a', 'b'])
+        conn.close()
+        ok_(os.path.exists(database + '.v3.bak'))
+    finally:
+        shutil.rmtree(workdir)
+
+
+def test_migrate__failed():
+    """A failing file is rolled back and leaves the previous version."""
+    workdir = tempfile.mkdtemp()
+    try:
+        database = os.path.join(workdir, 'inventory.sqlite')
+        make_sql_files(workdir, ['CREATE TABLE register (a TEXT);',
+                                 'ALTER TABLE register ADD COLUMN b TEXT; INSERT INTO missing VALUES (1);'])
+        with patch.object(DatabaseBuilder, 'SQL_FILES_PATH', os.path.join(workdir, '*.sql')):
+            assert_raises(sqlite3.OperationalError, DatabaseBuilder(database).migrate)
+
+        conn = sqlite3.connect(database)
+        eq_(conn.execute('PRAGMA user_version').fetchone()[0], 1)
+        eq_([row[1] for row in conn.execute('PRAGMA table_info(register)')], ['a'])
+        conn.close()
+    finally:
+        shutil.rmtree(workdir)
+
+
+def test_migrate__numbering():
+    """SQL files must be numbered without gaps or duplicates."""
+    workdir = tempfile.mkdtemp()
+    try:
+        database = os.path.join(workdir, 'inventory.sqlite')
+        make_sql_files(workdir, ['CREATE TABLE register (a TEXT);'])
+        with open(os.path.join(workdir, '0003_gap.sql'), 'w') as f:
+            f.write('ALTER TABLE register ADD COLUMN b TEXT;')
+        with patch.object(DatabaseBuilder, 'SQL_FILES_PATH', os.path.join(workdir, '*.sql')):
+            assert_raises(ValueError, DatabaseBuilder(database).migrate)
+            os.rename(os.path.join(workdir, '0003_gap.sql'),
+                      os.path.join(workdir, '0001_duplicate.sql'))
+            assert_raises(ValueError, DatabaseBuilder(database).migrate)
+    finally:
+        shutil.rmtree(workdir)
+
+
+def test_migrate__legacy_intermediate():
+    """A legacy database built with more files than the first three is detected."""
+    workdir = tempfile.mkdtemp()
+    try:
+        database = os.path.join(workdir, 'inventory.sqlite')
+        conn = sqlite3.connect(database)
+        for sql_file in sorted(os.listdir(os.path.join(ROOTDIR, 'sql')))[:8]:
+            with open(os.path.join(ROOTDIR, 'sql', sql_file)) as f:
+                conn.executescript(f.read())
+        conn.close()
+
+        builder = DatabaseBuilder(database)
+        latest = len(builder.sql_files())
+        eq_(builder.migrate(), latest - 8)
+
+        conn = sqlite3.connect(database)
+        eq_(conn.execute('PRAGMA user_version').fetchone()[0], latest)
+        conn.close()
+        ok_(os.path.exists(database + '.v8.bak'))
+    finally:
+        shutil.rmtree(workdir)
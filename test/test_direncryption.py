@@ -20,11 +20,23 @@
 # <dmars+github@protonmail.com>
 #------------------------------------------------------------------------------
 
+import io
 import os
+import sqlite3
+import time
+import shutil
+import tempfile
+import asyncio
+import threading
 import nose
 from nose.tools import *
 from mock import Mock, MagicMock, patch
+from direncrypt import ROOTDIR
+from direncrypt.database_builder import DatabaseBuilder
 from direncrypt.direncryption import DirEncryption
+from direncrypt.fileops import FileOps
+from direncrypt.inventory import Inventory as RealInventory
+from direncrypt.scanner import ScanResult
 
 saved_params = {
     'last_timestamp': 1234567890,
@@ -46,6 +58,24 @@ test_args.public_id = None
 test_args.gpg_keyring = None
 test_args.gpg_homedir = None
 test_args.gpg_binary = None
+test_args.scan_workers = None
+test_args.jobs = None
+test_args.gpg_engine = None
+
+def iter_register(register):
+    """Serve a register dict through a mocked Inventory.iter_register."""
+    def kind(record):
+        if record['is_link']:
+            return 'links'
+        return 'files' if record['encrypted_file'] else 'dirs'
+
+    def side_effect(filter='all', order_by=None, batch_size=None):
+        records = [record for record in register.values()
+                   if filter in ('all', kind(record))]
+        if order_by:
+            records.sort(key=lambda record: record[order_by])
+        return iter(records)
+    return side_effect
 
 @patch('direncrypt.direncryption.GPGOps')
 @patch('direncrypt.direncryption.Inventory')
@@ -73,6 +103,20 @@ def test_set_parameters__from_param(expanduser, Inventory, GPGOps):
     eq_(de.gpg_binary, saved_params['gpg_binary'])
 
 
+@patch('direncrypt.direncryption.GPGOps')
+@patch('direncrypt.direncryption.Inventory')
+@patch('direncrypt.backends.AESGCM', None)
+def test_init__aead_unavailable(Inventory, GPGOps):
+    """A configured aead backend that cannot be used stops the run."""
+    Inventory().__enter__().read_parameters.return_value = dict(saved_params, backend='aead')
+    assert_raises(ImportError, DirEncryption, test_args)
+
+    Inventory().__enter__().read_parameters.return_value = saved_params
+    de = DirEncryption(test_args)
+    ok_(de.backend is de.gpg)
+    ok_('aead' not in de.backends)
+
+
 @patch('direncrypt.direncryption.GPGOps')
 @patch('direncrypt.direncryption.Inventory')
 @patch('direncrypt.direncryption.os.path.expanduser')
@@ -89,6 +133,9 @@ def test_set_parameters__from_args(expanduser, Inventory, GPGOps):
     args.gpg_keyring = 'runtime_gpg_keyring'
     args.gpg_homedir = 'runtime_gpg_homedir'
     args.gpg_binary = 'runtime_gpg_binary'
+    args.scan_workers = 4
+    args.jobs = 8
+    args.gpg_engine = 'asyncio'
 
     expanduser.side_effect = [
         args.plaindir,
@@ -112,6 +159,9 @@ def test_set_parameters__from_args(expanduser, Inventory, GPGOps):
     eq_(de.public_id, args.public_id)
     eq_(de.gpg_keyring, args.gpg_keyring)
     eq_(de.gpg_binary, args.gpg_binary)
+    eq_(de.scan_workers, 4)
+    eq_(de.jobs, 8)
+    eq_(de.gpg_engine, 'asyncio')
 
 
 @patch('direncrypt.direncryption.GPGOps')
@@ -132,7 +182,8 @@ def test_encrypt(expanduser, GPGOps):
     eq_(inventory.register.call_count, 1)
     de.gpg.encrypt.assert_called_once_with(
         os.path.join(saved_params['plaindir'], 'plainfile'),
-        os.path.join(saved_params['securedir'], 'securefile')
+        os.path.join(saved_params['securedir'], 'securefile'),
+        None
     )
 
 
@@ -172,28 +223,322 @@ def test_encrypt_all(maintenance, register_links, register_dirs, encrypt_files):
     eq_(register_dirs.call_count, 1)
     eq_(encrypt_files.call_count, 1)
 
+@patch('direncrypt.direncryption.GPGOps')
+@patch('direncrypt.direncryption.Inventory')
+@patch('direncrypt.direncryption.ScanSnapshot')
+@patch('direncrypt.direncryption.DirEncryption.scan_plaindir')
+@patch('direncrypt.direncryption.DirEncryption.encrypt_regular_files')
+@patch('direncrypt.direncryption.DirEncryption.do_inv_maintenance')
+def test_encrypt_all__snapshot(maintenance, encrypt_files, scan_plaindir,
+                               ScanSnapshot, Inventory, GPGOps):
+    """Only records of paths changed since the snapshot are read."""
+    params = dict(saved_params, snapshot='1')
+    inv = Inventory().__enter__()
+    inv.read_parameters.return_value = params
+    inv.count_register.return_value = 3
+    inv.read_register_paths.return_value = {}
+    scan = make_scan(files=['unchanged', 'changed', 'new'])
+    scan_plaindir.return_value = scan
+    snapshot = ScanSnapshot.load.return_value
+    snapshot.__enter__.return_value = snapshot
+    snapshot.plaindir = params['plaindir']
+    snapshot.register_count = 3
+    snapshot.diff.return_value = (['changed', 'new'], ['removed'])
+    encrypt_files.return_value = {'new'}
+
+    de = DirEncryption(test_args)
+    de.encrypt_all()
+
+    eq_(inv.read_register.call_count, 0)
+    inv.read_register_paths.assert_called_once_with(
+        ['changed', 'new', 'removed'], recursive=False)
+    eq_(sorted(encrypt_files.call_args[0][2].files), ['changed', 'new'])
+    eq_(maintenance.call_args[0][2], scan)
+    ScanSnapshot.write.assert_called_once_with(
+        de.snapshot_file, scan, params['plaindir'], 3, skip={'new'})
+
+
+@patch('direncrypt.direncryption.GPGOps')
+@patch('direncrypt.direncryption.Inventory')
+@patch('direncrypt.direncryption.ScanSnapshot')
+def test_load_snapshot__register_changed(ScanSnapshot, Inventory, GPGOps):
+    """Snapshot is not used if the register changed since it was written."""
+    inv = Inventory().__enter__()
+    inv.read_parameters.return_value = dict(saved_params, snapshot='1')
+    inv.count_register.return_value = 4
+    snapshot = ScanSnapshot.load.return_value
+    snapshot.plaindir = saved_params['plaindir']
+    snapshot.register_count = 3
+
+    de = DirEncryption(test_args)
+    eq_(de.load_snapshot(inv), None)
+    eq_(snapshot.close.call_count, 1)
+
+
 @patch('direncrypt.direncryption.GPGOps')
 @patch('direncrypt.direncryption.Inventory')
 @patch('direncrypt.direncryption.DirEncryption.find_unencrypted_files')
-@patch('direncrypt.direncryption.DirEncryption.encrypt')
+@patch('direncrypt.direncryption.DirEncryption.encrypt_file')
 @patch('direncrypt.direncryption.FileOps.delete_file')
-def test_encrypt_regular_files(delete_file, encrypt, find_ufiles, Inventory, GPGOps):
+def test_encrypt_regular_files(delete_file, encrypt_file, find_ufiles, Inventory, GPGOps):
 
     find_ufiles.return_value = {
-        'test_path_1': {'is_new': False},
-        'test_path_2': {'is_new': False},
-        'test_path_3': {'is_new': True}
+        'test_path_1': {'is_new': False, 'fingerprint': None},
+        'test_path_2': {'is_new': False, 'fingerprint': None},
+        'test_path_3': {'is_new': True, 'fingerprint': None}
     }
+    encrypt_file.return_value = MagicMock(ok=True)
+    inv = Inventory().__enter__()
+    register = {'test_path_1': {'pack': None, 'encrypted_file': 'old_1'},
+                'test_path_2': {'pack': None, 'encrypted_file': 'old_2'}}
+    # old versions are deleted once the new ones are committed
+    delete_file.side_effect = lambda securedir, encfile: ok_(inv.commit.called)
 
     de = DirEncryption(test_args)
-    de.encrypt_regular_files(Inventory().__enter__().read_register("all"), Inventory().__enter__())
+    de.pack_threshold = 0
+    de.chunk_threshold = 0
+    failed = de.encrypt_regular_files(register, inv)
 
-    eq_(encrypt.call_count, 3)
+    eq_(failed, set())
+    eq_(encrypt_file.call_count, 3)
+    eq_(inv.register.call_count, 3)
     eq_(delete_file.call_count, 2)
     eq_(find_ufiles.call_count, 1)
-    eq_(encrypt.call_args_list[0][0][0], 'test_path_1')
-    eq_(encrypt.call_args_list[1][0][0], 'test_path_2')
-    eq_(encrypt.call_args_list[2][0][0], 'test_path_3')
+    eq_(encrypt_file.call_args_list[0][0][0], 'test_path_1')
+    eq_(encrypt_file.call_args_list[1][0][0], 'test_path_2')
+    eq_(encrypt_file.call_args_list[2][0][0], 'test_path_3')
+    eq_(delete_file.call_args_list[0][0][1], 'old_1')
+
+
+@patch('direncrypt.direncryption.GPGOps')
+@patch('direncrypt.direncryption.Inventory')
+@patch('direncrypt.direncryption.DirEncryption.find_unencrypted_files')
+@patch('direncrypt.direncryption.DirEncryption.encrypt_file')
+@patch('direncrypt.direncryption.FileOps.delete_file')
+def test_encrypt_regular_files__failed(delete_file, encrypt_file, find_ufiles, Inventory, GPGOps):
+    """Old encrypted file is kept if the new one cannot be written."""
+    find_ufiles.return_value = {
+        'test_path_1': {'is_new': False, 'fingerprint': None},
+        'test_path_2': {'is_new': True, 'fingerprint': None}
+    }
+    encrypt_file.return_value = MagicMock(ok=False, stderr='error')
+    inv = MagicMock()
+
+    de = DirEncryption(test_args)
+    de.pack_threshold = 0
+    de.chunk_threshold = 0
+    failed = de.encrypt_regular_files({'test_path_1': {'pack': None, 'encrypted_file': 'old_1'}},
+                                      inv)
+
+    eq_(failed, {'test_path_1', 'test_path_2'})
+    eq_(delete_file.call_count, 0)
+    eq_(inv.register.call_count, 0)
+
+
+@patch('direncrypt.direncryption.GPGOps')
+@patch('direncrypt.direncryption.Inventory')
+@patch('direncrypt.direncryption.DirEncryption.find_unencrypted_files')
+@patch('direncrypt.direncryption.DirEncryption.encrypt_file')
+@patch('direncrypt.direncryption.FileOps.delete_file')
+def test_encrypt_regular_files__jobs(delete_file, encrypt_file, find_ufiles, Inventory, GPGOps):
+    """Files are encrypted in a thread pool and registered on the calling thread."""
+    files = {'test_path_{}'.format(n): {'is_new': True, 'fingerprint': (n, 0, 0, 0)}
+             for n in range(50)}
+    find_ufiles.return_value = files
+    main_thread = threading.current_thread()
+    workers = set()
+
+    def slow_encrypt(plainfile, encfile, session_key=None, backend=None):
+        workers.add(threading.current_thread())
+        time.sleep(0.001)
+        return MagicMock(ok=plainfile != 'test_path_7', stderr='error')
+
+    encrypt_file.side_effect = slow_encrypt
+    inv = MagicMock()
+    inv.register.side_effect = lambda *args, **kwargs: ok_(
+        threading.current_thread() is main_thread)
+
+    de = DirEncryption(test_args)
+    de.jobs = 4
+    de.pack_threshold = 0
+    de.chunk_threshold = 0
+    failed = de.encrypt_regular_files({}, inv)
+
+    eq_(failed, {'test_path_7'})
+    ok_(main_thread not in workers)
+    eq_(inv.register.call_count, 49)
+    eq_(sorted(call[0][0] for call in inv.register.call_args_list),
+        sorted(set(files) - {'test_path_7'}))
+    for call in inv.register.call_args_list:
+        eq_(call[0][5], files[call[0][0]]['fingerprint'])
+
+
+@patch('direncrypt.direncryption.GPGOps')
+@patch('direncrypt.direncryption.Inventory')
+@patch('direncrypt.direncryption.DirEncryption.find_unencrypted_files')
+@patch('direncrypt.direncryption.DirEncryption.encrypt_file')
+@patch('direncrypt.direncryption.FileOps')
+def test_encrypt_regular_files__digest(FileOps, encrypt_file, find_ufiles, Inventory, GPGOps):
+
+    Inventory().__enter__().read_parameters.return_value = dict(saved_params, content_digest='1')
+
+    find_ufiles.return_value = {
+        'test_path_1': {'is_new': False, 'fingerprint': (1, 2, 3, 4)},
+        'test_path_2': {'is_new': False, 'fingerprint': (5, 6, 7, 8)},
+        'test_path_3': {'is_new': True, 'fingerprint': (9, 10, 11, 12)}
+    }
+    register = {
+        'test_path_1': {'digest': 'digest_1', 'encrypted_file': 'old_1'},
+        'test_path_2': {'digest': 'digest_2', 'encrypted_file': 'old_2'}
+    }
+    FileOps.file_digest.side_effect = ['digest_1', 'digest_changed', 'digest_3']
+    encrypt_file.return_value = MagicMock(ok=True)
+    inv = MagicMock()
+
+    de = DirEncryption(test_args)
+    de.encrypt_regular_files(register, inv)
+
+    eq_(encrypt_file.call_count, 2)
+    eq_(FileOps.delete_file.call_count, 1)
+    inv.update_fingerprint.assert_called_once_with('test_path_1', (1, 2, 3, 4))
+    eq_(encrypt_file.call_args_list[0][0][0], 'test_path_2')
+    eq_(inv.register.call_args_list[0][0][6], 'digest_changed')
+    eq_(inv.register.call_args_list[1][0][6], 'digest_3')
+
+    # with jobs, digests are computed by the workers
+    main_thread = threading.current_thread()
+    threads = []
+
+    def file_digest(plaindir, plainfile):
+        threads.append(threading.current_thread())
+        return {'test_path_1': 'digest_1'}.get(plainfile, 'digest_changed')
+
+    FileOps.file_digest.side_effect = file_digest
+    inv.reset_mock()
+    de.jobs = 2
+    de.encrypt_regular_files(register, inv)
+    eq_(len(threads), 3)
+    ok_(main_thread not in threads)
+    inv.update_fingerprint.assert_called_once_with('test_path_1', (1, 2, 3, 4))
+    eq_(inv.register.call_count, 2)
+
+@patch('direncrypt.direncryption.GPGOps')
+@patch('direncrypt.direncryption.Inventory')
+@patch('direncrypt.direncryption.DirEncryption.find_unencrypted_files')
+@patch('direncrypt.direncryption.FileOps.delete_file')
+def test_encrypt_regular_files__digest_packs_chunks(delete_file, find_ufiles, Inventory, GPGOps):
+    """Packed and chunked files whose content did not change are kept."""
+    Inventory().__enter__().read_parameters.return_value = dict(saved_params, content_digest='1')
+    plaindir = tempfile.mkdtemp()
+    try:
+        for name, size in [('small', 5), ('large', 50)]:
+            with open(os.path.join(plaindir, name), 'wb') as f:
+                f.write(b'x' * size)
+        find_ufiles.return_value = {
+            name: {'is_new': False, 'fingerprint': (size, 1, 0, 0)}
+            for name, size in [('small', 5), ('large', 50)]}
+        register = {
+            'small': {'encrypted_file': 'pack-1', 'pack': (0, 5),
+                      'digest': FileOps.file_digest(plaindir, 'small')},
+            'large': {'encrypted_file': 'manifest-1', 'chunked': True,
+                      'digest': FileOps.file_digest(plaindir, 'large')}}
+        inv = MagicMock()
+        inv.find_chunk.return_value = 'chunk-1'
+
+        de = DirEncryption(test_args)
+        de.plaindir = plaindir
+        de.pack_threshold = 10
+        de.chunk_threshold = 20
+        eq_(de.encrypt_regular_files(register, inv), set())
+
+        eq_(de.gpg.encrypt_stream.call_count, 0)
+        eq_(inv.register.call_count, 0)
+        eq_(inv.register_manifest.call_count, 0)
+        eq_(inv.clean_manifest.call_count, 0)
+        eq_(sorted(c[0][0] for c in inv.update_fingerprint.call_args_list), ['large', 'small'])
+    finally:
+        shutil.rmtree(plaindir)
+
+
+@patch('direncrypt.direncryption.GPGOps')
+@patch('direncrypt.direncryption.Inventory')
+@patch('direncrypt.direncryption.time.monotonic')
+def test_current_session_key(monotonic, Inventory, GPGOps):
+    """A session key is made on first use, reused, and rotated after its lifetime."""
+    wrapped = MagicMock(ok=True)
+    wrapped.__str__.return_value = 'wrapped'
+    GPGOps.return_value.wrap_key.return_value = wrapped
+    monotonic.side_effect = [100, 150, 200, 200]
+    inv = MagicMock()
+
+    de = DirEncryption(test_args)
+    de.use_session_keys = True
+    de.session_key_lifetime = 100
+    key_id, session_key = de.current_session_key(inv)
+    eq_(de.current_session_key(inv), (key_id, session_key))
+    new_key_id, new_session_key = de.current_session_key(inv)
+
+    ok_(new_key_id != key_id)
+    ok_(new_session_key != session_key)
+    eq_(inv.register_session_key.call_args_list[0][0],
+        (key_id, de.public_id, 'wrapped'))
+    eq_(inv.register_session_key.call_count, 2)
+    GPGOps.return_value.wrap_key.assert_called_with(new_session_key)
+
+
+@patch('direncrypt.direncryption.GPGOps')
+@patch('direncrypt.direncryption.Inventory')
+@patch('direncrypt.direncryption.DirEncryption.find_unencrypted_files')
+@patch('direncrypt.direncryption.DirEncryption.encrypt_file')
+def test_encrypt_regular_files__session_key(encrypt_file, find_ufiles, Inventory, GPGOps):
+    """Files are encrypted with the session key, and registered with its id."""
+    find_ufiles.return_value = {
+        'test_path_1': {'is_new': True, 'fingerprint': None},
+        'test_path_2': {'is_new': True, 'fingerprint': None}
+    }
+    encrypt_file.return_value = MagicMock(ok=True)
+    GPGOps.return_value.wrap_key.return_value = MagicMock(ok=True)
+    inv = MagicMock()
+
+    de = DirEncryption(test_args)
+    de.pack_threshold = 0
+    de.chunk_threshold = 0
+    de.use_session_keys = True
+    de.encrypt_regular_files({}, inv)
+
+    key_id, session_key = de.session_key
+    eq_(inv.register_session_key.call_count, 1)
+    eq_([call[0][2] for call in encrypt_file.call_args_list], [session_key, session_key])
+    eq_([call[1]['key_id'] for call in inv.register.call_args_list], [key_id, key_id])
+
+
+@patch('direncrypt.direncryption.GPGOps')
+@patch('direncrypt.direncryption.Inventory')
+@patch('direncrypt.direncryption.DirEncryption.find_unencrypted_files')
+def test_encrypt_regular_files__backend(find_ufiles, Inventory, GPGOps):
+    """Files are encrypted by the configured backend with a session key, and
+    registered with the backend name."""
+    find_ufiles.return_value = {
+        'test_path_1': {'is_new': True, 'fingerprint': None}
+    }
+    GPGOps.return_value.wrap_key.return_value = MagicMock(ok=True)
+    inv = MagicMock()
+    aead = MagicMock()
+    aead.name = 'aead'
+    aead.encrypt.return_value = MagicMock(ok=True)
+
+    de = DirEncryption(test_args)
+    de.pack_threshold = 0
+    de.chunk_threshold = 0
+    de.use_session_keys = False
+    de.backends['aead'] = aead
+    de.backend = aead
+    de.encrypt_regular_files({}, inv)
+
+    key_id, session_key = de.session_key
+    eq_(aead.encrypt.call_args[0][2], session_key)
+    ok_(not de.gpg.encrypt.called)
+    eq_(inv.register.call_args[1], {'key_id': key_id, 'backend': 'aead'})
 
 
 @patch('direncrypt.direncryption.GPGOps')
@@ -205,8 +550,8 @@ def test_register_empty_dirs(find_udirs, register, Inventory, GPGOps):
     Inventory().__enter__().read_parameters.return_value = saved_params
 
     find_udirs.return_value = {
-        'test_dir_1': {'is_new': False},
-        'test_dir_2': {'is_new': True}
+        'test_dir_1': {'is_new': False, 'fingerprint': None},
+        'test_dir_2': {'is_new': True, 'fingerprint': None}
     }
 
     de = DirEncryption(test_args)
@@ -223,8 +568,8 @@ def test_register_empty_dirs(find_udirs, register, Inventory, GPGOps):
 def test_register_symlinks(register, find_ulinks, Inventory, GPGOps):
 
     find_ulinks.return_value = {
-        'test_link_1': {'target': 'target_1', 'is_new': False},
-        'test_link_2': {'target': 'target_2', 'is_new': True}
+        'test_link_1': {'target': 'target_1', 'is_new': False, 'fingerprint': None},
+        'test_link_2': {'target': 'target_2', 'is_new': True, 'fingerprint': None}
     }
 
     de = DirEncryption(test_args)
@@ -271,6 +616,27 @@ def test_decrypt(expanduser, Inventory, GPGOps):
     )
 
 
+@patch('direncrypt.direncryption.GPGOps')
+@patch('direncrypt.direncryption.Inventory')
+def test_decrypt__backend(Inventory, GPGOps):
+    """Every file is decrypted by the backend named in its record."""
+    Inventory().__enter__().read_parameters.return_value = saved_params
+    aead = MagicMock()
+
+    de = DirEncryption(test_args)
+    de.backends['aead'] = aead
+    ok_(de.decrypt('enc_1', 'plain_1', 'sessionkey', 'aead'))
+    ok_(de.decrypt('enc_2', 'plain_2', 'trustno1', 'gpg'))
+    ok_(de.decrypt('enc_3', 'plain_3', 'trustno1'))
+    ok_(not de.decrypt('enc_4', 'plain_4', 'trustno1', 'unknown'))
+
+    eq_(aead.decrypt.call_count, 1)
+    eq_(aead.decrypt.call_args[0][2], 'sessionkey')
+    eq_([call[0][0] for call in de.gpg.decrypt.call_args_list],
+        [os.path.join(saved_params['securedir'], 'enc_2'),
+         os.path.join(saved_params['securedir'], 'enc_3')])
+
+
 @patch('direncrypt.direncryption.GPGOps')
 @patch('direncrypt.direncryption.Inventory')
 @patch('direncrypt.direncryption.os.path.expanduser')
@@ -288,7 +654,7 @@ def test_decrypt_all__no_files(decrypt, expanduser,
         saved_params['gpg_binary']
     ]
 
-    Inventory().__enter__().read_register.return_value = {}
+    Inventory().__enter__().iter_register.side_effect = iter_register({})
 
     de = DirEncryption(test_args)
     de.decrypt_all('trustno1')
@@ -314,7 +680,7 @@ def test_decrypt_all(create_symlink, decrypt, expanduser, Inventory, GPGOps):
         saved_params['gpg_binary']
     ]
 
-    Inventory().__enter__().read_register.return_value = {
+    Inventory().__enter__().iter_register.side_effect = iter_register({
         'unenc_1': {
             'unencrypted_file': 'unenc_1',
             'encrypted_file': 'uuid-1',
@@ -351,22 +717,172 @@ def test_decrypt_all(create_symlink, decrypt, expanduser, Inventory, GPGOps):
             'target': 'target_5'
         }
 
-    }
+    })
 
     de = DirEncryption(test_args)
     de.decrypt_all('trustno1')
 
     eq_(de.decrypt.call_count, 2)
     eq_(create_symlink.call_count, 2)
-    eq_(de.decrypt.call_args_list[0][0], ('uuid-1', 'unenc_1', 'trustno1'))
-    eq_(de.decrypt.call_args_list[1][0], ('uuid-3', 'unenc_3', 'trustno1'))
+    eq_(de.decrypt.call_args_list[0][0], ('uuid-1', 'unenc_1', 'trustno1', None))
+    eq_(de.decrypt.call_args_list[1][0], ('uuid-3', 'unenc_3', 'trustno1', None))
 
 
+@patch('direncrypt.direncryption.GPGOps')
+@patch('direncrypt.direncryption.Inventory')
+@patch('direncrypt.direncryption.DirEncryption.decrypt')
+@patch('direncrypt.direncryption.FileOps')
+def test_decrypt_all__jobs(FileOps, decrypt, Inventory, GPGOps):
+    """Directories are created first, files decrypted in a pool, symlinks last."""
+    Inventory().__enter__().read_parameters.return_value = saved_params
+    register = {
+        'unenc_{}'.format(n): {
+            'unencrypted_file': 'unenc_{}'.format(n),
+            'encrypted_file': 'uuid-{}'.format(n),
+            'public_id': saved_params['public_id'],
+            'is_link': 0,
+            'target': ''
+        } for n in range(20)
+    }
+    register['link'] = {'unencrypted_file': os.path.join('sub', 'link'),
+                        'encrypted_file': '', 'public_id': '',
+                        'is_link': 1, 'target': 'target'}
+    register['empty'] = {'unencrypted_file': 'empty', 'encrypted_file': '',
+                         'public_id': '', 'is_link': 0, 'target': ''}
+    Inventory().__enter__().iter_register.side_effect = iter_register(register)
+
+    events = []
+    FileOps.create_directory.side_effect = lambda root, name, parents: events.append(('d', name))
+    FileOps.create_symlink.side_effect = lambda root, name, target: events.append(('l', name))
+
+    def slow_decrypt(encfile, plainfile, phrase, backend=None):
+        time.sleep(0.001)
+        events.append(('f', plainfile))
+        if plainfile == 'unenc_3':
+            raise IOError('No space left on device')
+        return True
+
+    decrypt.side_effect = slow_decrypt
+
+    de = DirEncryption(test_args)
+    de.jobs = 4
+    de.decrypt_all('trustno1')
+
+    eq_(decrypt.call_count, 20)
+    eq_(events[0], ('d', 'empty'))
+    eq_(sorted(events[1:21]), sorted(('f', name) for name in register if name.startswith('unenc')))
+    eq_(events[21:], [('d', 'sub'), ('l', os.path.join('sub', 'link'))])
+
+
+@patch('direncrypt.direncryption.GPGOps')
+@patch('direncrypt.direncryption.Inventory')
+@patch('direncrypt.direncryption.DirEncryption.decrypt')
+def test_decrypt_all__session_keys(decrypt, Inventory, GPGOps):
+    """Each session key is decrypted once and used as the passphrase of its files."""
+    Inventory().__enter__().read_parameters.return_value = saved_params
+    register = {
+        'unenc_{}'.format(n): {
+            'unencrypted_file': 'unenc_{}'.format(n),
+            'encrypted_file': 'uuid-{}'.format(n),
+            'public_id': saved_params['public_id'],
+            'is_link': 0,
+            'target': '',
+            'key_id': key_id
+        } for n, key_id in enumerate(['key-1', 'key-1', None])
+    }
+    Inventory().__enter__().iter_register.side_effect = iter_register(register)
+    Inventory().__enter__().read_session_keys.return_value = {'key-1': 'wrapped'}
+    unwrapped = MagicMock(ok=True)
+    unwrapped.__str__.return_value = 'sessionkey'
+    GPGOps.return_value.unwrap_key.return_value = unwrapped
+    decrypt.return_value = True
+
+    de = DirEncryption(test_args)
+    de.decrypt_all('trustno1')
+
+    Inventory().__enter__().read_session_keys.assert_called_once_with(['key-1'])
+    GPGOps.return_value.unwrap_key.assert_called_once_with('wrapped', 'trustno1')
+    eq_(sorted(call[0] for call in decrypt.call_args_list),
+        [('uuid-0', 'unenc_0', 'sessionkey', None),
+         ('uuid-1', 'unenc_1', 'sessionkey', None),
+         ('uuid-2', 'unenc_2', 'trustno1', None)])
+
+    # restoring single records reuses the decrypted session key
+    de.restore_record(register['unenc_0'], 'trustno1')
+    de.restore_record(register['unenc_1'], 'trustno1')
+    eq_(GPGOps.return_value.unwrap_key.call_count, 1)
+    eq_(decrypt.call_args[0], ('uuid-1', 'unenc_1', 'sessionkey', None))
+
+
+@patch('direncrypt.direncryption.GPGOps')
+@patch('direncrypt.direncryption.Inventory')
+def test_run_jobs__asyncio(Inventory, GPGOps):
+    """Coroutines run in an event loop and results are yielded as they complete."""
+    running = []
+    peak = []
+
+    async def job(n):
+        running.append(n)
+        peak.append(len(running))
+        await asyncio.sleep(0.001 * (10 - n))
+        running.remove(n)
+        return n * 2
+
+    de = DirEncryption(test_args)
+    de.gpg_engine = 'asyncio'
+    de.jobs = 3
+    results = dict(de.run_jobs(None, ((n, (n,)) for n in range(10)), job))
+
+    eq_(results, {n: n * 2 for n in range(10)})
+    eq_(max(peak), 6)
+
+
+@patch('direncrypt.direncryption.GPGOps')
+@patch('direncrypt.direncryption.Inventory')
+@patch('direncrypt.direncryption.DirEncryption.find_unencrypted_files')
+def test_encrypt_regular_files__asyncio(find_ufiles, Inventory, GPGOps):
+    """The asyncio engine encrypts through GPGOps.encrypt_async."""
+    find_ufiles.return_value = {
+        'test_path_1': {'is_new': True, 'fingerprint': None},
+        'test_path_2': {'is_new': True, 'fingerprint': None}
+    }
+
+    async def encrypt_async(plainfile, encfile, session_key=None):
+        return MagicMock(ok=not plainfile.endswith('2'), stderr='error')
+
+    inv = MagicMock()
+    de = DirEncryption(test_args)
+    de.gpg_engine = 'asyncio'
+    de.pack_threshold = 0
+    de.chunk_threshold = 0
+    de.gpg.encrypt_async.side_effect = encrypt_async
+    failed = de.encrypt_regular_files({}, inv)
+
+    eq_(failed, {'test_path_2'})
+    eq_(de.gpg.encrypt.call_count, 0)
+    eq_(inv.register.call_count, 1)
+    eq_(inv.register.call_args[0][0], 'test_path_1')
+
+
+def make_scan(files=(), links=(), dirs=(), mtime=1234567895):
+    """Build a ScanResult with the same stat values for every entry."""
+    scan = ScanResult()
+    for entries, kind in ((files, scan.files), (links, scan.links), (dirs, scan.dirs)):
+        for name in entries:
+            kind[name] = MagicMock(st_mtime=mtime, st_ctime=mtime, st_size=10,
+                                   st_mtime_ns=mtime * 10**9, st_ino=100,
+                                   st_ctime_ns=mtime * 10**9)
+    return scan
+
+def stored_fingerprint(mtime=1234567885):
+    """Fingerprint of an entry scanned by make_scan() with the given mtime."""
+    return (10, mtime * 10**9, 100, mtime * 10**9)
+
 @patch('direncrypt.direncryption.GPGOps')
 @patch('direncrypt.direncryption.Inventory')
 @patch('direncrypt.direncryption.os.path.expanduser')
-@patch('direncrypt.direncryption.os.walk')
-def test_find_unencrypted_files__empty_dir(walk, expanduser, Inventory, GPGOps):
+@patch('direncrypt.direncryption.TreeScanner')
+def test_find_unencrypted_files__empty_dir(TreeScanner, expanduser, Inventory, GPGOps):
 
     Inventory().__enter__().read_parameters.return_value = saved_params
 
@@ -384,11 +900,12 @@ def test_find_unencrypted_files__empty_dir(walk, expanduser, Inventory, GPGOps):
             'encrypted_file': 'uuid-1',
             'public_id': saved_params['public_id'],
             'is_link': 0,
-            'target': ''
+            'target': '',
+            'fingerprint': stored_fingerprint()
         }
     }
 
-    walk.return_value = []
+    TreeScanner().scan.return_value = make_scan()
 
     de = DirEncryption(test_args)
     files = de.find_unencrypted_files(register)
@@ -399,10 +916,7 @@ def test_find_unencrypted_files__empty_dir(walk, expanduser, Inventory, GPGOps):
 @patch('direncrypt.direncryption.GPGOps')
 @patch('direncrypt.direncryption.Inventory')
 @patch('direncrypt.direncryption.os.path.expanduser')
-@patch('direncrypt.direncryption.os.walk')
-@patch('direncrypt.direncryption.os.stat')
-@patch('direncrypt.direncryption.os.path.islink')
-def test_find_unencrypted_files(islink, stat, walk, expanduser, Inventory, GPGOps):
+def test_find_unencrypted_files(expanduser, Inventory, GPGOps):
 
     Inventory().__enter__().read_parameters.return_value = saved_params
 
@@ -420,41 +934,99 @@ def test_find_unencrypted_files(islink, stat, walk, expanduser, Inventory, GPGOp
             'encrypted_file': 'uuid-1',
             'public_id': saved_params['public_id'],
             'is_link': 0,
-            'target': ''
+            'target': '',
+            'fingerprint': stored_fingerprint()
         }
     }
 
-    walk.return_value = [
-        (saved_params['plaindir'], ['subdir_1'], ['unenc_1', 'unenc_2', 'unenc_3']),
-        (os.path.join(saved_params['plaindir'], 'subdir_1'), [], ['unenc_4'])
-    ]
-
-    stat.return_value.st_mtime = 1234567895
-    islink.return_value = True
+    names = ['unenc_1', 'unenc_2', 'unenc_3', os.path.join('subdir_1', 'unenc_4')]
     de = DirEncryption(test_args)
-    files = de.find_unencrypted_files(register)
+
+    files = de.find_unencrypted_files(register, make_scan(links=names))
     eq_(len(files), 0)
 
-    islink.reset_mock()
-    islink.return_value = False
-    files = de.find_unencrypted_files(register)
+    files = de.find_unencrypted_files(register, make_scan(files=names))
     eq_(len(files), 4)
     ok_('unenc_3' in files.keys())
     ok_(os.path.join('subdir_1', 'unenc_4') in files.keys())
+    eq_(files['unenc_1']['is_new'], False)
 
-    stat.reset_mock()
-    stat.return_value.st_mtime = 1234567885
-    files = de.find_unencrypted_files(register)
+    files = de.find_unencrypted_files(register, make_scan(files=names, mtime=1234567885))
     eq_(len(files), 3)
+    ok_('unenc_1' not in files.keys())
+
+@patch('direncrypt.direncryption.GPGOps')
+@patch('direncrypt.direncryption.Inventory')
+def test_find_unencrypted_files__fingerprint(Inventory, GPGOps):
+
+    Inventory().__enter__().read_parameters.return_value = saved_params
+
+    stored = (10, 1234567885 * 10**9, 100, 1234567885 * 10**9)
+    register = {
+        'unenc_1': {
+            'unencrypted_file': 'unenc_1',
+            'encrypted_file': 'uuid-1',
+            'public_id': saved_params['public_id'],
+            'is_link': 0,
+            'target': '',
+            'fingerprint': stored
+        }
+    }
+
+    de = DirEncryption(test_args)
+
+    # older mtime than last run, but fingerprint differs
+    files = de.find_unencrypted_files(register, make_scan(files=['unenc_1'], mtime=1234567880))
+    eq_(list(files.keys()), ['unenc_1'])
+    eq_(files['unenc_1']['is_new'], False)
+    eq_(files['unenc_1']['fingerprint'], (10, 1234567880 * 10**9, 100, 1234567880 * 10**9))
+
+    files = de.find_unencrypted_files(register, make_scan(files=['unenc_1'], mtime=1234567885))
+    eq_(files, {})
+
+@patch('direncrypt.direncryption.GPGOps')
+@patch('direncrypt.direncryption.Inventory')
+def test_is_modified__upgraded_database(Inventory, GPGOps):
+    """Unchanged records of an upgraded database get a fingerprint, not a new encryption."""
+    Inventory().__enter__().read_parameters.return_value = saved_params
+    workdir = tempfile.mkdtemp()
+    try:
+        database = os.path.join(workdir, 'inventory.sqlite')
+        conn = sqlite3.connect(database)
+        for sql_file in sorted(os.listdir(os.path.join(ROOTDIR, 'sql')))[:3]:
+            with open(os.path.join(ROOTDIR, 'sql', sql_file)) as f:
+                conn.executescript(f.read())
+        for name in ('unenc_1', 'unenc_2', 'unenc_3'):
+            conn.execute("INSERT INTO register (unencrypted_file, encrypted_file, public_id, is_link, target) "
+                         "VALUES (?, 'uuid', 'public_id', 0, '')", (name,))
+        conn.commit()
+        conn.close()
+        DatabaseBuilder(database).migrate()
+
+        de = DirEncryption(test_args)
+        scan = make_scan(files=['unenc_1'], mtime=1234567880)
+        scan.files.update(make_scan(files=['unenc_2']).files)
+        # content changed in place and mtime set back
+        scan.files.update(make_scan(files=['unenc_3'], mtime=1234567880).files)
+        scan.files['unenc_3'].st_ctime = 1234567895
+        with RealInventory(database) as inv:
+            register = inv.read_register('files')
+            eq_(register['unenc_1']['fingerprint'], None)
+            files = de.find_unencrypted_files(register, scan)
+            eq_(sorted(files), ['unenc_2', 'unenc_3'])
+            de.store_missing_fingerprints(register, scan, inv)
+            register = inv.read_register('files')
+        eq_(register['unenc_1']['fingerprint'], stored_fingerprint(1234567880))
+        eq_(register['unenc_2']['fingerprint'], None)
+        eq_(register['unenc_3']['fingerprint'], None)
+    finally:
+        shutil.rmtree(workdir)
 
 @patch('direncrypt.direncryption.GPGOps')
 @patch('direncrypt.direncryption.Inventory')
 @patch('direncrypt.direncryption.os.path.expanduser')
-@patch('direncrypt.direncryption.os.walk')
-@patch('direncrypt.direncryption.os.stat')
-@patch('direncrypt.direncryption.os.path.islink')
 @patch('direncrypt.direncryption.os.readlink')
-def test_find_unregistered_links(readlink, islink, stat, walk, expanduser, Inventory, GPGOps):
+def test_find_unregistered_links(readlink, expanduser, Inventory, GPGOps):
 
     Inventory().__enter__().read_parameters.return_value = saved_params
 
@@ -472,40 +1044,33 @@ def test_find_unregistered_links(readlink, islink, stat, walk, expanduser, Inven
             'encrypted_file': '',
             'public_id': '',
             'is_link':1,
-            'target': 'target_1'
+            'target': 'target_1',
+            'fingerprint': stored_fingerprint()
         }
     }
 
-    walk.return_value = [
-        (saved_params['plaindir'], ['subdir_1'], ['unenc_1', 'unenc_2', 'unenc_3']),
-        (os.path.join(saved_params['plaindir'], 'subdir_1'), [], ['unenc_4'])
-    ]
-
-    stat.return_value.st_mtime = 1234567895
-    islink.return_value = True
+    names = ['unenc_1', 'unenc_2', 'unenc_3', 'subdir_1',
+             os.path.join('subdir_1', 'unenc_4')]
     readlink.return_value = 'my_target'
     de = DirEncryption(test_args)
-    links = de.find_unregistered_links(register)
-    eq_(len(links), 6)
+    links = de.find_unregistered_links(register, make_scan(links=names))
+    eq_(len(links), 5)
     ok_('unenc_3' in links.keys())
     ok_(os.path.join('subdir_1', 'unenc_4') in links.keys())
+    eq_(links['unenc_3']['target'], 'my_target')
 
-    stat.reset_mock()
-    stat.return_value.st_mtime = 1234567885
-    links = de.find_unregistered_links(register)
-    eq_(len(links), 5)
+    readlink.reset_mock()
+    links = de.find_unregistered_links(register, make_scan(links=names, mtime=1234567885))
+    eq_(len(links), 4)
+    eq_(readlink.call_count, 4)
 
-    islink.reset_mock()
-    islink.return_value = False
-    links = de.find_unregistered_links(register)
+    links = de.find_unregistered_links(register, make_scan(files=names))
     eq_(len(links), 0)
 
 @patch('direncrypt.direncryption.GPGOps')
 @patch('direncrypt.direncryption.Inventory')
 @patch('direncrypt.direncryption.os.path.expanduser')
-@patch('direncrypt.direncryption.os.walk')
-@patch('direncrypt.direncryption.os.stat')
-def test_find_unregistered_empty_dirs( stat, walk, expanduser, Inventory, GPGOps):
+def test_find_unregistered_empty_dirs(expanduser, Inventory, GPGOps):
 
     Inventory().__enter__().read_parameters.return_value = saved_params
 
@@ -523,44 +1088,28 @@ def test_find_unregistered_empty_dirs( stat, walk, expanduser, Inventory, GPGOps
             'encrypted_file': '',
             'public_id': '',
             'is_link': 0,
-            'target': ''
+            'target': '',
+            'fingerprint': stored_fingerprint()
         }
     }
 
-    walk.return_value = [
-        (saved_params['plaindir'], ['subdir_1'], ['unenc_1', 'unenc_2', 'unenc_3']),
-        (os.path.join(saved_params['plaindir'], 'subdir_1'), [], [])
-    ]
-
-    stat.return_value.st_mtime = 1234567895
     de = DirEncryption(test_args)
-    dirs = de.find_unregistered_empty_dirs(register)
+    dirs = de.find_unregistered_empty_dirs(register, make_scan(dirs=['subdir_1']))
     eq_(len(dirs), 1)
     ok_('subdir_1' in dirs.keys())
 
-    stat.reset_mock()
-    stat.return_value.st_mtime = 1234567885
-    dirs = de.find_unregistered_empty_dirs(register)
+    dirs = de.find_unregistered_empty_dirs(register, make_scan(dirs=['subdir_1'], mtime=1234567885))
     eq_(len(dirs), 0)
 
 @patch('direncrypt.direncryption.GPGOps')
 @patch('direncrypt.direncryption.Inventory')
-@patch('direncrypt.direncryption.os.path.expanduser')
 @patch('direncrypt.direncryption.os.path.isfile')
-@patch('direncrypt.direncryption.os.listdir')
-def test_clean_files(listdir, isfile, expanduser, Inventory, GPGOps):
+@patch('direncrypt.direncryption.FileOps.delete_file')
+def test_clean_files(delete_file, isfile, Inventory, GPGOps):
 
     Inventory().__enter__().read_parameters.return_value = saved_params
 
-    expanduser.side_effect = [
-        saved_params['plaindir'],
-        saved_params['securedir'],
-        saved_params['restoredir'],
-        saved_params['gpg_homedir'],
-        saved_params['gpg_binary']
-    ]
-
-    isfile.return_value = False
+    isfile.return_value = True
     inv = MagicMock()
     inv.read_register.return_value = {
         'unenc_1': {
@@ -579,28 +1128,20 @@ def test_clean_files(listdir, isfile, expanduser, Inventory, GPGOps):
         }
     }
     de = DirEncryption(test_args)
-    de.clean(inv)
-    eq_(inv.clean_record.call_count, 6)
+    de.clean(inv, scan=make_scan(files=['unenc_2']))
+    eq_(inv.read_register.call_count, 1)
+    inv.clean_records.assert_called_once_with(['unenc_1'])
+    delete_file.assert_called_once_with(saved_params['securedir'], 'uuid-1')
 
 @patch('direncrypt.direncryption.GPGOps')
 @patch('direncrypt.direncryption.Inventory')
-@patch('direncrypt.direncryption.os.path.expanduser')
-@patch('direncrypt.direncryption.os.path.islink')
-@patch('direncrypt.direncryption.os.listdir')
-def test_clean_links(listdir, islink, expanduser, Inventory, GPGOps):
+@patch('direncrypt.direncryption.os.path.isfile')
+@patch('direncrypt.direncryption.FileOps.delete_file')
+def test_clean_links(delete_file, isfile, Inventory, GPGOps):
 
     Inventory().__enter__().read_parameters.return_value = saved_params
 
-    expanduser.side_effect = [
-        saved_params['plaindir'],
-        saved_params['securedir'],
-        saved_params['restoredir'],
-        saved_params['gpg_homedir'],
-        saved_params['gpg_binary']
-    ]
-
-    inv = MagicMock()
-    inv.read_register.return_value = {
+    register = {
         'unenc_3': {
             'unencrypted_file': 'unenc_3',
             'encrypted_file': '',
@@ -616,28 +1157,21 @@ def test_clean_links(listdir, islink, expanduser, Inventory, GPGOps):
             'target': 'link_4'
         }
     }
-    islink.return_value = False
+    inv = MagicMock()
     de = DirEncryption(test_args)
-    de.clean(inv)
-    eq_(inv.clean_record.call_count, 6)
+    de.clean(inv, register, make_scan(files=['unenc_3']))
+    inv.read_register.assert_not_called()
+    inv.clean_records.assert_called_once_with(['unenc_4'])
+    eq_(delete_file.call_count, 0)
+    eq_(isfile.call_count, 0)
 
 @patch('direncrypt.direncryption.GPGOps')
 @patch('direncrypt.direncryption.Inventory')
-@patch('direncrypt.direncryption.os.path.expanduser')
-@patch('direncrypt.direncryption.os.path.isdir')
-@patch('direncrypt.direncryption.os.listdir')
-def test_clean_dirs(listdir, isdir, expanduser, Inventory, GPGOps):
+@patch('direncrypt.direncryption.DirEncryption.scan_plaindir')
+def test_clean_dirs(scan_plaindir, Inventory, GPGOps):
 
     Inventory().__enter__().read_parameters.return_value = saved_params
 
-    expanduser.side_effect = [
-        saved_params['plaindir'],
-        saved_params['securedir'],
-        saved_params['restoredir'],
-        saved_params['gpg_homedir'],
-        saved_params['gpg_binary']
-    ]
-
     inv = MagicMock()
     inv.read_register.return_value = {
         'unenc_5': {
@@ -653,17 +1187,7 @@ def test_clean_dirs(listdir, isdir, expanduser, Inventory, GPGOps):
             'public_id': '',
             'is_link': 0,
             'target': ''
-        }
-    }
-    isdir.return_value = False
-    de = DirEncryption(test_args)
-    de.clean(inv)
-    eq_(inv.clean_record.call_count, 6)
-
-    inv.reset_mock()
-    isdir.reset_mock()
-
-    inv.read_register.return_value = {
+        },
         'unenc_7': {
             'unencrypted_file': 'unenc_7',
             'encrypted_file': '',
@@ -672,7 +1196,390 @@ def test_clean_dirs(listdir, isdir, expanduser, Inventory, GPGOps):
             'target': ''
         }
     }
-    isdir.return_value = True
-    listdir.return_value = ['some_file']
+    # unenc_5 is still empty, unenc_6 was deleted, unenc_7 has been filled
+    scan_plaindir.return_value = make_scan(files=[os.path.join('unenc_7', 'file')],
+                                           dirs=['unenc_5'])
+    de = DirEncryption(test_args)
     de.clean(inv)
-    eq_(inv.clean_record.call_count, 3)
+    eq_(scan_plaindir.call_count, 1)
+    inv.clean_records.assert_called_once_with(['unenc_6', 'unenc_7'])
+
+@patch('direncrypt.direncryption.GPGOps')
+@patch('direncrypt.direncryption.Inventory')
+@patch('direncrypt.direncryption.os.path.isfile')
+@patch('direncrypt.direncryption.FileOps.delete_file')
+def test_remove_missing(delete_file, isfile, Inventory, GPGOps):
+
+    Inventory().__enter__().read_parameters.return_value = dict(saved_params, exclude='file_4 dir_3/')
+
+    register = {
+        'file_1': {'encrypted_file': 'uuid-1', 'is_link': 0},
+        'file_2': {'encrypted_file': 'uuid-2', 'is_link': 0},
+        'file_3': {'encrypted_file': 'uuid-3', 'is_link': 0},
+        'file_4': {'encrypted_file': 'uuid-4', 'is_link': 0},
+        'file_5': {'encrypted_file': 'pack-1', 'is_link': 0, 'pack': (0, 5)},
+        'link_1': {'encrypted_file': '', 'is_link': 1},
+        'dir_1': {'encrypted_file': '', 'is_link': 0},
+        'dir_2': {'encrypted_file': '', 'is_link': 0},
+        'dir_3': {'encrypted_file': '', 'is_link': 0}
+    }
+    # file_2 was deleted, file_3 is now a symlink, dir_2 is not empty,
+    # file_4 and dir_3 are excluded, file_5 was deleted but its pack is kept
+    scan = make_scan(files=['file_1'], links=['link_1', 'file_3'], dirs=['dir_1'])
+    isfile.return_value = True
+    inv = MagicMock()
+
+    de = DirEncryption(test_args)
+    de.remove_missing(register, scan, inv)
+
+    eq_(sorted(c[0][1] for c in delete_file.call_args_list), ['uuid-2', 'uuid-3'])
+    inv.clean_records.assert_called_once_with(['file_2', 'file_5', 'dir_2'])
+
+@patch('direncrypt.direncryption.GPGOps')
+@patch('direncrypt.direncryption.Inventory')
+@patch('direncrypt.direncryption.FileOps.delete_file')
+def test_remove_missing__unreadable_directory(delete_file, Inventory, GPGOps):
+    """Records under a directory that failed to scan are not removed."""
+    plaindir = tempfile.mkdtemp()
+    securedir = tempfile.mkdtemp()
+    try:
+        os.makedirs(os.path.join(plaindir, 'nfs'))
+        for name in ['file_1', os.path.join('nfs', 'a'), os.path.join('nfs', 'b')]:
+            with open(os.path.join(plaindir, name), 'w') as f:
+                f.write(name)
+        for encfile in ['uuid-1', 'uuid-a', 'uuid-b', 'uuid-2']:
+            open(os.path.join(securedir, encfile), 'w').close()
+        register = {
+            'file_1': {'encrypted_file': 'uuid-1', 'is_link': 0},
+            os.path.join('nfs', 'a'): {'encrypted_file': 'uuid-a', 'is_link': 0},
+            os.path.join('nfs', 'b'): {'encrypted_file': 'uuid-b', 'is_link': 0},
+            'file_2': {'encrypted_file': 'uuid-2', 'is_link': 0}
+        }
+        scandir = os.scandir
+        def failing_scandir(path):
+            if os.path.basename(path) == 'nfs':
+                raise OSError(5, 'Input/output error')
+            return scandir(path)
+
+        de = DirEncryption(test_args)
+        de.plaindir = plaindir
+        de.securedir = securedir
+        with patch('direncrypt.scanner.os.scandir', side_effect=failing_scandir):
+            scan = de.scan_plaindir()
+        inv = MagicMock()
+        de.remove_missing(register, scan, inv)
+    finally:
+        shutil.rmtree(plaindir)
+        shutil.rmtree(securedir)
+
+    eq_([c[0][1] for c in delete_file.call_args_list], ['uuid-2'])
+    inv.clean_records.assert_called_once_with(['file_2'])
+
+@patch('direncrypt.direncryption.GPGOps')
+@patch('direncrypt.direncryption.Inventory')
+def test_scan_paths__excluded_content(Inventory, GPGOps):
+    """A directory holding only excluded entries is empty for both scans."""
+    Inventory().__enter__().read_parameters.return_value = dict(saved_params, exclude='node_modules/')
+    plaindir = tempfile.mkdtemp()
+    try:
+        os.makedirs(os.path.join(plaindir, 'proj', 'node_modules'))
+        with open(os.path.join(plaindir, 'proj', 'node_modules', 'index.js'), 'w') as f:
+            f.write('index')
+
+        de = DirEncryption(test_args)
+        de.plaindir = plaindir
+        full = de.scan_plaindir()
+        from_list = de.scan_paths([], parents=['proj'])
+    finally:
+        shutil.rmtree(plaindir)
+
+    eq_(list(full.dirs), ['proj'])
+    eq_(list(from_list.dirs), ['proj'])
+
+@patch('direncrypt.direncryption.GPGOps')
+@patch('direncrypt.direncryption.Inventory')
+@patch('direncrypt.direncryption.DirEncryption.scan_paths')
+@patch('direncrypt.direncryption.DirEncryption.encrypt_regular_files')
+@patch('direncrypt.direncryption.DirEncryption.register_empty_dirs')
+@patch('direncrypt.direncryption.DirEncryption.register_symlinks')
+@patch('direncrypt.direncryption.DirEncryption.remove_missing')
+def test_sync_paths(remove_missing, register_links, register_dirs, encrypt_files,
+                    scan_paths, Inventory, GPGOps):
+
+    inv = Inventory().__enter__()
+    inv.read_register_paths.side_effect = [{'a': {}}, {'sub': {}}]
+
+    de = DirEncryption(test_args)
+    de.sync_paths(['a', os.path.join('sub', 'b'), 'sub', '', os.path.join('sub', 'dir', 'c')])
+
+    eq_(inv.read_register_paths.call_args_list[0][0][0],
+        {'a', 'sub', os.path.join('sub', 'b'), os.path.join('sub', 'dir', 'c')})
+    eq_(inv.read_register_paths.call_args_list[1][0][0], {os.path.join('sub', 'dir')})
+    eq_(inv.read_register_paths.call_args_list[1][1], {'recursive': False})
+    eq_(encrypt_files.call_args[0][0], {'a': {}, 'sub': {}})
+    eq_(remove_missing.call_count, 1)
+    inv.read_register.assert_not_called()
+
+@patch('direncrypt.direncryption.GPGOps')
+@patch('direncrypt.direncryption.Inventory')
+@patch('direncrypt.direncryption.DirEncryption.sync_paths')
+def test_encrypt_list(sync_paths, Inventory, GPGOps):
+
+    Inventory().__enter__().read_parameters.return_value = dict(saved_params, plaindir='/plain')
+
+    de = DirEncryption(test_args)
+    de.encrypt_list(io.BytesIO(b'a\r\n./sub/b\n\n/plain/c\n/other/d\n../e\n'))
+    eq_(sync_paths.call_args[0][0], {'a', os.path.join('sub', 'b'), 'c'})
+
+    de.encrypt_list(io.BytesIO(b'a\nb\0sub/c\0'), null_separated=True)
+    eq_(sync_paths.call_args[0][0], {'a\nb', os.path.join('sub', 'c')})
+
+
+def fake_encrypt_stream(stream, encfile, session_key=None):
+    """Store a pack as it is, in place of gpg."""
+    with open(encfile, 'wb') as f:
+        f.write(stream.read())
+    return MagicMock(ok=True)
+
+def fake_decrypt_data(encfile, phrase):
+    """Read a pack stored by fake_encrypt_stream."""
+    with open(encfile, 'rb') as f:
+        return MagicMock(ok=True, data=f.read())
+
+@patch('direncrypt.direncryption.GPGOps')
+@patch('direncrypt.direncryption.Inventory')
+@patch('direncrypt.direncryption.DirEncryption.find_unencrypted_files')
+@patch('direncrypt.direncryption.DirEncryption.encrypt_file')
+@patch('direncrypt.direncryption.FileOps.delete_file')
+def test_encrypt_regular_files__packs(delete_file, encrypt_file, find_ufiles, Inventory, GPGOps):
+    """Files below the threshold are encrypted together in packs."""
+    plaindir = tempfile.mkdtemp()
+    securedir = tempfile.mkdtemp()
+    try:
+        sizes = {'small_1': 4, 'small_2': 6, 'small_3': 3, 'large': 20}
+        for name, size in sizes.items():
+            with open(os.path.join(plaindir, name), 'wb') as f:
+                f.write(name[-1].encode() * size)
+        find_ufiles.return_value = {
+            name: {'is_new': name != 'small_1', 'fingerprint': (size, 0, 0, 0)}
+            for name, size in sizes.items()}
+        encrypt_file.return_value = MagicMock(ok=True)
+        inv = MagicMock()
+
+        de = DirEncryption(test_args)
+        de.plaindir = plaindir
+        de.securedir = securedir
+        de.pack_threshold = 10
+        de.pack_size = 8
+        de.chunk_threshold = 0
+        de.use_session_keys = True
+        de.gpg.encrypt_stream.side_effect = fake_encrypt_stream
+        failed = de.encrypt_regular_files({'small_1': {'pack': None, 'encrypted_file': 'old_1'}},
+                                          inv)
+
+        eq_(failed, set())
+        eq_(encrypt_file.call_count, 1)
+        eq_(encrypt_file.call_args[0][0], 'large')
+        eq_(de.gpg.encrypt_stream.call_count, 2)
+        key_id, session_key = de.session_key
+        eq_([c[1]['session_key'] for c in de.gpg.encrypt_stream.call_args_list],
+            [session_key, session_key])
+        eq_(delete_file.call_args_list[0][0][1], 'old_1')
+        eq_(inv.register_pack.call_count, 2)
+
+        members = {c[0][0]: (c[0][1], c[1]['pack']) for c in inv.register.call_args_list
+                   if c[1].get('pack')}
+        eq_(sorted(members), ['small_1', 'small_2', 'small_3'])
+        eq_(members['small_1'][0], members['small_2'][0])
+        eq_(members['small_2'][1], (4, 6))
+        eq_(set(c[1]['key_id'] for c in inv.register.call_args_list), {key_id})
+        with open(os.path.join(securedir, members['small_3'][0]), 'rb') as f:
+            eq_(f.read(), b'333')
+    finally:
+        shutil.rmtree(plaindir)
+        shutil.rmtree(securedir)
+
+@patch('direncrypt.direncryption.GPGOps')
+@patch('direncrypt.direncryption.Inventory')
+def test_decrypt_all__packs(Inventory, GPGOps):
+    """Each pack is decrypted once and split into its files."""
+    securedir = tempfile.mkdtemp()
+    restoredir = tempfile.mkdtemp()
+    try:
+        with open(os.path.join(securedir, 'pack-1'), 'wb') as f:
+            f.write(b'firstsecond')
+        record = {'encrypted_file': 'pack-1', 'public_id': 'param_public_id',
+                  'is_link': 0, 'target': ''}
+        Inventory().__enter__().iter_register.side_effect = iter_register({
+            'a': dict(record, unencrypted_file='a', pack=(0, 5)),
+            'sub/b': dict(record, unencrypted_file='sub/b', pack=(5, 6))
+        })
+
+        de = DirEncryption(test_args)
+        de.securedir = securedir
+        de.restoredir = restoredir
+        de.public_id = 'param_public_id'
+        de.gpg.decrypt_data.side_effect = fake_decrypt_data
+        de.decrypt_all('passphrase')
+
+        eq_(de.gpg.decrypt_data.call_count, 1)
+        eq_(de.gpg.decrypt.call_count, 0)
+        with open(os.path.join(restoredir, 'a'), 'rb') as f:
+            eq_(f.read(), b'first')
+        with open(os.path.join(restoredir, 'sub', 'b'), 'rb') as f:
+            eq_(f.read(), b'second')
+    finally:
+        shutil.rmtree(securedir)
+        shutil.rmtree(restoredir)
+
+@patch('direncrypt.direncryption.GPGOps')
+@patch('direncrypt.direncryption.Inventory')
+def test_repack(Inventory, GPGOps):
+    """Empty packs are deleted and sparse packs are rewritten together."""
+    securedir = tempfile.mkdtemp()
+    try:
+        for pack_id, data in [('pack-1', b'aaaaabbb'), ('pack-2', b'ccccdddd'),
+                              ('pack-3', b'eeee'), ('pack-4', b'ffffgggg')]:
+            with open(os.path.join(securedir, pack_id), 'wb') as f:
+                f.write(data)
+        inv = Inventory().__enter__()
+        inv.read_packs.return_value = {
+            'pack-1': (8, 3), 'pack-2': (8, 0), 'pack-3': (4, 1), 'pack-4': (8, 8)}
+        inv.read_pack_members.side_effect = lambda pack_id: {
+            'pack-1': {'b': {'pack': (5, 3)}},
+            'pack-3': {'e': {'pack': (0, 1), 'key_id': 'key-1'}}}[pack_id]
+        inv.read_session_keys.return_value = {'key-1': 'wrapped'}
+        unwrapped = MagicMock(ok=True)
+        unwrapped.__str__.return_value = 'sessionkey'
+
+        de = DirEncryption(test_args)
+        de.securedir = securedir
+        de.pack_size = 100
+        de.gpg.unwrap_key.return_value = unwrapped
+        de.gpg.encrypt_stream.side_effect = fake_encrypt_stream
+        de.gpg.decrypt_data.side_effect = fake_decrypt_data
+        de.repack('passphrase')
+
+        eq_([c[0][1] for c in de.gpg.decrypt_data.call_args_list],
+            ['passphrase', 'sessionkey'])
+        eq_(sorted(c[0][0] for c in inv.clean_pack.call_args_list),
+            ['pack-1', 'pack-2', 'pack-3'])
+        eq_(inv.register_pack.call_count, 1)
+        new_pack = inv.register_pack.call_args[0][0]
+        eq_(sorted(os.listdir(securedir)), sorted(['pack-4', new_pack]))
+        with open(os.path.join(securedir, new_pack), 'rb') as f:
+            eq_(f.read(), b'bbbe')
+        eq_([c[0] for c in inv.move_pack_member.call_args_list],
+            [('b', new_pack, (0, 3), None), ('e', new_pack, (3, 1), None)])
+        # members are committed to the new pack before old packs are deleted
+        eq_([name for name, args, kwargs in inv.mock_calls
+             if name in ('move_pack_member', 'commit', 'clean_pack')][-4:],
+            ['move_pack_member', 'commit', 'clean_pack', 'clean_pack'])
+    finally:
+        shutil.rmtree(securedir)
+
+@patch('direncrypt.direncryption.GPGOps')
+@patch('direncrypt.direncryption.Inventory')
+@patch('direncrypt.direncryption.DirEncryption.find_unencrypted_files')
+def test_encrypt_regular_files__chunked(find_ufiles, Inventory, GPGOps):
+    """Only chunks that are not registered yet are encrypted."""
+    plaindir = tempfile.mkdtemp()
+    securedir = tempfile.mkdtemp()
+    try:
+        data = os.urandom(200000)
+        with open(os.path.join(plaindir, 'large'), 'wb') as f:
+            f.write(data)
+        find_ufiles.return_value = {
+            'large': {'is_new': True, 'fingerprint': (len(data), 0, 0, 0)}}
+        chunks = {}
+        inv = MagicMock()
+        inv.find_chunk.side_effect = lambda digest: chunks.get(digest)
+        inv.register_chunk.side_effect = lambda chunk_id, digest, length, key_id: \
+            chunks.__setitem__(digest, chunk_id)
+
+        de = DirEncryption(test_args)
+        de.plaindir = plaindir
+        de.securedir = securedir
+        de.pack_threshold = 0
+        de.chunk_threshold = 100000
+        de.chunk_size = 16384
+        de.use_session_keys = True
+        de.gpg.encrypt_stream.side_effect = fake_encrypt_stream
+        eq_(de.encrypt_regular_files({}, inv), set())
+
+        # chunks are encrypted with the session key, which is registered with them
+        key_id, session_key = de.session_key
+        eq_(set(c[1]['session_key'] for c in de.gpg.encrypt_stream.call_args_list),
+            {session_key})
+        eq_(set(c[0][3] for c in inv.register_chunk.call_args_list), {key_id})
+        manifest_id, chunk_ids = inv.register_manifest.call_args[0]
+        eq_(inv.register.call_args[0][:2], ('large', manifest_id))
+        ok_(inv.register.call_args[1]['chunked'])
+        eq_(sorted(os.listdir(securedir)), sorted(set(chunk_ids)))
+        eq_(b''.join(open(os.path.join(securedir, c), 'rb').read() for c in chunk_ids),
+            data)
+
+        # change a few bytes in the middle of the file
+        with open(os.path.join(plaindir, 'large'), 'r+b') as f:
+            f.seek(100000)
+            f.write(b'changed')
+        find_ufiles.return_value = {
+            'large': {'is_new': False, 'fingerprint': (len(data), 1, 0, 0)}}
+        de.gpg.encrypt_stream.reset_mock()
+        register = {'large': {'encrypted_file': manifest_id, 'chunked': True}}
+        eq_(de.encrypt_regular_files(register, inv), set())
+
+        ok_(1 <= de.gpg.encrypt_stream.call_count <= 2)
+        inv.clean_manifest.assert_called_once_with(manifest_id)
+        new_chunk_ids = inv.register_manifest.call_args[0][1]
+        ok_(len(set(new_chunk_ids) & set(chunk_ids)) >= len(chunk_ids) - 2)
+    finally:
+        shutil.rmtree(plaindir)
+        shutil.rmtree(securedir)
+
+@patch('direncrypt.direncryption.GPGOps')
+@patch('direncrypt.direncryption.Inventory')
+def test_decrypt_all__chunked(Inventory, GPGOps):
+    """Chunks of a file are decrypted one by one and joined."""
+    securedir = tempfile.mkdtemp()
+    restoredir = tempfile.mkdtemp()
+    try:
+        for chunk_id, data in [('chunk-1', b'first '), ('chunk-2', b'second')]:
+            with open(os.path.join(securedir, chunk_id), 'wb') as f:
+                f.write(data)
+        Inventory().__enter__().iter_register.side_effect = iter_register({
+            'large': {'unencrypted_file': 'large', 'encrypted_file': 'manifest-1',
+                      'public_id': 'param_public_id', 'is_link': 0, 'target': '',
+                      'chunked': True}
+        })
+        Inventory().__enter__().read_manifest.return_value = ['chunk-1', 'chunk-2', 'chunk-1']
+        Inventory().__enter__().read_chunk_keys.return_value = {'chunk-1': None,
+                                                                'chunk-2': 'key-1'}
+        Inventory().__enter__().read_session_keys.return_value = {'key-1': 'wrapped'}
+        unwrapped = MagicMock(ok=True)
+        unwrapped.__str__.return_value = 'sessionkey'
+        GPGOps.return_value.unwrap_key.return_value = unwrapped
+        phrases = []
+
+        def decrypt_data(encfile, phrase):
+            phrases.append(phrase)
+            with open(encfile, 'rb') as f:
+                return MagicMock(ok=True, data=f.read())
+
+        de = DirEncryption(test_args)
+        de.securedir = securedir
+        de.restoredir = restoredir
+        de.public_id = 'param_public_id'
+        de.gpg.decrypt_data.side_effect = decrypt_data
+        de.gpg.temporary_path.side_effect = lambda path: path + '.tmp'
+        de.decrypt_all('passphrase')
+
+        eq_(de.gpg.decrypt.call_count, 0)
+        eq_(os.listdir(restoredir), ['large'])
+        with open(os.path.join(restoredir, 'large'), 'rb') as f:
+            eq_(f.read(), b'first secondfirst ')
+        eq_(phrases, ['passphrase', 'sessionkey', 'passphrase'])
+        GPGOps.return_value.unwrap_key.assert_called_once_with('wrapped', 'passphrase')
+    finally:
+        shutil.rmtree(securedir)
+        shutil.rmtree(restoredir)
@@ -20,6 +20,9 @@
 # <dmars+github@protonmail.com>
 #------------------------------------------------------------------------------
 
+import os
+import hashlib
+import tempfile
 import nose
 from nose.tools import *
 from mock import patch
@@ -64,3 +67,26 @@ def test_create_directory_os_error(mkdir):
     mkdir.side_effect = OSError('Boom!')
     r = FileOps.create_directory('test_dir', 'test_name')
     assert r == False
+
+@patch('direncrypt.fileops.os.makedirs')
+def test_create_directory_parents(makedirs):
+    """Parent directories are created too."""
+    r = FileOps.create_directory('test_dir', os.path.join('a', 'b'), parents=True)
+    assert r == True
+    makedirs.assert_called_once_with(os.path.join('test_dir', 'a', 'b'), exist_ok=True)
+
+def test_file_digest():
+    """Digest is computed over blocks smaller than the file."""
+    with tempfile.NamedTemporaryFile() as f:
+        f.write(b'x' * 100)
+        f.flush()
+        r = FileOps.file_digest(os.path.dirname(f.name), os.path.basename(f.name),
+                                block_size=7)
+    assert r == hashlib.sha256(b'x' * 100).hexdigest()
+
+@patch('direncrypt.fileops.open')
+def test_file_digest__os_error(open):
+    """Error while reading file."""
+    open.side_effect = OSError('Boom!')
+    r = FileOps.file_digest('test_dir', 'test_file')
+    assert r == None
@@ -20,10 +20,16 @@
 # <dmars+github@protonmail.com>
 #------------------------------------------------------------------------------
 
+import io
+import os
+import sys
+import shutil
+import asyncio
 import tempfile
 import nose
-from nose.tools import ok_
+from nose.tools import eq_, ok_
 from mock import MagicMock, patch
+from direncrypt.compression import CompressionPolicy
 from direncrypt.gpgops import GPGOps
 
 @patch('direncrypt.gpgops.gnupg.GPG')
@@ -32,7 +38,7 @@ def test_encrypt_ok(open, GPG):
     """Successful encryption sets 'ok' attribute to True."""
     crypt_result = MagicMock()
     crypt_result.ok = True
-    GPG.return_value.encrypt = crypt_result
+    GPG.return_value.encrypt_file.return_value = crypt_result
 
     g = GPGOps(gpg_recipient='B183CAFE')
     result = g.encrypt('plainfile', 'encryptedfile')
@@ -45,36 +51,235 @@ def test_encrypt_fail(open, GPG):
     """Unsuccessful encryption sets 'ok' attribute to False."""
     crypt_result = MagicMock()
     crypt_result.ok = False
-    GPG.return_value.encrypt = crypt_result
+    GPG.return_value.encrypt_file.return_value = crypt_result
 
     g = GPGOps(gpg_recipient='B183CAFE')
     result = g.encrypt('plainfile', 'encryptedfile')
-    not ok_(result.ok)
+    ok_(not result.ok)
 
 
 @patch('direncrypt.gpgops.gnupg.GPG')
 @patch('builtins.open')
-@patch('direncrypt.gpgops.os')
+def test_encrypt_streams(open, GPG):
+    """File handle is passed to gpg instead of the whole content."""
+    g = GPGOps(gpg_recipient='B183CAFE')
+    g.encrypt('plainfile', 'encryptedfile')
+
+    f = open.return_value.__enter__.return_value
+    GPG.return_value.encrypt_file.assert_called_once_with(
+        f, 'B183CAFE', armor=False, output='encryptedfile', extra_args=None)
+    ok_(not f.read.called)
+    ok_(not GPG.return_value.encrypt.called)
+    ok_(GPG.return_value.buffer_size == GPGOps.STREAM_BUFFER_SIZE)
+
+
+@patch('direncrypt.gpgops.gnupg.GPG')
+def test_encrypt_compression(GPG):
+    """Compression options of the policy are passed to gpg for each file."""
+    policy = CompressionPolicy(algorithm='zlib', level=6, skip=['.jpg'])
+    g = GPGOps(gpg_recipient='B183CAFE', compression=policy)
+
+    g.encrypt_stream(io.BytesIO(b'text'), 'encryptedfile', 'notes.txt')
+    eq_(GPG.return_value.encrypt_file.call_args[1]['extra_args'],
+        ['--compress-algo', 'zlib', '--compress-level', '6'])
+    g.encrypt_stream(io.BytesIO(b'image'), 'encryptedfile', 'photo.JPG')
+    eq_(GPG.return_value.encrypt_file.call_args[1]['extra_args'],
+        ['--compress-algo', 'none'])
+
+
+@patch('direncrypt.gpgops.gnupg.GPG')
+def test_encrypt_session_key(GPG):
+    """With a session key, content is encrypted symmetrically with it."""
+    g = GPGOps(gpg_recipient='B183CAFE')
+    stream = io.BytesIO(b'text')
+
+    g.encrypt_stream(stream, 'encryptedfile', session_key='sessionkey')
+    GPG.return_value.encrypt_file.assert_called_once_with(
+        stream, None, symmetric=True, passphrase='sessionkey', armor=False,
+        output='encryptedfile', extra_args=GPGOps.SESSION_KEY_OPTIONS)
+
+
+@patch('direncrypt.gpgops.gnupg.GPG')
+def test_wrap_unwrap_key(GPG):
+    """Session keys are encrypted to the recipient, and decrypted with the passphrase."""
+    g = GPGOps(gpg_recipient='B183CAFE')
+
+    g.wrap_key('sessionkey')
+    GPG.return_value.encrypt.assert_called_once_with(
+        'sessionkey', 'B183CAFE', armor=True)
+    g.unwrap_key('wrappedkey', 'phrase')
+    GPG.return_value.decrypt.assert_called_once_with(
+        'wrappedkey', passphrase='phrase')
+
+
+@patch('direncrypt.gpgops.gnupg.GPG')
+@patch('builtins.open')
+@patch('direncrypt.backends.os')
 def test_decrypt_ok(os, open, GPG):
     """Successful decryption sets 'ok' attribute to True."""
     crypt_result = MagicMock()
     crypt_result.ok = True
-    GPG.return_value.decrypt = crypt_result
+    GPG.return_value.decrypt_file.return_value = crypt_result
+    os.path.join.return_value = 'tmpfile'
+    os.path.lexists.return_value = False
 
     g = GPGOps(gpg_recipient='B183CAFE')
     result = g.decrypt('encryptedfile', 'plainfile', 'phrase')
     ok_(result.ok)
+    GPG.return_value.decrypt_file.assert_called_once_with(
+        open.return_value.__enter__.return_value,
+        passphrase='phrase', output='tmpfile')
+    os.replace.assert_called_once_with('tmpfile', 'plainfile')
+    ok_(not os.remove.called)
 
 
 @patch('direncrypt.gpgops.gnupg.GPG')
 @patch('builtins.open')
-@patch('direncrypt.gpgops.os')
+@patch('direncrypt.backends.os')
 def test_decrypt_fail(os, open, GPG):
     """Unsuccessful decryption sets 'ok' attribute to False."""
     crypt_result = MagicMock()
     crypt_result.ok = False
-    GPG.return_value.decrypt = crypt_result
+    GPG.return_value.decrypt_file.return_value = crypt_result
+    os.path.join.return_value = 'tmpfile'
+    os.path.lexists.return_value = True
 
     g = GPGOps(gpg_recipient='B183CAFE')
     result = g.decrypt('encryptedfile', 'plainfile', 'phrase')
-    not ok_(result.ok)
+    ok_(not result.ok)
+    ok_(not os.replace.called)
+    os.remove.assert_called_once_with('tmpfile')
+
+
+def test_decrypt_fail__no_partial_file():
+    """Failed decryption leaves neither plainfile nor temporary file."""
+    workdir = tempfile.mkdtemp()
+    try:
+        encfile = os.path.join(workdir, 'encryptedfile')
+        with open(encfile, 'wb') as f:
+            f.write(b'not gpg data')
+        plainfile = os.path.join(workdir, 'restore', 'plainfile')
+
+        def decrypt_file(f, passphrase, output):
+            with open(output, 'wb') as out:
+                out.write(b'partial')
+            return MagicMock(ok=False)
+
+        with patch('direncrypt.gpgops.gnupg.GPG') as GPG:
+            GPG.return_value.decrypt_file.side_effect = decrypt_file
+            g = GPGOps(gpg_recipient='B183CAFE')
+            result = g.decrypt(encfile, plainfile, 'phrase')
+
+        ok_(not result.ok)
+        ok_(os.listdir(os.path.dirname(plainfile)) == [])
+    finally:
+        shutil.rmtree(workdir)
+
+
+FAKE_GPG = """
+import os, sys
+args = sys.argv[1:]
+output = args[args.index('--output') + 1]
+if '--passphrase-fd' in args:
+    fd = int(args[args.index('--passphrase-fd') + 1])
+    if os.read(fd, 100) != b'phrase\\n':
+        sys.stderr.write('bad passphrase')
+        sys.exit(2)
+with open(output, 'wb') as f:
+    f.write(sys.stdin.buffer.read()[::-1])
+"""
+
+
+def make_async_gpgops(workdir):
+    """Return GPGOps running a fake gpg that reverses its input."""
+    script = os.path.join(workdir, 'fake_gpg.py')
+    with open(script, 'w') as f:
+        f.write('#!{}\n'.format(sys.executable) + FAKE_GPG)
+    os.chmod(script, 0o755)
+    with patch('direncrypt.gpgops.gnupg.GPG') as GPG:
+        g = GPGOps(gpg_recipient='B183CAFE', max_processes=2)
+    g.gpg.make_args.side_effect = lambda args, passphrase: [script] + args
+    g.gpg.version = (2, 2, 0)
+    g.gpg.encoding = 'utf-8'
+    return g
+
+
+def test_encrypt_decrypt_async():
+    """gpg subprocesses run by asyncio read the file as standard input."""
+    workdir = tempfile.mkdtemp()
+    try:
+        g = make_async_gpgops(workdir)
+        plainfile = os.path.join(workdir, 'plainfile')
+        with open(plainfile, 'wb') as f:
+            f.write(b'plain content')
+        encfile = os.path.join(workdir, 'encfile')
+        restored = os.path.join(workdir, 'restore', 'plainfile')
+
+        result = asyncio.run(g.encrypt_async(plainfile, encfile))
+        ok_(result.ok)
+        with open(encfile, 'rb') as f:
+            ok_(f.read() == b'tnetnoc nialp')
+        args = g.gpg.make_args.call_args[0][0]
+        ok_(args[:3] == ['--encrypt', '--recipient', 'B183CAFE'])
+
+        result = asyncio.run(g.decrypt_async(encfile, restored, 'phrase'))
+        ok_(result.ok)
+        with open(restored, 'rb') as f:
+            ok_(f.read() == b'plain content')
+        ok_(os.listdir(os.path.dirname(restored)) == ['plainfile'])
+    finally:
+        shutil.rmtree(workdir)
+
+
+def test_encrypt_async_session_key():
+    """With a session key, asyncio gpg encrypts symmetrically and reads the key from a pipe."""
+    workdir = tempfile.mkdtemp()
+    try:
+        g = make_async_gpgops(workdir)
+        plainfile = os.path.join(workdir, 'plainfile')
+        with open(plainfile, 'wb') as f:
+            f.write(b'plain content')
+        encfile = os.path.join(workdir, 'encfile')
+
+        result = asyncio.run(g.encrypt_async(plainfile, encfile, 'phrase'))
+        ok_(result.ok)
+        args = g.gpg.make_args.call_args[0][0]
+        ok_(args[0] == '--symmetric')
+        ok_('--recipient' not in args)
+        result = asyncio.run(g.encrypt_async(plainfile, encfile, 'wrong'))
+        ok_(not result.ok)
+    finally:
+        shutil.rmtree(workdir)
+
+
+def test_decrypt_async_fail():
+    """Failed decryption reports stderr and leaves no file behind."""
+    workdir = tempfile.mkdtemp()
+    try:
+        g = make_async_gpgops(workdir)
+        encfile = os.path.join(workdir, 'encfile')
+        with open(encfile, 'wb') as f:
+            f.write(b'content')
+        restored = os.path.join(workdir, 'restore', 'plainfile')
+
+        result = asyncio.run(g.decrypt_async(encfile, restored, 'wrong'))
+        ok_(not result.ok)
+        ok_('bad passphrase' in result.stderr)
+        ok_(os.listdir(os.path.dirname(restored)) == [])
+    finally:
+        shutil.rmtree(workdir)
+
+
+def test_process_limit():
+    """One semaphore per event loop limits the number of processes."""
+    with patch('direncrypt.gpgops.gnupg.GPG'):
+        g = GPGOps(gpg_recipient='B183CAFE', max_processes=3)
+
+    async def limits():
+        return g.process_limit(), g.process_limit()
+
+    first, second = asyncio.run(limits())
+    ok_(first is second)
+    ok_(first._value == 3)
+    other, _ = asyncio.run(limits())
+    ok_(other is not first)
@@ -20,10 +20,14 @@
 # <dmars+github@protonmail.com>
 #------------------------------------------------------------------------------
 
+import os
+import shutil
+import tempfile
 import nose
 from nose.tools import *
 from mock import MagicMock, patch
-from direncrypt.inventory import Inventory
+from direncrypt.database_builder import DatabaseBuilder
+from direncrypt.inventory import Inventory, RegisterRecord
 
 @patch('direncrypt.inventory.sqlite3')
 def test_inventory_enter(sqlite3):
@@ -55,10 +59,10 @@ def test_read_parameters(connect):
 def test_read_all_register(connect):
 
     connect().cursor().execute.return_value = [
-        ('unenc_1', 'uuid-1', 'public_id_1', 0, ''),
-        ('unenc_2', '', '', 1, 'target_2'),
-        ('unenc_3', '', '', 1, 'target_3'),
-        ('unenc_4', '', '', 0, '')
+        ('unenc_1', 'uuid-1', 'public_id_1', 0, '', None, None, None, None, None, None, None, None, None, None),
+        ('unenc_2', '', '', 1, 'target_2', None, None, None, None, None, None, None, None, None, None),
+        ('unenc_3', '', '', 1, 'target_3', None, None, None, None, None, None, None, None, None, None),
+        ('unenc_4', '', '', 0, '', None, None, None, None, None, None, None, None, None, None)
     ]
 
     with Inventory('test_database') as inv:
@@ -72,13 +76,14 @@ def test_read_all_register(connect):
     eq_(rows['unenc_2']['public_id'], '')
     eq_(rows['unenc_2']['is_link'], 1)
     eq_(rows['unenc_2']['target'], 'target_2')
+    eq_(rows['unenc_2']['fingerprint'], None)
 
 @patch('direncrypt.inventory.sqlite3.connect')
 def test_read_registered_files(connect):
 
     connect().cursor().execute.return_value = [
-        ('unenc_1', 'uuid-1', 'public_id_1', 0, ''),
-        ('unenc_2', 'uuid-2', 'public_id_2', 0, '')
+        ('unenc_1', 'uuid-1', 'public_id_1', 0, '', None, None, None, None, None, None, None, None, None, None),
+        ('unenc_2', 'uuid-2', 'public_id_2', 0, '', 5, 6, 7, 8, None, None, None, None, None, None)
     ]
 
     with Inventory('test_database') as inv:
@@ -92,13 +97,14 @@ def test_read_registered_files(connect):
     eq_(rows['unenc_2']['public_id'], 'public_id_2')
     eq_(rows['unenc_2']['is_link'], 0)
     eq_(rows['unenc_2']['target'], '')
+    eq_(rows['unenc_2']['fingerprint'], (5, 6, 7, 8))
 
 @patch('direncrypt.inventory.sqlite3.connect')
 def test_read_registered_links(connect):
 
     connect().cursor().execute.return_value = [
-        ('unenc_1', '', '', 1, 'target_1'),
-        ('unenc_2', '', '', 1, 'target_2')
+        ('unenc_1', '', '', 1, 'target_1', None, None, None, None, None, None, None, None, None, None),
+        ('unenc_2', '', '', 1, 'target_2', None, None, None, None, None, None, None, None, None, None)
     ]
 
     with Inventory('test_database') as inv:
@@ -117,8 +123,8 @@ def test_read_registered_links(connect):
 def test_read_registered_dirs(connect):
 
     connect().cursor().execute.return_value = [
-        ('unenc_1', '', '', 0, ''),
-        ('unenc_2', '', '', 0, '')
+        ('unenc_1', '', '', 0, '', None, None, None, None, None, None, None, None, None, None),
+        ('unenc_2', '', '', 0, '', None, None, None, None, None, None, None, None, None, None)
     ]
 
     with Inventory('test_database') as inv:
@@ -138,10 +144,33 @@ def test_register(connect):
 
     with Inventory('test_database') as inv:
         inv.register('plain', 'encrypted', 'public_id', 1, 'target')
+        eq_(inv.cursor.executemany.call_count, 0)
+        inv.flush()
 
-        eq_(inv.cursor.execute.call_count, 1)
-        eq_(inv.cursor.execute.call_args[0][1],
-            ('plain', 'encrypted', 'public_id', 1, 'target'))
+        eq_(inv.cursor.executemany.call_count, 1)
+        eq_(inv.cursor.executemany.call_args[0][1],
+            [('plain', 'encrypted', 'public_id', 1, 'target',
+              None, None, None, None, None, None, None, 0, None, None, 'l')])
+
+@patch('direncrypt.inventory.sqlite3.connect')
+def test_register_fingerprint(connect):
+
+    with Inventory('test_database') as inv:
+        inv.register('plain', 'encrypted', 'public_id', 0, '', (1, 2, 3, 4), 'abc')
+        inv.flush()
+
+        eq_(inv.cursor.executemany.call_args[0][1],
+            [('plain', 'encrypted', 'public_id', 0, '', 1, 2, 3, 4, 'abc', None, None, 0, None, None, 'f')])
+
+@patch('direncrypt.inventory.sqlite3.connect')
+def test_update_fingerprint(connect):
+
+    with Inventory('test_database') as inv:
+        inv.update_fingerprint('plain', (1, 2, 3, 4))
+        inv.flush()
+
+        eq_(inv.cursor.executemany.call_count, 1)
+        eq_(inv.cursor.executemany.call_args[0][1], [(1, 2, 3, 4, 'plain')])
 
 @patch('direncrypt.inventory.sqlite3.connect')
 def test_update_parameters(connect):
@@ -159,4 +188,335 @@ def test_exists_encrypted_file(connect):
         r = inv.exists_encrypted_file('filename')
 
         assert inv.cursor.execute.call_count==1
-        assert inv.cursor.execute.call_args[0][1]==('filename',)
+        assert inv.cursor.execute.call_args[0][1]==('filename', 'filename')
+
+@patch('direncrypt.inventory.sqlite3.connect')
+def test_read_dirstate(connect):
+
+    connect().cursor().execute.return_value = [
+        ('', 1234, '[["subdir", "d"], ["file", "f"]]'),
+        ('subdir', None, '[]')
+    ]
+
+    with Inventory('test_database') as inv:
+        dirstate = inv.read_dirstate()
+
+    eq_(dirstate, {
+        '': (1234, [('subdir', 'd'), ('file', 'f')]),
+        'subdir': (None, [])
+    })
+
+@patch('direncrypt.inventory.sqlite3.connect')
+def test_update_dirstate(connect):
+
+    with Inventory('test_database') as inv:
+        inv.update_dirstate({'subdir': (1234, [('file', 'f')])}, ['gone'])
+        inv.flush()
+
+        calls = inv.cursor.executemany.call_args_list
+        eq_(calls[0][0][1], [('subdir', 1234, '[["file", "f"]]')])
+        eq_(calls[1][0][1], [('gone',)])
+
+@patch('direncrypt.inventory.sqlite3.connect')
+def test_clean_records(connect):
+
+    with Inventory('test_database') as inv:
+        inv.clean_records(['file_1', 'file_2'])
+        inv.flush()
+
+        eq_(inv.cursor.executemany.call_count, 1)
+        eq_(inv.cursor.executemany.call_args[0][1], [('file_1',), ('file_2',)])
+
+@patch('direncrypt.inventory.sqlite3.connect')
+def test_count_register(connect):
+
+    with Inventory('test_database') as inv:
+        inv.cursor.fetchone.return_value = (42,)
+        eq_(inv.count_register(), 42)
+
+@patch('direncrypt.inventory.sqlite3.connect')
+def test_register_pack_member(connect):
+
+    with Inventory('test_database') as inv:
+        inv.register('plain', 'pack-1', 'public_id', 0, '', (1, 2, 3, 4), None, (100, 1))
+        inv.flush()
+
+        eq_(inv.cursor.executemany.call_args[0][1],
+            [('plain', 'pack-1', 'public_id', 0, '', 1, 2, 3, 4, None, 100, 1, 0, None, None, 'f')])
+
+@patch('direncrypt.inventory.sqlite3.connect')
+def test_read_packs(connect):
+
+    connect().cursor().execute.return_value = [('pack-1', 100, 40), ('pack-2', 50, 0)]
+
+    with Inventory('test_database') as inv:
+        packs = inv.read_packs()
+
+    eq_(packs, {'pack-1': (100, 40), 'pack-2': (50, 0)})
+
+@patch('direncrypt.inventory.sqlite3.connect')
+def test_read_pack_members(connect):
+
+    connect().cursor().execute.return_value = [
+        ('unenc_1', 'pack-1', 'public_id_1', 0, '', 5, 6, 7, 8, None, 0, 5, 0, None, None),
+        ('unenc_2', 'pack-1', 'public_id_1', 0, '', 3, 6, 7, 8, None, 5, 3, 0, None, None)
+    ]
+
+    with Inventory('test_database') as inv:
+        rows = inv.read_pack_members('pack-1')
+
+    eq_(list(rows), ['unenc_1', 'unenc_2'])
+    eq_(rows['unenc_2']['pack'], (5, 3))
+
+@patch('direncrypt.inventory.sqlite3.connect')
+def test_move_pack_member(connect):
+
+    with Inventory('test_database') as inv:
+        inv.move_pack_member('plain', 'pack-2', (10, 5))
+        inv.move_pack_member('other', 'pack-2', (15, 5), 'key-1')
+        inv.flush()
+
+        eq_(inv.cursor.executemany.call_args[0][1],
+            [('pack-2', 10, 5, None, 'plain'), ('pack-2', 15, 5, 'key-1', 'other')])
+
+@patch('direncrypt.inventory.sqlite3.connect')
+def test_register_chunked(connect):
+
+    with Inventory('test_database') as inv:
+        inv.register('plain', 'manifest-1', 'public_id', 0, '', (1, 2, 3, 4), chunked=True)
+        inv.flush()
+        eq_(inv.cursor.executemany.call_args[0][1][0][-4:], (1, None, None, 'f'))
+
+        inv.register_manifest('manifest-1', ['chunk-1', 'chunk-2'])
+        inv.flush()
+        eq_(inv.cursor.executemany.call_args[0][1],
+            [('manifest-1', 0, 'chunk-1'), ('manifest-1', 1, 'chunk-2')])
+
+@patch('direncrypt.inventory.sqlite3.connect')
+def test_find_chunk(connect):
+
+    with Inventory('test_database') as inv:
+        inv.cursor.fetchone.return_value = ('chunk-1',)
+        eq_(inv.find_chunk('abc'), 'chunk-1')
+        inv.cursor.fetchone.return_value = None
+        eq_(inv.find_chunk('def'), None)
+
+@patch('direncrypt.inventory.sqlite3.connect')
+def test_read_chunk_keys(connect):
+
+    connect().cursor().execute.side_effect = lambda request, args: [
+        (args[0], 'key-1' if args[0] == 'chunk-2' else None)]
+
+    with Inventory('test_database') as inv:
+        inv.register_chunk('chunk-2', 'abc', 10, 'key-1')
+        inv.flush()
+        eq_(inv.cursor.executemany.call_args[0][1], [('chunk-2', 'abc', 10, 'key-1')])
+        eq_(inv.read_chunk_keys(['chunk-1', 'chunk-2', 'chunk-1']),
+            {'chunk-1': None, 'chunk-2': 'key-1'})
+
+@patch('direncrypt.inventory.sqlite3.connect')
+def test_read_manifest(connect):
+
+    connect().cursor().execute.return_value = [('chunk-1',), ('chunk-2',)]
+
+    with Inventory('test_database') as inv:
+        eq_(inv.read_manifest('manifest-1'), ['chunk-1', 'chunk-2'])
+
+@patch('direncrypt.inventory.sqlite3.connect')
+def test_register_session_key(connect):
+
+    with Inventory('test_database') as inv:
+        inv.register('plain', 'encrypted', 'public_id', 0, '', key_id='key-1')
+        inv.flush()
+        eq_(inv.cursor.executemany.call_args[0][1][0][-3], 'key-1')
+
+        inv.register_session_key('key-1', 'public_id', 'wrapped')
+        inv.flush()
+        eq_(inv.cursor.executemany.call_args[0][1], [('key-1', 'public_id', 'wrapped')])
+
+@patch('direncrypt.inventory.sqlite3.connect')
+def test_register_backend(connect):
+
+    with Inventory('test_database') as inv:
+        inv.register('plain', 'encrypted', 'public_id', 0, '', key_id='key-1', backend='aead')
+        inv.flush()
+        eq_(inv.cursor.executemany.call_args[0][1][0][-3:], ('key-1', 'aead', 'f'))
+
+    connect().cursor().execute.return_value = [
+        ('unenc_1', 'uuid-1', 'public_id_1', 0, '', None, None, None, None, None, None, None, 0, 'key-1', 'aead'),
+        ('unenc_2', 'uuid-2', 'public_id_1', 0, '', None, None, None, None, None, None, None, 0, None, None)
+    ]
+
+    with Inventory('test_database') as inv:
+        rows = inv.read_register('files')
+
+    eq_(rows['unenc_1']['backend'], 'aead')
+    eq_(rows['unenc_2']['backend'], None)
+
+@patch('direncrypt.inventory.sqlite3.connect')
+def test_read_session_keys(connect):
+
+    connect().cursor().execute.side_effect = lambda request, args: [(args[0], 'wrapped')]
+
+    with Inventory('test_database') as inv:
+        eq_(inv.read_session_keys(['key-1', 'key-2']),
+            {'key-1': 'wrapped', 'key-2': 'wrapped'})
+
+@patch('direncrypt.inventory.sqlite3.connect')
+def test_clean_session_keys(connect):
+
+    with Inventory('test_database') as inv:
+        inv.clean_session_keys('key-1')
+        ok_('DELETE FROM session_keys' in inv.cursor.execute.call_args[0][0])
+        eq_(inv.cursor.execute.call_args[0][1], ('key-1',))
+
+@patch('direncrypt.inventory.sqlite3.connect')
+def test_write_batches(connect):
+
+    with Inventory('test_database', batch_size=3) as inv:
+        inv.register('plain_1', 'encrypted_1', 'public_id', 0, '')
+        inv.register('plain_2', 'encrypted_2', 'public_id', 0, '')
+        inv.clean_record('plain_3')
+        eq_(inv.cursor.executemany.call_count, 2)
+        eq_([len(call[0][1]) for call in inv.cursor.executemany.call_args_list], [2, 1])
+        eq_(inv.conn.commit.call_count, 1)
+
+        inv.register('plain_4', 'encrypted_4', 'public_id', 0, '')
+        eq_(inv.cursor.executemany.call_count, 2)
+        inv.read_register()
+        eq_(inv.cursor.executemany.call_count, 3)
+        eq_(inv.conn.commit.call_count, 1)
+
+@patch('direncrypt.inventory.sqlite3.connect')
+def test_write_batches__other_tables(connect):
+
+    with Inventory('test_database') as inv:
+        inv.cursor.execute.reset_mock()
+        inv.register_pack('pack-1', 10)
+        inv.clean_pack('pack-2')
+        inv.register_chunk('chunk-1', 'abc', 10)
+        inv.register_manifest('manifest-1', ['chunk-1'])
+        inv.clean_manifest('manifest-2')
+        inv.clean_chunks(['chunk-2'])
+        inv.register_session_key('key-1', 'public_id', 'wrapped')
+        inv.update_dirstate({'subdir': (1234, [])}, ['gone'])
+        eq_(inv.cursor.execute.call_count, 0)
+        eq_(inv.cursor.executemany.call_count, 0)
+        eq_(inv.pending_count, 9)
+
+        inv.read_manifest('manifest-1')
+        eq_(inv.cursor.executemany.call_count, 9)
+        eq_(inv.pending_count, 0)
+
+@patch('direncrypt.inventory.sqlite3.connect')
+@patch('direncrypt.inventory.time.monotonic')
+def test_write_commit_interval(monotonic, connect):
+
+    monotonic.side_effect = [0, 1, 11, 11, 12]
+    with Inventory('test_database', commit_interval=10) as inv:
+        inv.register('plain_1', 'encrypted_1', 'public_id', 0, '')
+        eq_(inv.conn.commit.call_count, 0)
+        inv.register('plain_2', 'encrypted_2', 'public_id', 0, '')
+        eq_(inv.conn.commit.call_count, 1)
+
+def test_pragmas():
+
+    workdir = tempfile.mkdtemp()
+    try:
+        database = os.path.join(workdir, 'inventory.sqlite')
+        DatabaseBuilder(database).build()
+        with Inventory(database) as inv:
+            inv.update_parameters('sqlite_synchronous', 'full')
+        with Inventory(database) as inv:
+            eq_(inv.conn.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+            eq_(inv.conn.execute('PRAGMA synchronous').fetchone()[0], 2)
+            eq_(inv.conn.execute('PRAGMA cache_size').fetchone()[0], -64 * 1024)
+    finally:
+        shutil.rmtree(workdir)
+
+def test_pragmas__invalid():
+
+    workdir = tempfile.mkdtemp()
+    try:
+        database = os.path.join(workdir, 'inventory.sqlite')
+        DatabaseBuilder(database).build()
+        with Inventory(database) as inv:
+            inv.update_parameters('sqlite_synchronous', 'sometimes')
+            inv.update_parameters('sqlite_cache_size', '64MB')
+        with Inventory(database) as inv:
+            eq_(inv.conn.execute('PRAGMA synchronous').fetchone()[0], 1)
+            eq_(inv.conn.execute('PRAGMA cache_size').fetchone()[0],
+                Inventory.DEFAULT_CACHE_SIZE)
+            # the parameter can still be fixed
+            inv.update_parameters('sqlite_cache_size', '-1024')
+        with Inventory(database) as inv:
+            eq_(inv.conn.execute('PRAGMA cache_size').fetchone()[0], -1024)
+    finally:
+        shutil.rmtree(workdir)
+
+def test_register_kind():
+
+    workdir = tempfile.mkdtemp()
+    try:
+        database = os.path.join(workdir, 'inventory.sqlite')
+        DatabaseBuilder(database).build()
+        with Inventory(database) as inv:
+            inv.register('file', 'encrypted', 'public_id', 0, '')
+            inv.register('link', '', '', 1, 'file')
+            inv.register('dir', '', '', 0, '')
+            eq_(list(inv.read_register('files')), ['file'])
+            eq_(list(inv.read_register('links')), ['link'])
+            eq_(list(inv.read_register('dirs')), ['dir'])
+            ok_(inv.exists_encrypted_file('encrypted'))
+            plan = inv.conn.execute('EXPLAIN QUERY PLAN ' + inv.REGISTER_COLUMNS +
+                                    'WHERE encrypted_file = ?', ('encrypted',)).fetchall()
+            ok_('register_encrypted_file' in str([tuple(row) for row in plan]))
+    finally:
+        shutil.rmtree(workdir)
+
+@patch('direncrypt.inventory.sqlite3')
+def test_register_record(sqlite3):
+
+    with Inventory('test_database') as inv:
+        records = [inv.make_record((name, 'pack-1', ''.join(['public', '_id']),
+                                    0, '', 10, 20, 30, 40, 'digest',
+                                    0, 10, 0, None, 'gpg'))
+                   for name in ('plain_1', 'plain_2')]
+    record = records[0]
+
+    ok_(isinstance(record, RegisterRecord))
+    ok_(not hasattr(record, '__dict__'))
+    eq_(record.fingerprint, (10, 20, 30, 40))
+    eq_(record['pack'], (0, 10))
+    eq_(record.get('chunked'), False)
+    eq_(record.get('missing', 'default'), 'default')
+    assert_raises(KeyError, lambda: record['missing'])
+    ok_(records[0].public_id is records[1].public_id)
+    ok_(records[0].encrypted_file is records[1].encrypted_file)
+    eq_(RegisterRecord('plain_3').fingerprint, None)
+    eq_(RegisterRecord('plain_3').pack, None)
+    eq_(records[0], inv.make_record(('plain_1', 'pack-1', 'public_id', 0, '',
+                                     10, 20, 30, 40, 'digest', 0, 10, 0, None, 'gpg')))
+
+def test_iter_register():
+
+    workdir = tempfile.mkdtemp()
+    try:
+        database = os.path.join(workdir, 'inventory.sqlite')
+        DatabaseBuilder(database).build()
+        with Inventory(database) as inv:
+            for n in range(5):
+                inv.register('plain_{}'.format(n), 'encrypted_{}'.format(4 - n),
+                             'public_id', 0, '')
+            inv.register('link', '', '', 1, 'plain_0')
+            records = inv.iter_register('files', 'encrypted_file', batch_size=2)
+            eq_(next(records).unencrypted_file, 'plain_4')
+            # the inventory stays usable while iterating
+            inv.clean_record('link')
+            inv.commit()
+            eq_([record.unencrypted_file for record in records],
+                ['plain_3', 'plain_2', 'plain_1', 'plain_0'])
+            eq_(len(list(inv.iter_register())), 5)
+            assert_raises(ValueError, list, inv.iter_register('all', 'target'))
+    finally:
+        shutil.rmtree(workdir)
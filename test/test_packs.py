@@ -0,0 +1,68 @@
+#------------------------------------------------------------------------------
+# direncrypt - Sync contents between encrypted and decrypted directories
+# Copyright (C) 2015  Domagoj Marsic
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Contact:
+# https://github.com/dmarsic
+# <dmars+github@protonmail.com>
+#------------------------------------------------------------------------------
+import io
+import os
+import shutil
+import tempfile
+import nose
+from nose.tools import *
+from direncrypt.packs import extract_member, group_members, read_members
+
+
+def test_group_members():
+    sizes = {'c': 30, 'a': 60, 'b': 50, 'd': 10}
+    eq_(group_members(sizes, 100), [['a', 'b'], ['c', 'd']])
+
+def test_group_members__empty():
+    eq_(group_members({}, 100), [])
+
+def test_read_extract_members():
+    plaindir = tempfile.mkdtemp()
+    restoredir = tempfile.mkdtemp()
+    try:
+        os.makedirs(os.path.join(plaindir, 'subdir'))
+        for name, data in [('a', b'first'), (os.path.join('subdir', 'b'), b''),
+                           ('c', b'third file')]:
+            with open(os.path.join(plaindir, name), 'wb') as f:
+                f.write(data)
+
+        names = ['a', os.path.join('subdir', 'b'), 'missing', 'c']
+        stream, placed, missing = read_members(plaindir, names)
+        eq_(stream.read(), b'firstthird file')
+        eq_(placed, [('a', 0, 5), (os.path.join('subdir', 'b'), 5, 0), ('c', 5, 10)])
+        eq_(missing, ['missing'])
+
+        for name, offset, length in placed:
+            ok_(extract_member(stream, offset, length, restoredir, name, block_size=3))
+        with open(os.path.join(restoredir, 'c'), 'rb') as f:
+            eq_(f.read(), b'third file')
+        eq_(os.path.getsize(os.path.join(restoredir, 'subdir', 'b')), 0)
+    finally:
+        shutil.rmtree(plaindir)
+        shutil.rmtree(restoredir)
+
+def test_extract_member__short_pack():
+    restoredir = tempfile.mkdtemp()
+    try:
+        ok_(not extract_member(io.BytesIO(b'abc'), 1, 5, restoredir, 'a'))
+    finally:
+        shutil.rmtree(restoredir)
@@ -0,0 +1,98 @@
+#------------------------------------------------------------------------------
+# direncrypt - Sync contents between encrypted and decrypted directories
+# Copyright (C) 2015  Domagoj Marsic
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Contact:
+# https://github.com/dmarsic
+# <dmars+github@protonmail.com>
+#------------------------------------------------------------------------------
+
+import os
+import nose
+from nose.tools import *
+from direncrypt.rules import PathRules
+
+
+def test_parse():
+    """Patterns are separated by whitespace."""
+    rules = PathRules.parse('node_modules/  *.tmp\n!keep.tmp')
+    eq_(rules.patterns, ['node_modules/', '*.tmp', '!keep.tmp'])
+    ok_(rules)
+    ok_(not PathRules.parse(None))
+    ok_(not PathRules.parse('').is_excluded('anything'))
+
+
+def test_match__name():
+    """Pattern without slash matches a name at any depth."""
+    rules = PathRules(['*.tmp', 'cache'])
+    ok_(rules.match('file.tmp'))
+    ok_(rules.match(os.path.join('a', 'b', 'file.tmp')))
+    ok_(rules.match(os.path.join('a', 'cache'), is_dir=True))
+    ok_(not rules.match('file.tmp.txt'))
+    ok_(not rules.match(os.path.join('cache', 'file')))
+
+
+def test_match__anchored():
+    """Pattern with slash is matched from the root."""
+    rules = PathRules(['/build', os.path.join('docs', '*.pdf')])
+    ok_(rules.match('build', is_dir=True))
+    ok_(not rules.match(os.path.join('src', 'build'), is_dir=True))
+    ok_(rules.match(os.path.join('docs', 'a.pdf')))
+    ok_(not rules.match(os.path.join('docs', 'sub', 'a.pdf')))
+
+
+def test_match__directory_only():
+    """Trailing slash matches directories only."""
+    rules = PathRules(['.git/'])
+    ok_(rules.match('.git', is_dir=True))
+    ok_(not rules.match('.git'))
+
+
+def test_match__double_star():
+    """Double star matches any number of directories."""
+    rules = PathRules(['a/**/z', 'logs/**'])
+    ok_(rules.match(os.path.join('a', 'z')))
+    ok_(rules.match(os.path.join('a', 'b', 'c', 'z')))
+    ok_(rules.match(os.path.join('logs', 'x', 'y.log')))
+    ok_(not rules.match(os.path.join('b', 'a', 'z')))
+
+
+def test_match__negation():
+    """The last matching pattern wins."""
+    rules = PathRules(['*.log', '!keep.log', 'keep.log.*'])
+    ok_(rules.match('debug.log'))
+    ok_(not rules.match('keep.log'))
+    ok_(rules.match('keep.log.1'))
+
+
+def test_match__character_class():
+    """Character classes and escapes are supported."""
+    rules = PathRules(['file[0-9].txt', 'other[!a].txt', 'star\\*'])
+    ok_(rules.match('file1.txt'))
+    ok_(not rules.match('filex.txt'))
+    ok_(rules.match('otherb.txt'))
+    ok_(not rules.match('othera.txt'))
+    ok_(rules.match('star*'))
+    ok_(not rules.match('stars'))
+
+
+def test_is_excluded():
+    """Content of an excluded directory is excluded."""
+    rules = PathRules(['node_modules/', '!important.js'])
+    ok_(rules.is_excluded(os.path.join('app', 'node_modules', 'important.js')))
+    ok_(not rules.is_excluded(os.path.join('app', 'important.js')))
+    ok_(not rules.is_excluded(os.path.join('app', 'node_modules')))
+    ok_(rules.is_excluded(os.path.join('app', 'node_modules'), is_dir=True))
@@ -0,0 +1,201 @@
+#------------------------------------------------------------------------------
+# direncrypt - Sync contents between encrypted and decrypted directories
+# Copyright (C) 2015  Domagoj Marsic
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Contact:
+# https://github.com/dmarsic
+# <dmars+github@protonmail.com>
+#------------------------------------------------------------------------------
+
+import os
+import shutil
+import tempfile
+import time
+import nose
+from nose.tools import *
+from mock import patch
+from direncrypt.scanner import TreeScanner
+from direncrypt.rules import PathRules
+
+
+def make_tree():
+    """Create a small tree with files, symlinks and empty directories."""
+    root = tempfile.mkdtemp()
+    os.makedirs(os.path.join(root, 'subdir_1', 'empty_2'))
+    os.makedirs(os.path.join(root, 'empty_1'))
+    os.makedirs(os.path.join(root, 'subdir_3'))
+    for name in ['file_1', os.path.join('subdir_1', 'file_2')]:
+        with open(os.path.join(root, name), 'w') as f:
+            f.write(name)
+    os.symlink('file_1', os.path.join(root, 'link_1'))
+    os.symlink('subdir_1', os.path.join(root, 'subdir_3', 'link_2'))
+    return root
+
+
+def test_scan():
+    """Files, links and empty directories are found in a single walk."""
+    root = make_tree()
+    try:
+        result = TreeScanner(root).scan()
+    finally:
+        shutil.rmtree(root)
+
+    eq_(sorted(result.files), ['file_1', os.path.join('subdir_1', 'file_2')])
+    eq_(sorted(result.links), ['link_1', os.path.join('subdir_3', 'link_2')])
+    eq_(sorted(result.dirs), ['empty_1', os.path.join('subdir_1', 'empty_2')])
+    eq_(result.files['file_1'].st_size, len('file_1'))
+
+
+def test_scan__empty_root():
+    """Root directory is not reported as an empty directory."""
+    root = tempfile.mkdtemp()
+    try:
+        result = TreeScanner(root).scan()
+    finally:
+        shutil.rmtree(root)
+
+    eq_(result.dirs, {})
+
+
+def test_scan__missing_root():
+    """Missing root directory gives an empty result."""
+    result = TreeScanner('/nonexistent/direncrypt/root').scan()
+    eq_((result.files, result.links, result.dirs), ({}, {}, {}))
+
+
+def age_directories(root, seconds=60):
+    """Move directory mtimes out of the racy window."""
+    past = time.time() - seconds
+    for dirpath, dirnames, filenames in os.walk(root):
+        os.utime(dirpath, (past, past))
+
+
+def test_scan__dirstate():
+    """Unchanged directories are listed from the dirstate."""
+    root = make_tree()
+    try:
+        age_directories(root)
+        scanner = TreeScanner(root, {})
+        first = scanner.scan()
+        changed, removed = scanner.dirstate_changes()
+        eq_(sorted(changed), ['', 'empty_1', 'subdir_1',
+                              os.path.join('subdir_1', 'empty_2'), 'subdir_3'])
+        eq_(removed, [])
+
+        with open(os.path.join(root, 'subdir_1', 'file_3'), 'w') as f:
+            f.write('new')
+        os.rmdir(os.path.join(root, 'empty_1'))
+        scanner = TreeScanner(root, scanner.new_dirstate)
+        with patch('direncrypt.scanner.os.scandir', wraps=os.scandir) as scandir:
+            second = scanner.scan()
+        changed, removed = scanner.dirstate_changes()
+    finally:
+        shutil.rmtree(root)
+
+    # only the root and subdir_1 changed
+    eq_(scandir.call_count, 2)
+    eq_(sorted(changed), ['', 'subdir_1'])
+    eq_(changed['subdir_1'][0], None)
+    eq_(removed, ['empty_1'])
+    eq_(sorted(second.files), sorted(list(first.files) + [os.path.join('subdir_1', 'file_3')]))
+    eq_(sorted(second.links), sorted(first.links))
+    eq_(sorted(second.dirs), [os.path.join('subdir_1', 'empty_2')])
+
+
+def test_scan__rules():
+    """Excluded entries are left out and excluded directories are not walked."""
+    root = make_tree()
+    try:
+        rules = PathRules(['subdir_1/', 'link_*', '!link_2'])
+        with patch('direncrypt.scanner.os.scandir', wraps=os.scandir) as scandir:
+            result = TreeScanner(root, rules=rules).scan()
+    finally:
+        shutil.rmtree(root)
+
+    eq_(scandir.call_count, 3)
+    eq_(sorted(result.files), ['file_1'])
+    eq_(sorted(result.links), [os.path.join('subdir_3', 'link_2')])
+    eq_(sorted(result.dirs), ['empty_1'])
+
+
+def test_scan__start():
+    """Walk can start in a subdirectory."""
+    root = make_tree()
+    try:
+        result = TreeScanner(root).scan(os.path.join('subdir_1', 'empty_2'))
+        eq_(sorted(result.dirs), [os.path.join('subdir_1', 'empty_2')])
+        result = TreeScanner(root).scan('subdir_1')
+    finally:
+        shutil.rmtree(root)
+
+    eq_(sorted(result.files), [os.path.join('subdir_1', 'file_2')])
+    eq_(sorted(result.dirs), [os.path.join('subdir_1', 'empty_2')])
+
+
+def test_scan__workers():
+    """Parallel walk gives the same sorted result as the serial walk."""
+    root = make_tree()
+    try:
+        serial = TreeScanner(root).scan()
+        parallel = TreeScanner(root, workers=4).scan()
+    finally:
+        shutil.rmtree(root)
+
+    for kind in ['files', 'links', 'dirs']:
+        eq_(list(getattr(parallel, kind)), sorted(getattr(serial, kind)))
+        eq_(list(getattr(serial, kind)), sorted(getattr(serial, kind)))
+
+
+def test_scan__workers_dirstate():
+    """Parallel walk builds the same dirstate as the serial walk."""
+    root = make_tree()
+    try:
+        age_directories(root)
+        serial = TreeScanner(root, dirstate={})
+        serial.scan()
+        parallel = TreeScanner(root, dirstate={}, workers=4)
+        parallel.scan()
+    finally:
+        shutil.rmtree(root)
+
+    eq_(parallel.new_dirstate, serial.new_dirstate)
+
+
+def failing_scandir(failing):
+    """Return an os.scandir replacement that fails on the given directory."""
+    scandir = os.scandir
+    def side_effect(path):
+        if os.path.basename(path) == failing:
+            raise OSError(5, 'Input/output error')
+        return scandir(path)
+    return side_effect
+
+
+def test_scan__unreadable_directory():
+    """A directory that cannot be listed is kept in the failed set."""
+    root = make_tree()
+    try:
+        with patch('direncrypt.scanner.os.scandir', side_effect=failing_scandir('subdir_1')):
+            result = TreeScanner(root).scan()
+    finally:
+        shutil.rmtree(root)
+
+    eq_(sorted(result.files), ['file_1'])
+    eq_(result.failed, {'subdir_1'})
+    ok_(result.is_incomplete(os.path.join('subdir_1', 'file_2')))
+    ok_(not result.is_incomplete('file_1'))
+    ok_(not result.is_incomplete('subdir_10'))
+    eq_(TreeScanner('/nonexistent/direncrypt/root').scan().failed, {''})
@@ -0,0 +1,109 @@
+#------------------------------------------------------------------------------
+# direncrypt - Sync contents between encrypted and decrypted directories
+# Copyright (C) 2015  Domagoj Marsic
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Contact:
+# https://github.com/dmarsic
+# <dmars+github@protonmail.com>
+#------------------------------------------------------------------------------
+import os
+import shutil
+import tempfile
+import nose
+from nose.tools import *
+from direncrypt.scanner import TreeScanner
+from direncrypt.snapshot import ScanSnapshot
+
+
+def make_tree():
+    """Create a tree with files, a symlink and an empty directory."""
+    root = tempfile.mkdtemp()
+    os.makedirs(os.path.join(root, 'subdir', 'empty'))
+    for name in ['a', 'c', os.path.join('subdir', 'b')]:
+        with open(os.path.join(root, name), 'w') as f:
+            f.write(name)
+    os.symlink('a', os.path.join(root, 'link'))
+    return root
+
+
+def test_write_load():
+    """Snapshot keeps the header values and all entries."""
+    root = make_tree()
+    try:
+        scan = TreeScanner(root).scan()
+        filename = os.path.join(root, 'snapshot')
+        ScanSnapshot.write(filename, scan, root, 7)
+        with ScanSnapshot.load(filename) as snapshot:
+            eq_(snapshot.plaindir, root)
+            eq_(snapshot.register_count, 7)
+            eq_(snapshot.count, 5)
+            eq_(snapshot.diff(scan), ([], []))
+    finally:
+        shutil.rmtree(root)
+
+
+def test_load__missing():
+    """Missing or invalid snapshot file is not loaded."""
+    root = tempfile.mkdtemp()
+    try:
+        eq_(ScanSnapshot.load(os.path.join(root, 'missing')), None)
+        filename = os.path.join(root, 'invalid')
+        with open(filename, 'wb') as f:
+            f.write(b'not a snapshot at all, but long enough')
+        eq_(ScanSnapshot.load(filename), None)
+        open(filename, 'wb').close()
+        eq_(ScanSnapshot.load(filename), None)
+    finally:
+        shutil.rmtree(root)
+
+
+def test_diff():
+    """New, changed, retyped and removed paths are found in one pass."""
+    root = make_tree()
+    try:
+        filename = os.path.join(root, '..', os.path.basename(root) + '.snapshot')
+        ScanSnapshot.write(filename, TreeScanner(root).scan(), root, 0)
+
+        with open(os.path.join(root, 'c'), 'w') as f:
+            f.write('changed content')
+        os.remove(os.path.join(root, 'link'))
+        os.mkdir(os.path.join(root, 'link'))
+        shutil.rmtree(os.path.join(root, 'subdir'))
+        with open(os.path.join(root, 'd'), 'w') as f:
+            f.write('d')
+
+        with ScanSnapshot.load(filename) as snapshot:
+            changed, removed = snapshot.diff(TreeScanner(root).scan())
+        os.remove(filename)
+    finally:
+        shutil.rmtree(root)
+
+    eq_(changed, ['c', 'd', 'link'])
+    eq_(removed, [os.path.join('subdir', 'b'), os.path.join('subdir', 'empty')])
+
+
+def test_write__skip():
+    """Skipped paths are reported as changed on the next diff."""
+    root = make_tree()
+    try:
+        scan = TreeScanner(root).scan()
+        filename = os.path.join(root, 'snapshot')
+        ScanSnapshot.write(filename, scan, root, 0, skip={'c'})
+        with ScanSnapshot.load(filename) as snapshot:
+            eq_(snapshot.count, 4)
+            eq_(snapshot.diff(scan), (['c'], []))
+    finally:
+        shutil.rmtree(root)
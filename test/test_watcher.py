@@ -0,0 +1,90 @@
+#------------------------------------------------------------------------------
+# direncrypt - Sync contents between encrypted and decrypted directories
+# Copyright (C) 2015  Domagoj Marsic
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Contact:
+# https://github.com/dmarsic
+# <dmars+github@protonmail.com>
+#------------------------------------------------------------------------------
+
+import os
+import shutil
+import tempfile
+import nose
+from nose.tools import *
+from direncrypt.watcher import InotifyWatcher
+
+
+def collect(watcher, rounds=5):
+    """Read events until none are left."""
+    paths = set()
+    for _ in range(rounds):
+        events = watcher.read_events(0.2)
+        if not events:
+            break
+        paths |= events
+    return paths
+
+
+def test_read_events():
+    """Created, modified and deleted paths are reported relative to root."""
+    root = tempfile.mkdtemp()
+    os.mkdir(os.path.join(root, 'subdir_1'))
+    try:
+        with InotifyWatcher(root) as watcher:
+            with open(os.path.join(root, 'file_1'), 'w') as f:
+                f.write('data')
+            os.unlink(os.path.join(root, 'file_1'))
+            with open(os.path.join(root, 'subdir_1', 'file_2'), 'w') as f:
+                f.write('data')
+            paths = collect(watcher)
+    finally:
+        shutil.rmtree(root)
+
+    eq_(paths, {'file_1', os.path.join('subdir_1', 'file_2')})
+
+
+def test_read_events__new_directory():
+    """New directories are watched, moved out directories are not."""
+    root = tempfile.mkdtemp()
+    outside = tempfile.mkdtemp()
+    try:
+        with InotifyWatcher(root) as watcher:
+            os.mkdir(os.path.join(root, 'subdir_1'))
+            collect(watcher)
+            with open(os.path.join(root, 'subdir_1', 'file_1'), 'w') as f:
+                f.write('data')
+            eq_(collect(watcher), {os.path.join('subdir_1', 'file_1')})
+
+            os.rename(os.path.join(root, 'subdir_1'), os.path.join(outside, 'moved'))
+            eq_(collect(watcher), {'subdir_1'})
+            with open(os.path.join(outside, 'moved', 'file_2'), 'w') as f:
+                f.write('data')
+            eq_(collect(watcher), set())
+    finally:
+        shutil.rmtree(root)
+        shutil.rmtree(outside)
+
+
+def test_parse_events__overflow():
+    """Queue overflow is reported as None."""
+    root = tempfile.mkdtemp()
+    try:
+        with InotifyWatcher(root) as watcher:
+            data = InotifyWatcher.EVENT_HEADER.pack(-1, InotifyWatcher.IN_Q_OVERFLOW, 0, 0)
+            eq_(watcher.parse_events(data), None)
+    finally:
+        shutil.rmtree(root)